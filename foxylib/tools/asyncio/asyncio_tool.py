@@ -1,12 +1,15 @@
 import asyncio
+import inspect
 import logging
+import time
 from asyncio import ensure_future, gather, get_event_loop
+from collections import deque
 from dataclasses import dataclass
 from datetime import datetime, timedelta
+from functools import partial
 from typing import Callable, Optional
 
 import pytz
-from aiostream.stream import merge
 from cachetools import LRUCache
 from future.utils import lmap
 from nose.tools import assert_false, assert_equal, assert_greater_equal, assert_true
@@ -15,6 +18,9 @@ from foxylib.tools.cache.cache_manager import CacheManager
 from foxylib.tools.collections.collections_tool import l_singleton2obj
 from foxylib.tools.collections.iter_tool import iter2singleton, IterTool
 from foxylib.tools.log.foxylib_logger import FoxylibLogger
+from foxylib.tools.metric.metric_tool import MetricTool
+from foxylib.tools.process.process_tool import ProcessTool
+from foxylib.tools.thread.thread_tool import ThreadTool
 from foxylib.tools.version.version_tool import VersionTool
 
 
@@ -47,27 +53,181 @@ class AioTool:
         return result_list
 
     @classmethod
-    async def awaitables2coro_gathered(cls, awaitables):
+    async def awaitables2coro_gathered(cls, awaitables, concurrency=None):
+        """
+        concurrency: max awaitables running at once. all at once if None
+        """
+        if concurrency is not None:
+            return await cls.aiter2list(cls.amap(lambda x: x, awaitables, concurrency))
+
         async def gathered():
             return await gather(*awaitables)
         return await gathered()
 
     @classmethod
-    def awaitables2result_list(cls, awaitables,):
-        return asyncio.run(cls.awaitables2coro_gathered(awaitables))
+    def awaitables2result_list(cls, awaitables, concurrency=None, ):
+        return asyncio.run(cls.awaitables2coro_gathered(awaitables, concurrency=concurrency))
 
     @classmethod
     async def aiter2list(cls, aiter):
         return [x async for x in aiter]
 
+    @classmethod
+    def aiterable2aiter(cls, iterable):
+        """
+        async iterator over an async or plain iterable
+        """
+        if hasattr(iterable, "__aiter__"):
+            return iterable.__aiter__()
+        return cls.iterable2aiter(iterable)
+
+    @classmethod
+    async def _func_x2result(cls, f, x):
+        result = f(x)
+        if inspect.isawaitable(result):
+            return await result
+        return result
+
+    @classmethod
+    async def amap(cls, f, iterable, concurrency, ordered=True):
+        """
+        f(x) for each x of a plain or async iterable, at most `concurrency` calls in flight.
+        input is pulled only as calls finish, so memory stays O(concurrency) on endless streams.
+
+        ordered: results in input order. a slow call holds back the ones after it, up to `concurrency`.
+        unordered: results as they complete.
+        the first failure is raised, and closing the generator early cancels the calls in flight.
+        """
+        aiter = cls.aiterable2aiter(iterable)
+        tasks = deque() if ordered else set()
+
+        async def task2added():
+            try:
+                x = await aiter.__anext__()
+            except StopAsyncIteration:
+                return False
+
+            task = asyncio.ensure_future(cls._func_x2result(f, x))
+            if ordered:
+                tasks.append(task)
+            else:
+                tasks.add(task)
+            return True
+
+        try:
+            is_open = True
+            while True:
+                while is_open and len(tasks) < concurrency:
+                    is_open = await task2added()
+
+                if not tasks:
+                    return
+
+                if ordered:
+                    yield await tasks[0]
+                    tasks.popleft()
+                    continue
+
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    tasks.remove(task)
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    @classmethod
+    async def _aiter2pumped(cls, aiter, queue, item_end, is_fair=False):
+        """
+        items into the queue, then item_end, which also follows a failure. the task then raises it
+        is_fair: yields to the loop after each item, so that a source that is always ready
+          can not refill the queue alone before the other pumps woken by the consumer get a turn
+        """
+        try:
+            async for item in aiter:
+                await queue.put(item)
+                if is_fair:
+                    await asyncio.sleep(0)
+        except Exception:
+            await queue.put(item_end)
+            raise
+
+        await queue.put(item_end)
+
+    @classmethod
+    async def abuffer(cls, iterable, size):
+        """
+        prefetch: a background task reads up to `size` items ahead of the consumer
+        """
+        end = object()
+        queue = asyncio.Queue(maxsize=size)
+        task = asyncio.ensure_future(cls._aiter2pumped(cls.aiterable2aiter(iterable), queue, end))
+
+        try:
+            while True:
+                item = await queue.get()
+                if item is end:
+                    await task  # raises the failure, if any
+                    return
+                yield item
+        finally:
+            task.cancel()
+
     @classmethod
     async def aiters2merged(cls, aiters):
-        async with merge(*aiters).stream() as streamer:
-            async for item in streamer:
+        """
+        items of all iterables as they come, each source at most one item ahead.
+        sources blocked on the shared queue are woken in turn, so a fast source can not starve the others.
+        the first failure is raised.
+        """
+        end = object()
+        aiter_list = lmap(cls.aiterable2aiter, aiters)
+        queue = asyncio.Queue(maxsize=max(len(aiter_list), 1))
+        tasks = [asyncio.ensure_future(cls._aiter2pumped(aiter, queue, end, is_fair=True)) for aiter in aiter_list]
+
+        def tasks2raise_failure():
+            for task in tasks:
+                if task.done() and not task.cancelled() and task.exception() is not None:
+                    raise task.exception()
+
+        try:
+            n_alive = len(tasks)
+            while n_alive:
+                item = await queue.get()
+                if item is end:
+                    n_alive -= 1
+                    tasks2raise_failure()  # a failed source is done before its end is queued
+                    continue
                 yield item
+        finally:
+            for task in tasks:
+                task.cancel()
 
     @classmethod
-    async def aiter2chunks(cls, aiter, chunk_size):
+    async def aiter2chunks(cls, aiter, chunk_size, timeout=None):
+        """
+        timeout: seconds after its first item that a partial chunk is flushed anyway. count only if None
+        """
+        if timeout is not None:
+            end = object()
+            queue = asyncio.Queue(maxsize=chunk_size)
+            task = asyncio.ensure_future(cls._aiter2pumped(cls.aiterable2aiter(aiter), queue, end))
+
+            try:
+                while True:
+                    item_list = await AioQueueTool.dequeue_batch(queue, chunk_size, timeout=timeout, item_end=end)
+                    is_end = item_list[-1] is end
+                    chunk = item_list[:-1] if is_end else item_list
+
+                    if chunk:
+                        yield chunk
+                    if is_end:
+                        await task
+                        return
+            finally:
+                task.cancel()
+
         chunk = []
         async for item in aiter:
             chunk.append(item)
@@ -78,6 +238,36 @@ class AioTool:
         if chunk:
             yield chunk
 
+    @classmethod
+    async def atake_until_deadline(cls, iterable, dt_deadline):
+        """
+        items until the datetime dt_deadline, also cutting short the wait for the next item
+        """
+        aiter = cls.aiterable2aiter(iterable)
+        loop = asyncio.get_event_loop()
+        time_deadline = loop.time() + (dt_deadline - datetime.now(pytz.utc)) / timedelta(seconds=1)
+
+        while True:
+            secs_left = time_deadline - loop.time()
+            if secs_left <= 0:
+                return
+
+            task = asyncio.ensure_future(aiter.__anext__())
+            try:
+                done, _ = await asyncio.wait([task], timeout=secs_left)
+            finally:
+                if not task.done():
+                    task.cancel()
+
+            if not done:
+                return
+
+            try:
+                item = task.result()
+            except StopAsyncIteration:
+                return
+            yield item
+
     @classmethod
     async def datetime2sleep(cls, dt):
         dt_now = datetime.now(pytz.utc)
@@ -205,22 +395,140 @@ class AioQueueTool:
         return items
 
     @classmethod
-    async def dequeue_n_timeout(cls, queue, n, timeout=None):
+    async def dequeue_n_timeout(cls, queue, n, timeout=None, item_end=None):
+        """
+        item_end: sentinel that ends the chunk early. returned as the last item
+        """
         logger = FoxylibLogger.func_level2logger(cls.dequeue_n_timeout, logging.DEBUG)
 
         item_first = await queue.get()
         item_list = [item_first]
+        if item_end is not None and item_first is item_end:
+            return item_list
 
         try:
             # logger.debug({"n": n})
             for i in range(n - 1):
                 item = await asyncio.wait_for(queue.get(), timeout=timeout)
                 item_list.append(item)
+                if item_end is not None and item is item_end:
+                    break
         except asyncio.TimeoutError:
             pass
 
         return item_list
 
+    class ArrivalQueue(asyncio.Queue):
+        """
+        asyncio.Queue that stamps each item as it is put, so that consumers see when it arrived, not when they got it.
+        time_got: arrival time of the item got last
+        """
+
+        def _init(self, maxsize):
+            super()._init(maxsize)
+            self._times = deque()
+            self.time_got = None
+
+        def _put(self, item):
+            self._times.append(time.perf_counter())
+            super()._put(item)
+
+        def _get(self):
+            self.time_got = self._times.popleft()
+            return super()._get()
+
+    @classmethod
+    def queue2time_got(cls, queue, time_default):
+        """
+        arrival time of the item just got, if the queue stamps them. time_default otherwise
+        """
+        if isinstance(queue, cls.ArrivalQueue):
+            return queue.time_got
+        return time_default
+
+    class AdaptiveLinger:
+        """
+        linger of dequeue_batch() from the arrival rate seen so far, as an EWMA of the gap between items.
+        observe() takes arrival times. dequeue_batch() reads them from an ArrivalQueue; on other queues it falls
+        back to dequeue times, which a backlog or a slow consumer distorts.
+
+        waits as long as filling the batch takes at that rate, within [secs_min, secs_max],
+        and only secs_min when not even one more item is expected within secs_max.
+        shared by the workers of a queue, on one event loop.
+        """
+
+        def __init__(self, secs_max, secs_min=0.0, alpha=0.2):
+            self.secs_max = secs_max
+            self.secs_min = secs_min
+            self.alpha = alpha
+
+            self.secs_gap = None
+            self.time_last = None
+
+        def observe(self, time_arrival):
+            if self.time_last is not None:
+                secs_gap = max(time_arrival - self.time_last, 0.0)
+                self.secs_gap = secs_gap if self.secs_gap is None \
+                    else self.alpha * secs_gap + (1 - self.alpha) * self.secs_gap
+            self.time_last = time_arrival
+
+        def size2secs(self, size_remaining):
+            if self.secs_gap is None:
+                return self.secs_max
+
+            if self.secs_gap > self.secs_max:
+                return self.secs_min
+
+            secs = size_remaining * self.secs_gap
+            return min(max(secs, self.secs_min), self.secs_max)
+
+    @classmethod
+    async def dequeue_batch(cls, queue, size_max, size_min=1, timeout=None, linger=None, item_end=None, ):
+        """
+        micro-batch of up to size_max items. waits for the first item, then for at most `timeout` seconds overall.
+        timeout None: until size_max items. 0: only what is already queued, like dequeue_n_nowait()
+        size_min: keeps waiting past the deadline until there are that many items
+        linger: AdaptiveLinger, which sets the deadline instead of `timeout`. learns best from an ArrivalQueue
+        item_end: sentinel that ends the batch early. returned as the last item
+        """
+        item = await queue.get()
+        time_first = time.perf_counter()
+
+        item_list = [item]
+        if item_end is not None and item is item_end:
+            return item_list
+
+        if linger is not None:
+            linger.observe(cls.queue2time_got(queue, time_first))
+
+        secs = linger.size2secs(size_max - 1) if linger is not None else timeout
+        deadline = time_first + secs if secs is not None else None
+
+        while len(item_list) < size_max:
+            try:
+                item = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                if len(item_list) < size_min or deadline is None:
+                    secs_wait = None
+                else:
+                    secs_wait = deadline - time.perf_counter()
+                    if secs_wait <= 0:
+                        break
+
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout=secs_wait)
+                except asyncio.TimeoutError:
+                    break
+
+            item_list.append(item)
+            if item_end is not None and item is item_end:
+                break
+
+            if linger is not None:
+                linger.observe(cls.queue2time_got(queue, time.perf_counter()))
+
+        return item_list
+
     @classmethod
     async def items2enqueue_by_chunk(cls, queue, items_in, p):
         item_list_in = list(items_in)
@@ -240,11 +548,53 @@ class AioQueueTool:
 
 
 class AioPipeline:
+    """
+    stages connected by queues: producers, then pipers, then consumers.
+    a stage is a list of batch functions. each runs in `workers` tasks (see Config), reading from the queue before it.
+
+    producer: () -> iterable or async iterable of items
+    piper: list of items -> iterable of items, or a coroutine returning one
+    consumer: list of items -> anything, iterated through if iterable
+
+    queues are bounded, so a slow stage blocks the ones before it instead of letting queues grow.
+    the first failure in any stage cancels the whole pipeline and is raised.
+    on completion, END flows down the queues behind the last item, and each stage flushes its partial chunk and exits.
+    """
+
+    END = object()  # sentinel behind the last item of a queue
+
     @dataclass
     class Config:
+        """
+        config of a queue, and of the stage reading from it
+        dequeue_*: micro-batches, see AioQueueTool.dequeue_batch()
+            chunksize: max batch size. timeout: seconds to fill a batch after its first item, overall
+            size_min: min batch size, except the last one. linger: AioQueueTool.AdaptiveLinger, instead of timeout
+        maxsize: bound of the queue made when f_queue is None (0: unbounded). an ArrivalQueue with dequeue_linger
+        workers: tasks per batch function of the stage, i.e. batches in flight
+        mode: where the batch functions run, see Mode. producers always run inline
+        pool: name of the executor in ThreadTool.name2executor() or the pool in ProcessTool.name2pool()
+        ipc_chunksize: PROCESS mode sends each batch in chunks of this many items, run in parallel. whole if None
+        ordered: outputs in input order, even with several workers. batches are then dequeued one at a time
+        """
+
+        class Mode:
+            INLINE = "inline"  # on the event loop. batch functions may be coroutine functions
+            THREAD = "thread"  # blocking I/O, or C code releasing the GIL
+            PROCESS = "process"  # CPU-bound python. batch functions and items must be picklable (dill as fallback)
+
         f_queue: Callable[[], asyncio.Queue] = None
         dequeue_chunksize: int = 1
         dequeue_timeout: Optional[float] = None
+        dequeue_size_min: int = 1
+        dequeue_linger: Optional["AioQueueTool.AdaptiveLinger"] = None
+        maxsize: int = 1024
+        workers: int = 1
+        name: Optional[str] = None
+        mode: str = Mode.INLINE
+        pool: Optional[str] = None
+        ipc_chunksize: Optional[int] = None
+        ordered: bool = False
 
         @CacheManager.attach_cachedmethod(self2cache=lambda x: LRUCache(maxsize=2), )
         def queue(self):
@@ -253,20 +603,126 @@ class AioPipeline:
         @classmethod
         def config_list2init(cls, config_list, size):
             if config_list is None:
-                return [cls(f_queue=asyncio.Queue) for _ in range(size)]
+                config_list = [None] * size
 
             def config2init(config):
-                if not config:
-                    return cls(f_queue=asyncio.Queue)
-
+                config = config or cls()
                 if config.f_queue is None:
-                    config.f_queue = asyncio.Queue
+                    f_queue = AioQueueTool.ArrivalQueue if config.dequeue_linger is not None else asyncio.Queue
+                    config.f_queue = partial(f_queue, maxsize=config.maxsize)
                 return config
 
             return lmap(config2init, config_list)
 
+    class StageStats:
+        """
+        metrics of one stage, updated on the event loop only
+
+        secs_busy: time in the batch functions
+        secs_blocked_get: time waiting for input, i.e. starved by the stage before
+        secs_blocked_put: time waiting on the full queue after, i.e. back-pressure from the stage after
+        queue_depth(_max): items in the queue before the stage. sampled on each dequeue for the max
+        """
+
+        class Field:
+            NAME = "name"
+            WORKERS = "workers"
+            ITEMS_IN = "items_in"
+            ITEMS_OUT = "items_out"
+            BATCHES = "batches"
+            ERRORS = "errors"
+            SECS_BUSY = "secs_busy"
+            SECS_BLOCKED_GET = "secs_blocked_get"
+            SECS_BLOCKED_PUT = "secs_blocked_put"
+            SECS_ELAPSED = "secs_elapsed"
+            THROUGHPUT = "throughput"
+            QUEUE_DEPTH = "queue_depth"
+            QUEUE_DEPTH_MAX = "queue_depth_max"
+            QUEUE_MAXSIZE = "queue_maxsize"
+
+        def __init__(self, name):
+            self.name = name
+            self.queue_in = None
+
+            self.workers = 0
+            self.workers_alive = 0
+            self.items_in = 0
+            self.items_out = 0
+            self.batches = 0
+            self.errors = 0
+            self.secs_busy = 0.0
+            self.secs_blocked_get = 0.0
+            self.secs_blocked_put = 0.0
+            self.queue_depth_max = 0
+
+            self.time_start = None
+            self.time_end = None
+
+        def to_dict(self):
+            """
+            throughput: items out per second, or items in for consumers
+            """
+            if self.time_start is None:
+                secs_elapsed = None
+            else:
+                secs_elapsed = (self.time_end or time.perf_counter()) - self.time_start
+
+            count = self.items_out or self.items_in
+            return {self.Field.NAME: self.name,
+                    self.Field.WORKERS: self.workers,
+                    self.Field.ITEMS_IN: self.items_in,
+                    self.Field.ITEMS_OUT: self.items_out,
+                    self.Field.BATCHES: self.batches,
+                    self.Field.ERRORS: self.errors,
+                    self.Field.SECS_BUSY: self.secs_busy,
+                    self.Field.SECS_BLOCKED_GET: self.secs_blocked_get,
+                    self.Field.SECS_BLOCKED_PUT: self.secs_blocked_put,
+                    self.Field.SECS_ELAPSED: secs_elapsed,
+                    self.Field.THROUGHPUT: MetricTool.count_secs2rate(count, secs_elapsed),
+                    self.Field.QUEUE_DEPTH: self.queue_in.qsize() if self.queue_in is not None else None,
+                    self.Field.QUEUE_DEPTH_MAX: self.queue_depth_max,
+                    self.Field.QUEUE_MAXSIZE: self.queue_in.maxsize if self.queue_in is not None else None,
+                    }
+
+        @classmethod
+        def size2list(cls, size, config_list=None):
+            """
+            pass to batches_list2pipelined() to watch a running pipeline
+            """
+            def index2name(i):
+                config = config_list[i - 1] if config_list and i > 0 else None
+                return config.name if config and config.name else "stage{}".format(i)
+
+            return [cls(index2name(i)) for i in range(size)]
+
+    @classmethod
+    async def tasks2supervised(cls, tasks):
+        """
+        waits for all tasks. the first failure cancels the others and is raised.
+        cancelling this cancels them all.
+        """
+        try:
+            if not tasks:
+                return
+
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            tasks_failed = [t for t in done if not t.cancelled() and t.exception() is not None]
+            if tasks_failed:
+                raise tasks_failed[0].exception()
+        finally:
+            tasks_pending = [t for t in tasks if not t.done()]
+            for t in tasks_pending:
+                t.cancel()
+
+            if tasks_pending:
+                await asyncio.gather(*tasks_pending, return_exceptions=True)
+
     @classmethod
     async def coros_list2pipelined(cls, coros_list, queue_list):
+        """
+        coros loop forever on their queues. they are cancelled once the queue before them is joined.
+        a coro raising cancels the pipeline.
+        """
         logger = FoxylibLogger.func_level2logger(cls.coros_list2pipelined, logging.DEBUG)
         n = len(coros_list)
         assert_greater_equal(n, 1)
@@ -276,18 +732,38 @@ class AioPipeline:
             assert_true(AioQueueTool.queue2is_valid_loop(q))
 
         tasks_list = [lmap(asyncio.create_task, coros) for coros in coros_list]
+        tasks_all = [t for tasks in tasks_list for t in tasks]
+
+        async def stages2done():
+            await asyncio.gather(*tasks_list[0])
+            logger.debug('{}/{} coros done'.format(1, n))
 
-        await asyncio.gather(*tasks_list[0])
-        logger.debug('{}/{} coros done'.format(1, n))
+            for i in range(1, n):
+                await queue_list[i - 1].join()
+                logger.debug('{}/{} queue empty'.format(i, n - 1))
 
-        for i in range(1, n):
-            await queue_list[i - 1].join()
-            logger.debug('{}/{} queue empty'.format(i, n - 1))
+                for c in tasks_list[i]:
+                    c.cancel()
 
-            for c in tasks_list[i]:
-                c.cancel()
+                logger.debug('{}/{} coros done'.format(i + 1, n))
 
-            logger.debug('{}/{} coros done'.format(i + 1, n))
+        task_main = asyncio.ensure_future(stages2done())
+        try:
+            while not task_main.done():
+                tasks_running = [t for t in tasks_all if not t.done()]
+                done, _ = await asyncio.wait([task_main, *tasks_running], return_when=asyncio.FIRST_COMPLETED)
+
+                tasks_failed = [t for t in done
+                                if t is not task_main and not t.cancelled() and t.exception() is not None]
+                if tasks_failed:
+                    raise tasks_failed[0].exception()
+
+            return task_main.result()
+        finally:
+            for t in [task_main, *tasks_all]:
+                if not t.done():
+                    t.cancel()
+            await asyncio.gather(task_main, *tasks_all, return_exceptions=True)
 
     @classmethod
     async def funcs_list2pipelined(cls, funcs_list, queue_list=None):
@@ -297,69 +773,236 @@ class AioPipeline:
             assert_equal(len(queue_list), n-1)
 
         batches_producer = funcs_list[0]
-        batches_list_after = [[lambda l: f(iter2singleton(l)) for f in funcs]
+        batches_list_after = [[partial(lambda f, l: f(iter2singleton(l)), f) for f in funcs]
                               for funcs in funcs_list[1:]
                               ]
         batches_list = [batches_producer, *batches_list_after]
 
-        config_list = [AioPipeline.Config(f_queue=lambda: queue_list[i] if queue_list else None)
+        config_list = [AioPipeline.Config(f_queue=(lambda q: lambda: q)(queue_list[i]) if queue_list else None)
                        for i in range(n - 1)]
 
         return await cls.batches_list2pipelined(batches_list, config_list=config_list)
 
     @classmethod
-    async def batches_list2pipelined(cls, batches_list, config_list=None,):
-        logger = FoxylibLogger.func_level2logger(cls.batches_list2pipelined, logging.DEBUG)
-        n = len(batches_list)
+    async def _queue_item2put(cls, queue, item, stats):
+        if queue.full():
+            time_start = time.perf_counter()
+            await queue.put(item)
+            stats.secs_blocked_put += time.perf_counter() - time_start
+        else:
+            queue.put_nowait(item)
 
-        config_list = cls.Config.config_list2init(config_list, n-1)
-        assert_equal(len(config_list), n - 1)
+    @classmethod
+    async def _batch2produced(cls, batch, queue_out, stats):
+        items = batch()
+        is_async = hasattr(items, "__anext__")
+        iterator = items if is_async else iter(items)
 
-        queue_list = [config.queue() for config in config_list]
-        for q in queue_list:
-            assert_true(AioQueueTool.queue2is_valid_loop(q))
+        while True:
+            time_start = time.perf_counter()
+            try:
+                item = await iterator.__anext__() if is_async else next(iterator)
+            except (StopIteration, StopAsyncIteration):
+                break
+            finally:
+                stats.secs_busy += time.perf_counter() - time_start
+
+            stats.items_out += 1
+            if queue_out is not None:
+                await cls._queue_item2put(queue_out, item, stats)
+
+    class Sequencer:
+        """
+        keeps the outputs of a stage's workers in input order.
+        batches are dequeued one worker at a time and numbered. a worker puts its outputs once all earlier batches have.
+        """
 
-        async def batch2coro_producer(batch):
-            queue_out = queue_list[0]
-            for item_out in batch():
-                await queue_out.put(item_out)
+        def __init__(self):
+            self.lock_dequeue = asyncio.Lock()
+            self.cond = asyncio.Condition()
+            self.seq_dequeued = 0
+            self.seq_put = 0
 
-        async def batch_index2coro_piper(batch, i):
-            config_in = config_list[i-1]
-            queue_out = queue_list[i]
+        async def dequeue(self, f_dequeue):
+            async with self.lock_dequeue:
+                item_list = await f_dequeue()
+                seq = self.seq_dequeued
+                self.seq_dequeued += 1
+            return seq, item_list
 
-            queue_in = queue_list[i-1]
-            chunksize = config_in.dequeue_chunksize
-            timeout = config_in.dequeue_timeout
+        async def seq2turn(self, seq):
+            async with self.cond:
+                await self.cond.wait_for(lambda: self.seq_put == seq)
 
-            while True:
-                item_list_in = await AioQueueTool.dequeue_n_timeout(queue_in, chunksize, timeout=timeout)
-                items_out = batch(item_list_in)
-                for item_out in items_out:
-                    await queue_out.put(item_out)
+        async def turn2done(self):
+            async with self.cond:
+                self.seq_put += 1
+                self.cond.notify_all()
+
+    @classmethod
+    def _batch_items2list(cls, batch, item_list):
+        result = batch(item_list)
+        return list(result) if result is not None else []
 
-                AioTool.task_count2all_done(len(item_list_in), queue_in, )
+    @classmethod
+    def _batch_items2consumed(cls, batch, item_list):
+        IterTool.consume(batch(item_list))
+        return []
+
+    @classmethod
+    async def _batch_items2result(cls, batch, item_list, config, is_consumer):
+        """
+        list of output items. iterables are run through where the batch function runs
+        """
+        Mode = cls.Config.Mode
 
-        async def batch2coro_consumer(batch):
-            config = config_list[-1]
+        if config.mode == Mode.INLINE:
+            result = batch(item_list)
+            if inspect.isawaitable(result):
+                result = await result
 
-            queue_in = queue_list[-1]
-            chunksize = config.dequeue_chunksize
-            timeout = config.dequeue_timeout
+            if is_consumer:
+                IterTool.consume(result)
+                return []
+            return list(result) if result is not None else []
 
-            while True:
-                item_list_in = await AioQueueTool.dequeue_n_timeout(queue_in, chunksize, timeout=timeout)
-                IterTool.consume(batch(item_list_in))
-                AioTool.task_count2all_done(len(item_list_in), queue_in, )
-
-        coros_producer = lmap(batch2coro_producer, batches_list[0])
-        coros_list_piper = [[batch_index2coro_piper(batch, i)
-                              for batch in batches_list[i]]
-                             for i in range(1, n - 1)]
-        coros_consumer = lmap(batch2coro_consumer, batches_list[-1])
-        coros_list = [coros_producer, *coros_list_piper, coros_consumer]
-
-        return await cls.coros_list2pipelined(coros_list, queue_list)
+        f = partial(cls._batch_items2consumed if is_consumer else cls._batch_items2list, batch)
+
+        if config.mode == Mode.THREAD:
+            executor = ThreadTool.name2executor(config.pool)
+            return await ThreadTool.executor_func2aio_result(executor, f, item_list)  # never blocks the loop
+
+        if config.mode == Mode.PROCESS:
+            pool = ProcessTool.name2pool(config.pool)
+            size = config.ipc_chunksize or len(item_list)
+            chunks = [item_list[i:i + size] for i in range(0, len(item_list), size)]
+
+            result_lists = await asyncio.gather(*[ProcessTool.pool_func_x2aio_future(pool, f, chunk)
+                                                  for chunk in chunks])
+            return [item for result_list in result_lists for item in result_list]
+
+        raise ValueError({"mode": config.mode})
+
+    @classmethod
+    async def _batch2piped(cls, batch, config_in, queue_out, stats, sequencer=None):
+        """
+        queue_out None for consumers
+        """
+        queue_in = config_in.queue()
+
+        async def dequeue():
+            return await AioQueueTool.dequeue_batch(queue_in, config_in.dequeue_chunksize,
+                                                    size_min=config_in.dequeue_size_min,
+                                                    timeout=config_in.dequeue_timeout,
+                                                    linger=config_in.dequeue_linger,
+                                                    item_end=cls.END)
+
+        while True:
+            stats.queue_depth_max = max(stats.queue_depth_max, queue_in.qsize())
+            time_start = time.perf_counter()
+            if sequencer is not None:
+                seq, item_list = await sequencer.dequeue(dequeue)
+            else:
+                seq, item_list = None, await dequeue()
+            stats.secs_blocked_get += time.perf_counter() - time_start
+
+            is_end = item_list[-1] is cls.END
+            item_list_in = item_list[:-1] if is_end else item_list
+            if is_end:
+                queue_in.put_nowait(cls.END)  # for the other workers of the stage. the slot was just freed
+
+            item_list_out = []
+            if item_list_in:
+                time_start = time.perf_counter()
+                item_list_out = await cls._batch_items2result(batch, item_list_in, config_in, queue_out is None)
+                stats.secs_busy += time.perf_counter() - time_start
+
+                stats.batches += 1
+                stats.items_in += len(item_list_in)
+                stats.items_out += len(item_list_out)
+
+            if sequencer is not None:
+                await sequencer.seq2turn(seq)
+
+            for item_out in item_list_out:
+                await cls._queue_item2put(queue_out, item_out, stats)
+
+            if sequencer is not None:
+                await sequencer.turn2done()
+
+            AioTool.task_count2all_done(len(item_list), queue_in, )
+
+            if is_end:
+                return
+
+    @classmethod
+    async def batches_list2pipelined(cls, batches_list, config_list=None, stats_list=None, ):
+        """
+        config_list: one Config per queue, i.e. per stage after the producers
+        stats_list: StageStats per stage, to watch while running. made if None
+        returns stats_list
+        """
+        logger = FoxylibLogger.func_level2logger(cls.batches_list2pipelined, logging.DEBUG)
+        n = len(batches_list)
+        assert_greater_equal(n, 1)
+
+        config_list = cls.Config.config_list2init(config_list, n-1)
+        assert_equal(len(config_list), n - 1)
+
+        stats_list = stats_list if stats_list is not None else cls.StageStats.size2list(n, config_list)
+        assert_equal(len(stats_list), n)
+
+        queue_list = [config.queue() for config in config_list]
+        for q in queue_list:
+            assert_true(AioQueueTool.queue2is_valid_loop(q))
+
+        async def stage_index2coro_worker(i, coro):
+            stats = stats_list[i]
+            try:
+                await coro
+            except Exception:
+                stats.errors += 1
+                raise
+
+            stats.workers_alive -= 1
+            if stats.workers_alive > 0:
+                return
+
+            stats.time_end = time.perf_counter()
+            logger.debug('{}/{} stages done'.format(i + 1, n))
+            if i < n - 1:
+                await queue_list[i].put(cls.END)
+
+        def stage_index2coros(i):
+            queue_out = queue_list[i] if i < n - 1 else None
+            if i == 0:
+                return [cls._batch2produced(batch, queue_out, stats_list[i]) for batch in batches_list[i]]
+
+            config_in = config_list[i - 1]
+            if config_in.mode != cls.Config.Mode.INLINE:
+                assert_false(any(map(asyncio.iscoroutinefunction, batches_list[i])))
+
+            sequencer = cls.Sequencer() if config_in.ordered else None
+            return [cls._batch2piped(batch, config_in, queue_out, stats_list[i], sequencer=sequencer)
+                    for batch in batches_list[i]
+                    for _ in range(config_in.workers)]
+
+        time_start = time.perf_counter()
+        tasks = []
+        for i in range(n):
+            coros = stage_index2coros(i)
+
+            stats = stats_list[i]
+            stats.queue_in = queue_list[i - 1] if i > 0 else None
+            stats.workers = stats.workers_alive = len(coros)
+            stats.time_start = time_start
+            if not coros and i < n - 1:
+                queue_list[i].put_nowait(cls.END)
+
+            tasks.extend(asyncio.create_task(stage_index2coro_worker(i, coro)) for coro in coros)
+
+        await cls.tasks2supervised(tasks)
+        return stats_list
 
     # @classmethod
     # @VersionTool.inactive(reason="need to be tested")
@@ -1,12 +1,17 @@
 import asyncio
 import logging
+import os
 import random
 import sys
+import threading
 from collections import deque
 from functools import partial, lru_cache
+import time
 from time import sleep
+from datetime import datetime, timedelta
 from unittest import TestCase
 
+import pytz
 from aiostream import stream
 from future.utils import lmap
 
@@ -14,6 +19,13 @@ from foxylib.tools.asyncio.asyncio_tool import AioTool, AioPipeline, AioQueueToo
 from foxylib.tools.collections.collections_tool import smap
 from foxylib.tools.function.function_tool import FunctionTool
 from foxylib.tools.log.foxylib_logger import FoxylibLogger
+from foxylib.tools.process.process_tool import ProcessTool
+from foxylib.tools.thread.thread_tool import ThreadTool
+
+
+def items2squared_pid(items):
+    # module-level, so that the process pool can unpickle it
+    return [(x * x, os.getpid()) for x in items]
 
 
 class P2C:
@@ -505,3 +517,562 @@ class TestAsyncTool(TestCase):
 
 
 
+class TestAioPipeline(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        FoxylibLogger.attach_stderr2loggers(logging.DEBUG)
+
+    def test_01(self):
+        """
+        slow consumer: bounded queues, back-pressure on the producer
+        """
+        consumed = []
+
+        def producer():
+            yield from range(200)
+
+        def piper(items):
+            return [x * 2 for x in items]
+
+        async def consumer(items):
+            await asyncio.sleep(0.001)
+            consumed.extend(items)
+
+        config_list = [AioPipeline.Config(maxsize=8, name="double"),
+                       AioPipeline.Config(maxsize=4, dequeue_chunksize=3, name="sink"),
+                       ]
+        stats_list = AioTool.awaitable2result(
+            AioPipeline.batches_list2pipelined([[producer], [piper], [consumer]], config_list=config_list))
+
+        self.assertEqual(consumed, [x * 2 for x in range(200)])
+
+        h_list = [stats.to_dict() for stats in stats_list]
+        F = AioPipeline.StageStats.Field
+        self.assertEqual([h[F.NAME] for h in h_list], ["stage0", "double", "sink"])
+        self.assertEqual([h[F.ITEMS_OUT] for h in h_list], [200, 200, 0])
+        self.assertEqual([h[F.ITEMS_IN] for h in h_list], [0, 200, 200])
+        self.assertLessEqual(h_list[1][F.QUEUE_DEPTH_MAX], 8)
+        self.assertLessEqual(h_list[2][F.QUEUE_DEPTH_MAX], 4)
+        self.assertGreater(h_list[0][F.SECS_BLOCKED_PUT], 0)
+        self.assertGreater(h_list[2][F.THROUGHPUT], 0)
+
+    def test_02(self):
+        """
+        a failing stage cancels the pipeline, even with an endless producer
+        """
+        cancelled = []
+
+        def producer():
+            x = 0
+            while True:
+                yield x
+                x += 1
+
+        def piper(items):
+            if items[0] == 50:
+                raise ValueError(items)
+            return items
+
+        async def consumer(items):
+            try:
+                await asyncio.sleep(0.001)
+            except asyncio.CancelledError:
+                cancelled.append(items)
+                raise
+
+        with self.assertRaises(ValueError):
+            AioTool.awaitable2result(AioPipeline.batches_list2pipelined(
+                [[producer], [piper], [consumer]],
+                config_list=[AioPipeline.Config(maxsize=4), AioPipeline.Config(maxsize=4, workers=2)]))
+
+        self.assertTrue(cancelled)
+
+    def test_03(self):
+        """
+        workers per stage, partial chunks flushed on completion
+        """
+        inflight = [0, 0]  # current, max
+        consumed = []
+
+        async def piper(items):
+            inflight[0] += 1
+            inflight[1] = max(inflight)
+            await asyncio.sleep(0.01)
+            inflight[0] -= 1
+            return items
+
+        def consumer(items):
+            consumed.append(len(items))
+
+        config_list = [AioPipeline.Config(workers=4),
+                       AioPipeline.Config(dequeue_chunksize=10),  # no timeout: waits for 10, or the end
+                       ]
+        AioTool.awaitable2result(AioPipeline.batches_list2pipelined(
+            [[lambda: range(25)], [piper], [consumer]], config_list=config_list))
+
+        self.assertEqual(inflight[1], 4)
+        self.assertEqual(sum(consumed), 25)
+        self.assertEqual(consumed[-1], 5)
+
+    def test_04(self):
+        """
+        cancelling the pipeline cancels every stage
+        """
+        cancelled = []
+
+        async def producer():
+            try:
+                while True:
+                    await asyncio.sleep(0.001)
+                    yield 1
+            except asyncio.CancelledError:
+                cancelled.append("producer")
+                raise
+
+        async def arun():
+            task = asyncio.ensure_future(AioPipeline.batches_list2pipelined([[producer], [lambda items: None]]))
+            await asyncio.sleep(0.05)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        AioTool.awaitable2result(arun())
+        self.assertEqual(cancelled, ["producer"])
+
+    def test_05(self):
+        """
+        coros_list2pipelined() raises a failing coro instead of hanging on queue.join()
+        """
+        async def producer(queue):
+            for x in range(10):
+                await queue.put(x)
+
+        async def consumer(queue):
+            await queue.get()
+            raise ValueError()
+
+        async def arun():
+            queue = asyncio.Queue()
+            await AioPipeline.coros_list2pipelined([[producer(queue)], [consumer(queue)]], [queue])
+
+        with self.assertRaises(ValueError):
+            AioTool.awaitable2result(arun())
+
+    def test_06(self):
+        """
+        blocking stage in a thread pool does not stall the event loop
+        """
+        ticks = []
+        consumed = []
+
+        def piper_blocking(items):
+            sleep(0.2)
+            return items
+
+        async def producer():
+            for x in range(8):
+                yield x
+            for _ in range(5):
+                await asyncio.sleep(0.01)
+                ticks.append(time.perf_counter())
+
+        config_list = [AioPipeline.Config(mode=AioPipeline.Config.Mode.THREAD, pool="TestAioPipeline.test_06",
+                                          workers=4, dequeue_chunksize=2, ordered=True),
+                       AioPipeline.Config(),
+                       ]
+        time_start = time.perf_counter()
+        AioTool.awaitable2result(AioPipeline.batches_list2pipelined(
+            [[producer], [piper_blocking], [consumed.extend]], config_list=config_list))
+        secs = time.perf_counter() - time_start
+        ThreadTool.shutdown_executor("TestAioPipeline.test_06")
+
+        self.assertEqual(consumed, list(range(8)))
+        self.assertLess(secs, 0.5)  # 4 batches of 0.2s in parallel
+        self.assertLess(ticks[0] - time_start, 0.1)  # loop not blocked by a 0.2s batch
+
+    def test_07(self):
+        """
+        CPU stage in a process pool, chunked IPC, order kept across workers
+        """
+        consumed = []
+
+        config_list = [AioPipeline.Config(mode=AioPipeline.Config.Mode.PROCESS, pool="TestAioPipeline.test_07",
+                                          workers=3, dequeue_chunksize=20, ipc_chunksize=5, ordered=True),
+                       AioPipeline.Config(dequeue_chunksize=7),
+                       ]
+        try:
+            AioTool.awaitable2result(AioPipeline.batches_list2pipelined(
+                [[lambda: range(200)], [items2squared_pid], [consumed.extend]], config_list=config_list))
+        finally:
+            ProcessTool.shutdown_pool("TestAioPipeline.test_07")
+
+        self.assertEqual([x for x, _ in consumed], [x * x for x in range(200)])
+        self.assertNotIn(os.getpid(), {pid for _, pid in consumed})
+
+    def test_08(self):
+        """
+        failure in a process stage propagates
+        """
+        def fail(items):
+            raise ValueError(items)
+
+        config_list = [AioPipeline.Config(mode=AioPipeline.Config.Mode.PROCESS, pool="TestAioPipeline.test_08")]
+        try:
+            with self.assertRaises(ValueError):
+                AioTool.awaitable2result(AioPipeline.batches_list2pipelined(
+                    [[lambda: range(10)], [fail]], config_list=config_list))
+        finally:
+            ProcessTool.shutdown_pool("TestAioPipeline.test_08")
+
+    def test_09(self):
+        """
+        a thread stage waits for room in a shared pool that is full, without blocking the loop
+        """
+        pool = "TestAioPipeline.test_09"
+        executor = ThreadTool.name2executor(pool, max_workers=1, max_queue=1)
+        event = threading.Event()
+
+        # filled from another thread: one running, one queued
+        thread = threading.Thread(target=lambda: [executor.submit(event.wait, 1) for _ in range(2)])
+        thread.start()
+        thread.join()
+
+        ticks = []
+
+        async def ticker():
+            while True:
+                ticks.append(time.perf_counter())
+                await asyncio.sleep(0.01)
+
+        async def arun():
+            task = asyncio.ensure_future(ticker())
+            asyncio.get_event_loop().call_later(0.3, event.set)
+
+            consumed = []
+            config_list = [AioPipeline.Config(mode=AioPipeline.Config.Mode.THREAD, pool=pool),
+                           AioPipeline.Config(), ]
+            await AioPipeline.batches_list2pipelined([[lambda: range(3)], [lambda l: l], [consumed.extend]],
+                                                     config_list=config_list)
+            task.cancel()
+            return consumed
+
+        try:
+            consumed = AioTool.awaitable2result(arun())
+        finally:
+            ThreadTool.shutdown_executor(pool)
+
+        self.assertEqual(consumed, [0, 1, 2])
+        self.assertGreater(ticks[-1] - ticks[0], 0.25)  # the stage did wait for the pool
+        self.assertLess(max(t2 - t1 for t1, t2 in zip(ticks, ticks[1:])), 0.1)
+
+
+class TestAioQueueTool(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        FoxylibLogger.attach_stderr2loggers(logging.DEBUG)
+
+    @classmethod
+    async def enqueue_trickle(cls, queue, items, secs):
+        for x in items:
+            await queue.put(x)
+            await asyncio.sleep(secs)
+
+    def test_01(self):
+        """
+        one deadline for the whole batch, not one per item
+        """
+        async def arun():
+            queue = asyncio.Queue()
+            task = asyncio.ensure_future(self.enqueue_trickle(queue, range(100), 0.02))
+
+            time_start = time.perf_counter()
+            item_list = await AioQueueTool.dequeue_batch(queue, 100, timeout=0.1)
+            secs = time.perf_counter() - time_start
+
+            task.cancel()
+            return item_list, secs
+
+        item_list, secs = AioTool.awaitable2result(arun())
+        self.assertLess(secs, 0.2)
+        self.assertGreaterEqual(len(item_list), 3)
+        self.assertLess(len(item_list), 10)
+        self.assertEqual(item_list, list(range(len(item_list))))
+
+    def test_02(self):
+        async def arun():
+            queue = asyncio.Queue()
+            for x in range(10):
+                queue.put_nowait(x)
+
+            # already queued: no wait, max size kept
+            l1 = await AioQueueTool.dequeue_batch(queue, 4, timeout=0)
+            l2 = await AioQueueTool.dequeue_batch(queue, 4, timeout=10)
+            l3 = await AioQueueTool.dequeue_batch(queue, 4, timeout=0)
+
+            # min size held past the deadline
+            task = asyncio.ensure_future(self.enqueue_trickle(queue, range(10, 13), 0.02))
+            l4 = await AioQueueTool.dequeue_batch(queue, 10, size_min=3, timeout=0)
+            await task
+
+            # end sentinel flushes
+            end = object()
+            queue.put_nowait(13)
+            queue.put_nowait(end)
+            l5 = await AioQueueTool.dequeue_batch(queue, 10, size_min=5, item_end=end)
+
+            return [l1, l2, l3, l4, l5[:-1]], l5[-1] is end
+
+        item_lists, is_end = AioTool.awaitable2result(arun())
+        self.assertEqual(item_lists, [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9], [10, 11, 12], [13]])
+        self.assertTrue(is_end)
+
+    def test_03(self):
+        linger = AioQueueTool.AdaptiveLinger(secs_max=0.1, secs_min=0.001)
+        self.assertEqual(linger.size2secs(9), 0.1)  # nothing seen yet
+
+        for i in range(20):
+            linger.observe(i * 0.005)  # 200/s
+        self.assertAlmostEqual(linger.size2secs(9), 0.045)
+
+        for i in range(20):
+            linger.observe(1 + i * 0.5)  # 2/s: not worth waiting
+        self.assertEqual(linger.size2secs(9), 0.001)
+
+    def test_04(self):
+        """
+        pipeline stage with adaptive linger: full batches from a fast producer, bounded wait on a slow one
+        """
+        chunks = []
+
+        async def producer():
+            for x in range(50):
+                yield x
+                if x >= 40:
+                    await asyncio.sleep(0.03)
+
+        config = AioPipeline.Config(dequeue_chunksize=10,
+                                    dequeue_linger=AioQueueTool.AdaptiveLinger(secs_max=0.05))
+        AioTool.awaitable2result(AioPipeline.batches_list2pipelined([[producer], [chunks.append]],
+                                                                    config_list=[config]))
+
+        self.assertEqual(sum(chunks, []), list(range(50)))
+        self.assertEqual(chunks[:4], [list(range(i, i + 10)) for i in range(0, 40, 10)])
+        self.assertTrue(all(len(chunk) <= 2 for chunk in chunks[5:]))
+
+    def test_05(self):
+        """
+        the linger learns the arrival rate, which a slow consumer and the backlog it leaves do not shift
+        """
+        async def arun():
+            queue = AioQueueTool.ArrivalQueue()
+            linger = AioQueueTool.AdaptiveLinger(secs_max=0.1)
+            task = asyncio.ensure_future(self.enqueue_trickle(queue, range(30), 0.01))
+
+            n = 0
+            while n < 30:
+                item_list = await AioQueueTool.dequeue_batch(queue, 5, linger=linger)
+                n += len(item_list)
+                await asyncio.sleep(0.05)  # slower than arrivals
+
+            await task
+            return linger.secs_gap
+
+        secs_gap = AioTool.awaitable2result(arun())
+        self.assertGreater(secs_gap, 0.008)
+        self.assertLess(secs_gap, 0.02)
+
+
+class TestAioToolStream(TestCase):
+    N_BENCHMARK = 100000
+
+    @classmethod
+    def setUpClass(cls):
+        FoxylibLogger.attach_stderr2loggers(logging.DEBUG)
+
+    @classmethod
+    async def arange(cls, n, secs=None):
+        for x in range(n):
+            if secs is not None:
+                await asyncio.sleep(secs)
+            yield x
+
+    def test_01(self):
+        inflight = [0, 0]  # current, max
+
+        async def f(x):
+            inflight[0] += 1
+            inflight[1] = max(inflight)
+            await asyncio.sleep(random.random() * 0.01)
+            inflight[0] -= 1
+            return x * 2
+
+        async def arun():
+            l_ordered = await AioTool.aiter2list(AioTool.amap(f, range(100), 10))
+            l_unordered = await AioTool.aiter2list(AioTool.amap(f, self.arange(100), 10, ordered=False))
+            return l_ordered, l_unordered
+
+        l_ordered, l_unordered = AioTool.awaitable2result(arun())
+        self.assertEqual(l_ordered, [x * 2 for x in range(100)])
+        self.assertEqual(sorted(l_unordered), [x * 2 for x in range(100)])
+        self.assertEqual(inflight[1], 10)
+
+        # gather with a concurrency limit
+        self.assertEqual(AioTool.awaitables2result_list([f(x) for x in range(30)], concurrency=5),
+                         [x * 2 for x in range(30)])
+        self.assertEqual(inflight[1], 10)
+
+    def test_02(self):
+        """
+        failure raised, calls in flight cancelled
+        """
+        started, finished, cancelled = set(), set(), set()
+
+        async def f(x):
+            started.add(x)
+            if x == 5:
+                raise ValueError(x)
+            try:
+                await asyncio.sleep(0.01 if x < 5 else 1)
+            except asyncio.CancelledError:
+                cancelled.add(x)
+                raise
+            finished.add(x)
+
+        async def arun(ordered):
+            try:
+                await AioTool.aiter2list(AioTool.amap(f, range(100), 8, ordered=ordered))
+            finally:
+                await asyncio.sleep(0)  # let the cancelled calls unwind
+
+        for ordered in [True, False]:
+            for xs in [started, finished, cancelled]:
+                xs.clear()
+
+            time_start = time.perf_counter()
+            with self.assertRaises(ValueError):
+                AioTool.awaitable2result(arun(ordered))
+
+            self.assertLess(time.perf_counter() - time_start, 0.5)
+            self.assertTrue(cancelled)
+            self.assertEqual(started - {5}, finished | cancelled)
+            self.assertLessEqual(len(started), 13)
+
+    def test_03(self):
+        async def arun():
+            # 10 items fast, then 1 every 0.05s: chunks flushed on time, not only on count
+            async def source():
+                async for x in self.arange(10):
+                    yield x
+                async for x in self.arange(3, secs=0.05):
+                    yield 10 + x
+
+            chunks_time = await AioTool.aiter2list(AioTool.aiter2chunks(source(), 4, timeout=0.01))
+            chunks_count = await AioTool.aiter2list(AioTool.aiter2chunks(source(), 4))
+            return chunks_time, chunks_count
+
+        chunks_time, chunks_count = AioTool.awaitable2result(arun())
+        self.assertEqual(chunks_count, [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9, 10, 11], [12]])
+        self.assertEqual(chunks_time[:2], [[0, 1, 2, 3], [4, 5, 6, 7]])
+        self.assertEqual(chunks_time[-3:], [[10], [11], [12]])
+
+    def test_04(self):
+        async def fast():
+            async for x in self.arange(100):
+                yield ("fast", x)
+
+        async def slow():
+            async for x in self.arange(5, secs=0.001):
+                yield ("slow", x)
+
+        async def failing():
+            yield 1
+            raise ValueError()
+
+        async def arun():
+            return await AioTool.aiter2list(AioTool.aiters2merged([fast(), slow(), range(3)]))
+
+        merged = AioTool.awaitable2result(arun())
+        self.assertEqual(len(merged), 108)
+        self.assertEqual([item[1] for item in merged if isinstance(item, tuple) and item[0] == "fast"],
+                         list(range(100)))
+
+        # the plain source is not starved by the fast one
+        i_last = max(i for i, item in enumerate(merged) if not isinstance(item, tuple))
+        self.assertLess(i_last, 10)
+
+        with self.assertRaises(ValueError):
+            AioTool.awaitable2result(AioTool.aiter2list(AioTool.aiters2merged([fast(), failing()])))
+
+    def test_05(self):
+        pulled = []
+
+        async def source():
+            for x in range(20):
+                pulled.append(x)
+                yield x
+
+        async def arun():
+            aiter = AioTool.abuffer(source(), 5)
+            first = await aiter.__anext__()
+            await asyncio.sleep(0.01)  # prefetching meanwhile
+            n_pulled = len(pulled)
+            rest = await AioTool.aiter2list(aiter)
+            return [first] + rest, n_pulled
+
+        items, n_pulled = AioTool.awaitable2result(arun())
+        self.assertEqual(items, list(range(20)))
+        self.assertGreaterEqual(n_pulled, 6)
+        self.assertLessEqual(n_pulled, 8)  # bounded: queue of 5, one pending put, one consumed
+
+    def test_06(self):
+        async def arun():
+            dt_deadline = datetime.now(pytz.utc) + timedelta(seconds=0.1)
+            return await AioTool.aiter2list(AioTool.atake_until_deadline(self.arange(1000, secs=0.03), dt_deadline))
+
+        time_start = time.perf_counter()
+        items = AioTool.awaitable2result(arun())
+        secs = time.perf_counter() - time_start
+
+        self.assertEqual(items, list(range(len(items))))
+        self.assertIn(len(items), {2, 3, 4})
+        self.assertLess(secs, 0.15)  # did not wait for the next item past the deadline
+
+    def test_07(self):
+        """
+        benchmark: 100k items through each operator, with bounded memory
+        """
+        logger = FoxylibLogger.func_level2logger(self.test_07, logging.DEBUG)
+        n = self.N_BENCHMARK
+        inflight = [0, 0]
+
+        async def f(x):
+            inflight[0] += 1
+            inflight[1] = max(inflight)
+            await asyncio.sleep(0)
+            inflight[0] -= 1
+            return x
+
+        async def count(aiter):
+            c = 0
+            async for _ in aiter:
+                c += 1
+            return c
+
+        benchmarks = [
+            ("amap ordered", lambda: AioTool.amap(f, self.arange(n), 100)),
+            ("amap unordered", lambda: AioTool.amap(f, self.arange(n), 100, ordered=False)),
+            ("aiter2chunks timeout", lambda: AioTool.aiter2chunks(self.arange(n), 1000, timeout=0.01)),
+            ("aiters2merged x4", lambda: AioTool.aiters2merged([self.arange(n // 4) for _ in range(4)])),
+            ("abuffer", lambda: AioTool.abuffer(self.arange(n), 100)),
+        ]
+
+        for name, f_aiter in benchmarks:
+            time_start = time.perf_counter()
+            c = AioTool.awaitable2result(count(f_aiter()))
+            secs = time.perf_counter() - time_start
+            logger.debug({"benchmark": name, "items": n, "secs": secs, "items/sec": n / secs})
+
+            self.assertEqual(c, n // 1000 if name == "aiter2chunks timeout" else n)
+            self.assertLess(secs, 30)
+
+        self.assertLessEqual(inflight[1], 100)
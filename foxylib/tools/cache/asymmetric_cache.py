@@ -4,6 +4,7 @@ import logging
 from functools import wraps, partial
 
 from cachetools import cached, lru, ttl, cachedmethod
+from cachetools.keys import hashkey
 from itertools import chain
 
 from nose.tools import assert_is_not_none, assert_in
@@ -16,24 +17,44 @@ from foxylib.tools.string.string_tool import format_str
 
 class AsymmetricCache:
     @classmethod
-    def _read_or_write(cls, f_lazy, cache, reader, writer, *_, lock=None, **__):
+    def _read_or_write(cls, f_lazy, cache, reader, writer, *_, lock=None, single_flight=None, timeout=None,
+                       key_flight=None, **__):
+        """
+        with single_flight, concurrent misses of the same args call f_lazy() once and the others wait for it.
+        key_flight: the key function of reader/writer, so that flights agree with cache keys. hashkey if None
+        """
         try:
             return CacheTool.reader2get(cache, reader, *_, lock=lock, **__)
         except KeyError:
             pass  # key not found
 
-        v = f_lazy()
+        def compute_and_write():
+            v = f_lazy()
 
-        try:
-            CacheTool.writer2set(cache, writer, v, *_, lock=lock, **__, )
-        except ValueError:
-            pass  # value too large
+            try:
+                CacheTool.writer2set(cache, writer, v, *_, lock=lock, **__, )
+            except ValueError:
+                pass  # value too large
+
+            return v
+
+        if single_flight is None:
+            return compute_and_write()
+
+        def read_or_compute():
+            # the previous flight may have filled the cache since our miss
+            try:
+                return CacheTool.reader2get(cache, reader, *_, lock=lock, **__)
+            except KeyError:
+                return compute_and_write()
 
-        return v
+        k = (id(cache), (key_flight or hashkey)(*_, **__))
+        return single_flight.run(k, read_or_compute, timeout=timeout)
 
     class Decorator:
         @classmethod
-        def cached(cls, func=None, cache=None, reader=None, writer=None, lock=None, ):
+        def cached(cls, func=None, cache=None, reader=None, writer=None, lock=None, single_flight=None, timeout=None,
+                   key=None, ):
             logger = FoxylibLogger.func_level2logger(cls.cached, logging.DEBUG)
 
             assert_is_not_none(cache)
@@ -55,7 +76,8 @@ class AsymmetricCache:
                 def wrapped(*_, **__):
                     # raise Exception({"_":_, "__":__})
                     f_lazy = partial(f, *_, **__)
-                    v = AsymmetricCache._read_or_write(f_lazy, cache, reader, writer, *_, lock=lock, **__)
+                    v = AsymmetricCache._read_or_write(f_lazy, cache, reader, writer, *_, lock=lock,
+                                                       single_flight=single_flight, timeout=timeout, key_flight=key, **__)
                     return v
 
                 return wrapped
@@ -63,7 +85,8 @@ class AsymmetricCache:
             return wrapper(func) if func else wrapper
 
         @classmethod
-        def cachedmethod(cls, func=None, self2cache=None, reader=None, writer=None, lock=None, ):
+        def cachedmethod(cls, func=None, self2cache=None, reader=None, writer=None, lock=None,
+                         single_flight=None, timeout=None, key=None, ):
             logger = FoxylibLogger.func_level2logger(cls.cachedmethod, logging.DEBUG)
 
             assert_is_not_none(self2cache)
@@ -81,7 +104,8 @@ class AsymmetricCache:
                 def wrapped(self, *_, **__):
                     cache = self2cache(self)
                     f_lazy = partial(f, self, *_, **__)
-                    v = AsymmetricCache._read_or_write(f_lazy, cache, reader, writer, *_, lock=lock, *__)
+                    v = AsymmetricCache._read_or_write(f_lazy, cache, reader, writer, *_, lock=lock,
+                                                       single_flight=single_flight, timeout=timeout, key_flight=key, **__)
                     return v
 
                 return wrapped
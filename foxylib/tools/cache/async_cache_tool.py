@@ -0,0 +1,188 @@
+import asyncio
+import logging
+from functools import wraps
+
+import cachetools
+from nose.tools import assert_equal, assert_is_not_none
+
+from foxylib.tools.cache.cache_tool import CacheTool, CacheBatchTool
+from foxylib.tools.function.function_tool import FunctionTool
+from foxylib.tools.log.foxylib_logger import FoxylibLogger
+from foxylib.tools.string.string_tool import format_str
+
+
+class AsyncRun:
+    """
+    one running coroutine that computes the values of some keys, and how many callers still wait for it.
+    the coroutine is cancelled when the last waiting caller is cancelled.
+    """
+
+    def __init__(self):
+        self.task = None
+        self.waiters = 0
+
+    def cancel_if_abandoned(self):
+        if self.waiters == 0 and self.task is not None and not self.task.done():
+            self.task.cancel()
+
+
+class Inflight:
+    def __init__(self, future, run):
+        self.future = future
+        self.run = run
+
+
+class AsyncCacheTool:
+    """
+    Memoization for coroutine functions: awaited results are cached, not coroutine objects.
+
+    Concurrent misses of the same key share one in-flight computation.
+    Errors are passed to every waiting caller and are not cached. A cancelled caller doesn't cancel
+    the computation while other callers wait for it.
+    """
+
+    @classmethod
+    def h_inflight_k2inflight(cls, h_inflight, k):
+        inflight = h_inflight.get(k)
+        if inflight is None:
+            return None
+
+        # left over from another event loop, e.g. an earlier asyncio.run()
+        if inflight.future.get_loop() is not asyncio.get_running_loop():
+            return None
+
+        return inflight
+
+    @classmethod
+    async def _run2completed(cls, cache, h_inflight, k_list, inflight_list, f_coro, lock=None):
+        try:
+            v_list = await f_coro()
+            assert_equal(len(k_list), len(v_list),
+                         msg=format_str("f_batch result incorrect: {} vs {}", len(k_list), len(v_list)))
+        except asyncio.CancelledError:
+            for inflight in inflight_list:
+                inflight.future.cancel()
+            raise
+        except Exception as e:
+            for inflight in inflight_list:
+                inflight.future.set_exception(e)
+                inflight.future.exception()  # mark as retrieved, as keys may have no waiter left
+        else:
+            for k, inflight, v in zip(k_list, inflight_list, v_list):
+                try:
+                    CacheTool.k2set(cache, k, v, lock=lock)
+                except ValueError:
+                    pass  # value too large
+                inflight.future.set_result(v)
+        finally:
+            for k, inflight in zip(k_list, inflight_list):
+                if h_inflight.get(k) is inflight:
+                    del h_inflight[k]
+
+    @classmethod
+    def keys2inflights(cls, cache, h_inflight, k_list, f_coro, lock=None):
+        """
+        start f_coro() that returns one value per key of k_list
+        """
+        loop = asyncio.get_running_loop()
+
+        run = AsyncRun()
+        inflight_list = [Inflight(loop.create_future(), run) for _ in k_list]
+        for k, inflight in zip(k_list, inflight_list):
+            h_inflight[k] = inflight
+
+        run.task = loop.create_task(cls._run2completed(cache, h_inflight, k_list, inflight_list, f_coro, lock=lock))
+        return inflight_list
+
+    @classmethod
+    async def inflight2result(cls, inflight):
+        run = inflight.run
+
+        run.waiters += 1
+        try:
+            return await asyncio.shield(inflight.future)
+        finally:
+            run.waiters -= 1
+            run.cancel_if_abandoned()
+
+    @classmethod
+    async def k2result(cls, cache, h_inflight, k, f_coro, lock=None):
+        try:
+            return CacheTool.k2get(cache, k, lock=lock)
+        except KeyError:
+            pass  # key not found
+
+        inflight = cls.h_inflight_k2inflight(h_inflight, k)
+        if inflight is None:
+            async def f_coro_list():
+                return [await f_coro()]
+
+            inflight = cls.keys2inflights(cache, h_inflight, [k], f_coro_list, lock=lock)[0]
+
+        return await cls.inflight2result(inflight)
+
+    @classmethod
+    def cached(cls, cache, key=cachetools.keys.hashkey, lock=None):
+        """
+        async counterpart of cachetools.cached()
+        """
+        assert_is_not_none(cache)
+
+        def wrapper(f):
+            h_inflight = {}
+
+            @wraps(f)
+            async def wrapped(*args, **kwargs):
+                k = key(*args, **kwargs)
+                return await cls.k2result(cache, h_inflight, k, lambda: f(*args, **kwargs), lock=lock)
+
+            return wrapped
+
+        return wrapper
+
+    @classmethod
+    async def batchrun(cls, f_batch, args, kwargs, cache, h_inflight, indexes_each, key, lock=None):
+        """
+        async counterpart of CacheBatchTool.batchrun().
+        keys missing from the cache and not in flight are computed in one f_batch() call.
+        """
+        logger = FoxylibLogger.func_level2logger(cls.batchrun, logging.DEBUG)
+
+        args_list = FunctionTool.args2split(args, indexes_each)
+        k_list = [key(*args_each, **kwargs) for args_each in args_list]
+
+        h_k2aw = {}  # awaitable, or value for cache hits
+        h_k2i_missing = {}
+        for i, k in enumerate(k_list):
+            if k in h_k2aw or k in h_k2i_missing:
+                continue
+
+            try:
+                h_k2aw[k] = CacheTool.k2get(cache, k, lock=lock)
+                continue
+            except KeyError:
+                pass
+
+            inflight = cls.h_inflight_k2inflight(h_inflight, k)
+            if inflight is not None:
+                h_k2aw[k] = cls.inflight2result(inflight)
+            else:
+                h_k2i_missing[k] = i
+
+        if h_k2i_missing:
+            k_list_missing = list(h_k2i_missing.keys())
+            args_missing = CacheBatchTool.args_indexes2filtered(args, indexes_each, list(h_k2i_missing.values()))
+
+            async def f_coro():
+                return await f_batch(*args_missing, **kwargs)
+
+            inflight_list = cls.keys2inflights(cache, h_inflight, k_list_missing, f_coro, lock=lock)
+            for k, inflight in zip(k_list_missing, inflight_list):
+                h_k2aw[k] = cls.inflight2result(inflight)
+
+        k_list_pending = [k for k, aw in h_k2aw.items() if asyncio.iscoroutine(aw)]
+        v_list_pending = await asyncio.gather(*[h_k2aw[k] for k in k_list_pending])
+
+        h_k2v = dict(h_k2aw)
+        h_k2v.update(zip(k_list_pending, v_list_pending))
+        return [h_k2v[k] for k in k_list]
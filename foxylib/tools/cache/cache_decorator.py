@@ -5,13 +5,16 @@ import cachetools
 from future.utils import lmap
 from nose.tools import assert_is_not_none
 
+from foxylib.tools.cache.async_cache_tool import AsyncCacheTool
+from foxylib.tools.cache.cache_registry import CacheRegistry
 from foxylib.tools.cache.cache_tool import CacheBatchTool
 from foxylib.tools.log.foxylib_logger import FoxylibLogger
 
 
 class CacheDecorator:
     @classmethod
-    def cachedmethod_each(cls, self2cache, indexes_each, key=cachetools.keys.hashkey, lock=None):
+    def cachedmethod_each(cls, self2cache, indexes_each, key=cachetools.keys.hashkey, lock=None,
+                          chunk_size=None, executor=None):
         logger = FoxylibLogger.func_level2logger(cls.cachedmethod_each, logging.DEBUG)
 
         """Decorator to wrap a function with a memoizing callable that saves
@@ -25,20 +28,25 @@ class CacheDecorator:
         indexes_each_no_self = lmap(lambda x:x-1, indexes_each)
 
         def wrapper(f_batch):
+            stats = CacheRegistry.func2stats(f_batch)
+            f_compute = stats.func_batch2timed(f_batch) if stats is not None else f_batch
+            _self2cache = stats.self2cache2registered(self2cache) if stats is not None else self2cache
+
             @wraps(f_batch)
             def wrapped(self, *args, **kwargs):
-                cache = self2cache(self)
+                cache = _self2cache(self)
                 # logger.debug({"hex(id(cache))": hex(id(cache))})
-                result = CacheBatchTool.batchrun(partial(f_batch, self), args, kwargs, cache,
-                                               indexes_each_no_self, key, lock)
+                result = CacheBatchTool.batchrun(partial(f_compute, self), args, kwargs, cache,
+                                               indexes_each_no_self, key, lock,
+                                               chunk_size=chunk_size, executor=executor)
                 return result
 
-            return wrapped
+            return stats.func_batch2counted(wrapped) if stats is not None else wrapped
 
         return wrapper
 
     @classmethod
-    def cached_each(cls, cache, indexes_each, key=cachetools.keys.hashkey, lock=None):
+    def cached_each(cls, cache, indexes_each, key=cachetools.keys.hashkey, lock=None, chunk_size=None, executor=None):
         logger = FoxylibLogger.func_level2logger(cls.cached_each, logging.DEBUG)
 
         """Decorator to wrap a function with a memoizing callable that saves
@@ -50,9 +58,40 @@ class CacheDecorator:
         assert_is_not_none(indexes_each)
 
         def wrapper(f_batch):
+            stats = CacheRegistry.func2stats(f_batch)
+            f_compute = stats.func_batch2timed(f_batch) if stats is not None else f_batch
+            if stats is not None:
+                stats.cache2registered(cache)
+
             @wraps(f_batch)
             def wrapped(*args, **kwargs):
-                return CacheBatchTool.batchrun(f_batch, args, kwargs, cache, indexes_each, key, lock)
-            return wrapped
+                return CacheBatchTool.batchrun(f_compute, args, kwargs, cache, indexes_each, key, lock,
+                                               chunk_size=chunk_size, executor=executor)
+            return stats.func_batch2counted(wrapped) if stats is not None else wrapped
+
+        return wrapper
+
+    @classmethod
+    def cached_each_async(cls, cache, indexes_each, key=cachetools.keys.hashkey, lock=None):
+        """
+        async counterpart of cached_each().
+        concurrent calls share the f_batch() call of the keys they have in common.
+        """
+        assert_is_not_none(cache)
+        assert_is_not_none(indexes_each)
+
+        def wrapper(f_batch):
+            h_inflight = {}
+
+            stats = CacheRegistry.func2stats(f_batch)
+            f_compute = stats.func_batch2timed(f_batch) if stats is not None else f_batch
+            if stats is not None:
+                stats.cache2registered(cache)
+
+            @wraps(f_batch)
+            async def wrapped(*args, **kwargs):
+                return await AsyncCacheTool.batchrun(f_compute, args, kwargs, cache, h_inflight, indexes_each, key,
+                                                     lock=lock)
+            return stats.func_batch2counted(wrapped) if stats is not None else wrapped
 
         return wrapper
@@ -7,6 +7,8 @@ import cachetools
 from cachetools.keys import hashkey
 from nose.tools import assert_is_not_none, assert_false, assert_true, assert_in
 
+from foxylib.tools.cache.async_cache_tool import AsyncCacheTool
+from foxylib.tools.cache.cache_registry import CacheRegistry
 from foxylib.tools.cache.cache_tool import CacheTool
 from foxylib.tools.collections.collections_tool import DictTool
 from foxylib.tools.function.callable_tool import CallableTool
@@ -80,7 +82,7 @@ class CacheManager:
     @classmethod
     def add2cache(cls, callable_, v, args=None, kwargs=None,):
         config = cls.callable2config(callable_)
-        key, lock = cls.Config.config2key(config), cls.Config.config2lock(config)
+        key, lock = cls.Config.config2key(config), cls.callable2lock(callable_)
 
         cache = cls.callable2cache(callable_)
 
@@ -90,7 +92,7 @@ class CacheManager:
     @classmethod
     def delete_key(cls, callable_, args=None, kwargs=None, ):
         config = cls.callable2config(callable_)
-        key, lock = cls.Config.config2key(config), cls.Config.config2lock(config)
+        key, lock = cls.Config.config2key(config), cls.callable2lock(callable_)
 
         cache = cls.callable2cache(callable_)
 
@@ -130,6 +132,22 @@ class CacheManager:
 
         raise RuntimeError("Invalid callable type: {}".format(type(callable_)))
 
+    @classmethod
+    def callable2lock(cls, callable_):
+        """
+        attach_cachedmethod() takes lock the way cachetools.cachedmethod() does, i.e. lock(self)
+        """
+        config = cls.callable2config(callable_)
+        lock = cls.Config.config2lock(config)
+        if lock is None or hasattr(lock, "__enter__"):
+            return lock
+
+        callable_type = CallableTool.callable2type(callable_)
+        if callable_type in {CallableTool.Type.INSTANCEMETHOD, CallableTool.Type.CLASSMETHOD}:
+            return lock(MethodTool.method2owner(callable_))
+
+        return lock
+
     # @classmethod
     # def func2manager(cls, func):
     #     return getattr(func, cls.Constant.ATTRIBUTE_NAME)
@@ -194,10 +212,15 @@ class CacheManager:
     #     return h_manager.get(method)
 
     @classmethod
-    def attach_cached(cls, func=None, cached=None, cache=None, key=None, lock=None,):
+    def attach_cached(cls, func=None, cached=None, cache=None, key=None, lock=None, single_flight=None, timeout=None,):
+        """
+        with single_flight (a SingleFlight), concurrent misses of the same key call func once
+        and the others wait for its result, up to timeout seconds.
+        """
         logger = FoxylibLogger.func_level2logger(cls.attach_cached, logging.DEBUG)
 
         assert_is_not_none(cache)
+        assert_false(cached is not None and single_flight is not None)
         cached = cached or cachetools.cached
 
         config = DictTool.filter(lambda k, v: v is not None,
@@ -219,19 +242,40 @@ class CacheManager:
             assert_false(hasattr(f, cls.Constant.ATTRIBUTE_NAME))
             setattr(f, cls.Constant.ATTRIBUTE_NAME, config)
 
+            stats = CacheRegistry.func2stats(f)
+            f_compute = stats.func2timed(f) if stats is not None else f
+            if stats is not None:
+                stats.cache2registered(cache)
+
+            if single_flight is not None:
+                _key = cls.Config.config2key(config)
 
-            f_cached = cached(cache, **kwargs)(f)
-            return f_cached
+                @wraps(f)
+                def f_cached(*_, **__):
+                    return CacheTool.k2get_or_set(cache, _key(*_, **__), lambda: f_compute(*_, **__), lock=lock,
+                                                  single_flight=single_flight, timeout=timeout)
+            else:
+                f_cached = cached(cache, **kwargs)(f_compute)
+
+            return stats.func2counted(f_cached) if stats is not None else f_cached
 
         return wrapper(func) if func else wrapper
 
     @classmethod
-    def attach_cachedmethod(cls, func=None, cachedmethod=None, self2cache=None, key=None, lock=None, ):
+    def attach_cachedmethod(cls, func=None, cachedmethod=None, self2cache=None, key=None, lock=None,
+                            single_flight=None, timeout=None, ):
+        """
+        cache, key and lock are bound once per instance and kept in the instance __dict__,
+        so that a cache hit costs one key hash and one cache lookup.
+        the cache itself still lives in the hideout, so that add2cache()/delete_key()/update_cache() see it.
+
+        lock works as in cachetools.cachedmethod(): lock(self) returns the lock to use.
+        single_flight works as in attach_cached(). one SingleFlight can serve many instances.
+        """
         logger = FoxylibLogger.func_level2logger(cls.attach_cachedmethod, logging.DEBUG)
 
         assert_is_not_none(self2cache)
-
-        cachedmethod = cachedmethod or cachetools.cachedmethod
+        assert_false(cachedmethod is not None and single_flight is not None)
 
         config = DictTool.filter(lambda k, v: v is not None,
                                  {cls.Config.Field.SELF2CACHE: self2cache,
@@ -249,23 +293,179 @@ class CacheManager:
             setattr(f, cls.Constant.ATTRIBUTE_NAME, config)
 
             _self2cache = cls.Config.config2self2cache(config)
+            _key = cls.Config.config2key(config)
+            _lock = cls.Config.config2lock(config)
 
-            @wraps(f)
-            def wrapped(self, *_, **__):
-                # config = cls.callable2config(f)
-                # _self2cache = cls.Config.config2cache(config)
+            stats = CacheRegistry.func2stats(f)
+            f_compute = stats.func2timed(f) if stats is not None else f
+            if stats is not None:
+                _self2cache = stats.self2cache2registered(_self2cache)
+
+            # hashkey(*args) equals and hashes like args itself, so the tuple python already built will do
+            is_hashkey = _key is hashkey
 
+            # per-instance slot. a classmethod stores it on the class, so subclasses get their own slot
+            # bound to the same hideout cache as before.
+            attr_bound = "{}.{}".format(cls.Constant.ATTRIBUTE_NAME, FunctionTool.func2name(f))
+
+            def self2cache_hideout(self):
                 # f.__self__ doesn't work here because classmethod() is not called yet
+                hideout = cls.Hideout.method2hideout(self, f)
+                return cls.Hideout.get_or_lazyinit_cache(hideout, lambda: _self2cache(self))
+
+            def self2bound(self, v_bound):
+                setattr(self, attr_bound, v_bound)
+                return v_bound
+
+            if cachedmethod is not None:
+                @wraps(f)
+                def wrapped(self, *_, **__):
+                    try:
+                        f_with_cache = self.__dict__[attr_bound]
+                    except KeyError:
+                        cache = self2cache_hideout(self)
+                        f_with_cache = self2bound(self, cachedmethod(lambda x: cache, **kwargs)(f_compute))
+
+                    return f_with_cache(self, *_, **__)
+
+            elif single_flight is not None:
+                @wraps(f)
+                def wrapped(self, *_, **__):
+                    try:
+                        cache, lock_self = self.__dict__[attr_bound]
+                    except KeyError:
+                        lock_self = _lock(self) if _lock is not None else None
+                        cache, lock_self = self2bound(self, (self2cache_hideout(self), lock_self))
+
+                    k = _ if is_hashkey and not __ else _key(*_, **__)
+                    return CacheTool.k2get_or_set(cache, k, lambda: f_compute(self, *_, **__), lock=lock_self,
+                                                  single_flight=single_flight, timeout=timeout)
+
+            elif _lock is None:
+                @wraps(f)
+                def wrapped(self, *_, **__):
+                    try:
+                        cache = self.__dict__[attr_bound]
+                    except KeyError:
+                        cache = self2bound(self, self2cache_hideout(self))
+
+                    k = _ if is_hashkey and not __ else _key(*_, **__)
+                    try:
+                        return cache[k]
+                    except KeyError:
+                        pass  # key not found
+
+                    v = f_compute(self, *_, **__)
+                    try:
+                        cache[k] = v
+                    except ValueError:
+                        pass  # value too large
+                    return v
+
+            else:
+                @wraps(f)
+                def wrapped(self, *_, **__):
+                    try:
+                        cache, lock_self = self.__dict__[attr_bound]
+                    except KeyError:
+                        cache, lock_self = self2bound(self, (self2cache_hideout(self), _lock(self)))
+
+                    k = _ if is_hashkey and not __ else _key(*_, **__)
+                    try:
+                        with lock_self:
+                            return cache[k]
+                    except KeyError:
+                        pass  # key not found
+
+                    v = f_compute(self, *_, **__)
+                    try:
+                        with lock_self:
+                            cache[k] = v
+                    except ValueError:
+                        pass  # value too large
+                    return v
+
+            return stats.func2counted(wrapped) if stats is not None else wrapped
+
+        return wrapper(func) if func else wrapper
+
+    @classmethod
+    def attach_cached_async(cls, func=None, cache=None, key=None, lock=None, ):
+        """
+        attach_cached() for coroutine functions. awaited results are cached,
+        and concurrent misses of the same key await one in-flight call.
+        """
+        assert_is_not_none(cache)
+
+        config = DictTool.filter(lambda k, v: v is not None,
+                                 {cls.Config.Field.CACHE: cache,
+                                  cls.Config.Field.KEY: key or hashkey,
+                                  cls.Config.Field.LOCK: lock,
+                                  })
+        kwargs = cls.Config.config2kwargs(config)
+
+        def wrapper(f):
+            assert_false(hasattr(f, cls.Constant.ATTRIBUTE_NAME))
+            setattr(f, cls.Constant.ATTRIBUTE_NAME, config)
+
+            stats = CacheRegistry.func2stats(f)
+            if stats is None:
+                return AsyncCacheTool.cached(cache, **kwargs)(f)
+
+            stats.cache2registered(cache)
+            return stats.func2counted(AsyncCacheTool.cached(cache, **kwargs)(stats.func2timed(f)))
+
+        return wrapper(func) if func else wrapper
+
+    @classmethod
+    def attach_cachedmethod_async(cls, func=None, self2cache=None, key=None, lock=None, ):
+        """
+        attach_cachedmethod() for coroutine methods. in-flight calls are tracked per instance.
+        """
+        assert_is_not_none(self2cache)
+
+        config = DictTool.filter(lambda k, v: v is not None,
+                                 {cls.Config.Field.SELF2CACHE: self2cache,
+                                  cls.Config.Field.KEY: key or hashkey,
+                                  cls.Config.Field.LOCK: lock,
+                                  })
+
+        def wrapper(f):
+            assert_false(hasattr(f, cls.Constant.ATTRIBUTE_NAME))
+            setattr(f, cls.Constant.ATTRIBUTE_NAME, config)
+
+            _self2cache = cls.Config.config2self2cache(config)
+            _key = cls.Config.config2key(config)
+            _lock = cls.Config.config2lock(config)
+
+            stats = CacheRegistry.func2stats(f)
+            f_compute = stats.func2timed(f) if stats is not None else f
+            if stats is not None:
+                _self2cache = stats.self2cache2registered(_self2cache)
+
+            attr_bound = "{}.{}".format(cls.Constant.ATTRIBUTE_NAME, FunctionTool.func2name(f))
+
+            def self2bound(self):
                 hideout = cls.Hideout.method2hideout(self, f)
                 cache = cls.Hideout.get_or_lazyinit_cache(hideout, lambda: _self2cache(self))
-                # logger.debug({"f":f,"cache":cache})
+                lock_self = _lock(self) if _lock is not None else None
+
+                v_bound = (cache, {}, lock_self)
+                setattr(self, attr_bound, v_bound)
+                return v_bound
+
+            @wraps(f)
+            async def wrapped(self, *_, **__):
+                try:
+                    cache, h_inflight, lock_self = self.__dict__[attr_bound]
+                except KeyError:
+                    cache, h_inflight, lock_self = self2bound(self)
 
-                f_with_cache = cachedmethod(lambda x: cache, **kwargs)(f)
-                result = f_with_cache(self, *_, **__)
-                # raise Exception({"self":self,"result":result,"cache":cache})
-                return result
+                k = _key(*_, **__)
+                return await AsyncCacheTool.k2result(cache, h_inflight, k, lambda: f_compute(self, *_, **__),
+                                                     lock=lock_self)
 
-            return wrapped
+            return stats.func2counted(wrapped) if stats is not None else wrapped
 
         return wrapper(func) if func else wrapper
 
@@ -322,10 +522,10 @@ class CacheManager:
 
         logger = FoxylibLogger.func_level2logger(cls.update_cache, logging.DEBUG)
         try:
-            CacheManager.delete_key(func, *_a, **_k)
+            CacheManager.delete_key(func, args=_a, kwargs=_k)
             yield
         finally:
-            CacheManager.add2cache(func, value, *_a, **_k)
+            CacheManager.add2cache(func, value, args=_a, kwargs=_k)
 
     @classmethod
     @contextmanager
@@ -336,12 +536,12 @@ class CacheManager:
         # logger.debug({"CacheManager.callable2cache(func)": CacheManager.callable2cache(func)})
         try:
             for v, a, k in value_args_kwargs_list:
-                CacheManager.delete_key(func, *a, **k)
+                CacheManager.delete_key(func, args=a, kwargs=k)
 
             # logger.debug({"CacheManager.callable2cache(func)":CacheManager.callable2cache(func)})
             yield
         finally:
             for v, a, k in value_args_kwargs_list:
-                CacheManager.add2cache(func, v, *a, **k)
+                CacheManager.add2cache(func, v, args=a, kwargs=k)
 
         # logger.debug({"CacheManager.callable2cache(func)": CacheManager.callable2cache(func)})
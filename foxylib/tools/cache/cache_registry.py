@@ -0,0 +1,310 @@
+import asyncio
+import time
+import weakref
+from functools import wraps
+from threading import Lock
+
+import cachetools
+
+from foxylib.tools.metric.metric_tool import HistogramMetric
+
+
+class CacheStats:
+    """
+    Metrics of one decorated function, over every cache it uses (one per instance for cachedmethods).
+
+    Counters are plain attribute increments, without a lock, to stay well under 1us per call.
+    They may lose an increment under thread contention, which is fine for tuning.
+
+    calls: lookups. misses: computations, background refreshes included. hits: calls - misses.
+    evictions: popitem() calls of cachetools caches, which is how they evict.
+    """
+
+    class Field:
+        NAME = "name"
+        CALLS = "calls"
+        HITS = "hits"
+        MISSES = "misses"
+        HIT_RATIO = "hit_ratio"
+        EVICTIONS = "evictions"
+        SIZE = "size"
+        MAXSIZE = "maxsize"
+        CACHES = "caches"
+        LATENCY = "latency"
+
+    def __init__(self, name):
+        self.name = name
+
+        self.calls = 0
+        self.misses = 0
+        self.evictions = 0
+        self.latency = HistogramMetric()
+
+        self.lock = Lock()
+        self.h_id2ref = {}
+
+    def _add_eviction(self):
+        self.evictions += 1
+
+    def cache2registered(self, cache, is_shared=True):
+        """
+        is_shared: the cache lives as long as the decorated function. such a cache that can't be weak-referenced
+        (e.g. dict) is held strongly. per-instance ones are left out of caches() instead, not to outlive the instance.
+        """
+        id_ = id(cache)
+        if id_ in self.h_id2ref:
+            return cache
+
+        with self.lock:
+            try:
+                ref = weakref.ref(cache, lambda _: self.h_id2ref.pop(id_, None))
+            except TypeError:
+                if not is_shared:
+                    return cache
+                ref = lambda: cache  # e.g. dict. not weak-referenceable
+
+            self.h_id2ref[id_] = ref
+
+        if isinstance(cache, cachetools.Cache) and "popitem" not in vars(cache):
+            popitem = type(cache).popitem
+            ref_cache = weakref.ref(cache)  # no reference cycle, so the cache is freed with its owner
+            add_eviction = self._add_eviction
+
+            # instance attribute shadows Cache.popitem(), which Cache.__setitem__() calls to evict
+            def popitem_counted():
+                add_eviction()
+                return popitem(ref_cache())
+
+            cache.popitem = popitem_counted
+
+        return cache
+
+    def self2cache2registered(self, self2cache):
+        def self2cache_registered(owner):
+            return self.cache2registered(self2cache(owner), is_shared=False)
+        return self2cache_registered
+
+    def caches(self):
+        with self.lock:
+            refs = list(self.h_id2ref.values())
+        return [cache for cache in (ref() for ref in refs) if cache is not None]
+
+    def func2timed(self, f):
+        """
+        wraps the computation, i.e. what runs on a miss
+        """
+        latency = self.latency
+
+        if asyncio.iscoroutinefunction(f):
+            @wraps(f)
+            async def wrapped(*_, **__):
+                self.misses += 1
+                time_start = time.perf_counter()
+                try:
+                    return await f(*_, **__)
+                finally:
+                    latency.add(time.perf_counter() - time_start)
+            return wrapped
+
+        @wraps(f)
+        def wrapped(*_, **__):
+            self.misses += 1
+            time_start = time.perf_counter()
+            try:
+                return f(*_, **__)
+            finally:
+                latency.add(time.perf_counter() - time_start)
+        return wrapped
+
+    def func_batch2timed(self, f_batch):
+        latency = self.latency
+
+        if asyncio.iscoroutinefunction(f_batch):
+            @wraps(f_batch)
+            async def wrapped(*_, **__):
+                time_start = time.perf_counter()
+                try:
+                    v_list = await f_batch(*_, **__)
+                finally:
+                    latency.add(time.perf_counter() - time_start)
+                self.misses += len(v_list)
+                return v_list
+            return wrapped
+
+        @wraps(f_batch)
+        def wrapped(*_, **__):
+            time_start = time.perf_counter()
+            try:
+                v_list = f_batch(*_, **__)
+            finally:
+                latency.add(time.perf_counter() - time_start)
+            self.misses += len(v_list)
+            return v_list
+        return wrapped
+
+    def func2counted(self, f):
+        """
+        wraps the cached function, i.e. what runs on every call
+        """
+        if asyncio.iscoroutinefunction(f):
+            @wraps(f)
+            async def wrapped(*_, **__):
+                self.calls += 1
+                return await f(*_, **__)
+            return wrapped
+
+        @wraps(f)
+        def wrapped(*_, **__):
+            self.calls += 1
+            return f(*_, **__)
+        return wrapped
+
+    def func_batch2counted(self, f):
+        if asyncio.iscoroutinefunction(f):
+            @wraps(f)
+            async def wrapped(*_, **__):
+                v_list = await f(*_, **__)
+                self.calls += len(v_list)
+                return v_list
+            return wrapped
+
+        @wraps(f)
+        def wrapped(*_, **__):
+            v_list = f(*_, **__)
+            self.calls += len(v_list)
+            return v_list
+        return wrapped
+
+    def reset(self):
+        self.calls = 0
+        self.misses = 0
+        self.evictions = 0
+        self.latency.reset()
+
+    def to_dict(self):
+        caches = self.caches()
+        maxsizes = [getattr(cache, "maxsize", None) for cache in caches]
+
+        calls, misses = self.calls, self.misses
+        hits = max(calls - misses, 0)
+        return {self.Field.NAME: self.name,
+                self.Field.CALLS: calls,
+                self.Field.HITS: hits,
+                self.Field.MISSES: misses,
+                self.Field.HIT_RATIO: hits / calls if calls else None,
+                self.Field.EVICTIONS: self.evictions,
+                self.Field.SIZE: sum(len(cache) for cache in caches),
+                self.Field.MAXSIZE: sum(maxsizes) if maxsizes and None not in maxsizes else None,
+                self.Field.CACHES: len(caches),
+                self.Field.LATENCY: self.latency.to_dict(),
+                }
+
+
+class CacheRegistry:
+    """
+    process-wide registry of CacheStats by decorated function.
+    decorators of CacheManager, CacheDecorator and DatetimedCache register while enabled.
+    """
+
+    class Constant:
+        PROMETHEUS_PREFIX = "foxylib_cache"
+
+    enabled = True
+
+    _h_name2stats = {}
+    _lock = Lock()
+
+    @classmethod
+    def func2name(cls, f):
+        return "{}.{}".format(f.__module__, getattr(f, "__qualname__", f.__name__))
+
+    @classmethod
+    def name2stats(cls, name):
+        stats = cls._h_name2stats.get(name)
+        if stats is not None:
+            return stats
+
+        with cls._lock:
+            if name not in cls._h_name2stats:
+                cls._h_name2stats[name] = CacheStats(name)
+            return cls._h_name2stats[name]
+
+    @classmethod
+    def func2stats(cls, f):
+        """
+        None while disabled, so that decorators skip instrumenting
+        """
+        if not cls.enabled:
+            return None
+        return cls.name2stats(cls.func2name(f))
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            stats_list = list(cls._h_name2stats.values())
+
+        for stats in stats_list:
+            stats.reset()
+
+    @classmethod
+    def snapshot(cls):
+        with cls._lock:
+            stats_list = list(cls._h_name2stats.values())
+
+        return {stats.name: stats.to_dict() for stats in stats_list}
+
+    @classmethod
+    def snapshot2prometheus(cls, snapshot=None, prefix=None):
+        """
+        Prometheus text exposition format
+        """
+        snapshot = snapshot if snapshot is not None else cls.snapshot()
+        prefix = prefix or cls.Constant.PROMETHEUS_PREFIX
+
+        def label(name, **kwargs):
+            h = dict({"name": name}, **kwargs)
+            return ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                            for k, v in h.items())
+
+        lines = []
+        for field, type_ in [(CacheStats.Field.HITS, "counter"),
+                             (CacheStats.Field.MISSES, "counter"),
+                             (CacheStats.Field.EVICTIONS, "counter"),
+                             (CacheStats.Field.SIZE, "gauge"),
+                             ]:
+            metric = "{}_{}{}".format(prefix, field, "_total" if type_ == "counter" else "")
+            lines.append("# TYPE {} {}".format(metric, type_))
+            for name, h in sorted(snapshot.items()):
+                lines.append("{}{{{}}} {}".format(metric, label(name), h[field]))
+
+        metric = "{}_compute_seconds".format(prefix)
+        lines.append("# TYPE {} histogram".format(metric))
+        for name, h in sorted(snapshot.items()):
+            h_latency = h[CacheStats.Field.LATENCY]
+            for bound, count in h_latency[HistogramMetric.Field.BUCKETS]:
+                le = "+Inf" if bound is None else repr(float(bound))
+                lines.append("{}_bucket{{{}}} {}".format(metric, label(name, le=le), count))
+            lines.append("{}_sum{{{}}} {}".format(metric, label(name), h_latency[HistogramMetric.Field.TOTAL]))
+            lines.append("{}_count{{{}}} {}".format(metric, label(name), h_latency[HistogramMetric.Field.COUNT]))
+
+        return "\n".join(lines) + "\n"
+
+    @classmethod
+    def snapshot2logline(cls, snapshot=None):
+        snapshot = snapshot if snapshot is not None else cls.snapshot()
+
+        def h2str(h):
+            hit_ratio = h[CacheStats.Field.HIT_RATIO]
+            mean = h[CacheStats.Field.LATENCY][HistogramMetric.Field.MEAN]
+            return "{}(hits={} misses={} hit_ratio={} evictions={} size={}/{} compute_mean={})".format(
+                h[CacheStats.Field.NAME],
+                h[CacheStats.Field.HITS],
+                h[CacheStats.Field.MISSES],
+                "-" if hit_ratio is None else "{:.3f}".format(hit_ratio),
+                h[CacheStats.Field.EVICTIONS],
+                h[CacheStats.Field.SIZE],
+                h[CacheStats.Field.MAXSIZE],
+                "-" if mean is None else "{:.6f}s".format(mean),
+            )
+
+        return " ".join(h2str(h) for _, h in sorted(snapshot.items()))
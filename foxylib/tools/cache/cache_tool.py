@@ -1,7 +1,11 @@
+import hashlib
+import json
 import logging
 from functools import wraps, lru_cache
+from itertools import chain
 
 import cachetools
+from cachetools.keys import hashkey
 import dill
 import six
 from frozendict import frozendict
@@ -72,6 +76,79 @@ class CacheTool:
         @classmethod
         def deserialize_dill(cls, s): return dill.loads(s)
 
+        class Fingerprinted:
+            """
+            argument keyed by its fingerprint, carrying the original value along until the call takes it.
+            the one stored in the cache key keeps the digest only
+            """
+            __slots__ = ("value", "digest")
+
+            def __init__(self, value, digest):
+                self.value = value
+                self.digest = digest
+
+            def __hash__(self):
+                return hash(self.digest)
+
+            def __eq__(self, other):
+                return isinstance(other, CacheTool.JSON.Fingerprinted) and self.digest == other.digest
+
+        TYPES_SCALAR = (str, int, float, bool, type(None))
+
+        @classmethod
+        def fingerprint(cls, j):
+            """
+            128-bit digest of the canonical JSON of j (dict keys sorted, lists and tuples alike),
+            serialized in one pass in C instead of rebuilding j in python like normalize().
+
+            scalars are their own fingerprint.
+            as in JSON, int/float/bool/None dict keys count as their string form.
+            structures JSON can't express (sets, other objects) fall back to normalize().
+            """
+            if isinstance(j, cls.TYPES_SCALAR):
+                return type(j), j
+
+            try:
+                s = json.dumps(j, sort_keys=True, separators=(",", ":"), check_circular=False)
+            except (TypeError, ValueError):
+                return cls.normalize(j)
+
+            return hashlib.blake2b(s.encode("utf-8"), digest_size=16).digest()
+
+        @classmethod
+        def fingerprint_pair(cls):
+            """
+            f_pair for cache2hashable(): keyed by fingerprint, the function still gets the original arguments
+            """
+            def serialize(j):
+                return cls.Fingerprinted(j, cls.fingerprint(j))
+
+            def deserialize(fingerprinted):
+                # called once per miss. the cache keeps this object as its key, so drop the argument
+                value, fingerprinted.value = fingerprinted.value, None
+                return value
+
+            return serialize, deserialize
+
+        @classmethod
+        def fingerprint_key(cls, *args, **kwargs):
+            """
+            key= for cachetools.cached() / CacheManager.attach_cached().
+            an argument object passed more than once is fingerprinted once.
+            only whole arguments are shared: equal sub-objects inside arguments are serialized again,
+            as fingerprint() encodes each argument in a single C pass.
+            """
+            h_id2digest = {}
+
+            def j2digest(j):
+                id_ = id(j)
+                if id_ not in h_id2digest:
+                    h_id2digest[id_] = cls.fingerprint(j)
+                return h_id2digest[id_]
+
+            return hashkey(*[j2digest(j) for j in args],
+                           **{k: j2digest(j) for k, j in kwargs.items()})
+
     @classmethod
     def cache2hashable(cls, func=None, cache=None, f_pair=None,):
 
@@ -101,7 +178,7 @@ class CacheTool:
             if hasattr(cache, "cache_info"):
                 wrapped.cache_info = cached_func.cache_info
 
-            if hasattr(wrapped, "cache_clear"):
+            if hasattr(cached_func, "cache_clear"):
                 wrapped.cache_clear = cached_func.cache_clear
 
             return wrapped
@@ -164,6 +241,37 @@ class CacheTool:
             cache[k] = value
         return value
 
+    @classmethod
+    def k2get_or_set(cls, cache, k, f_lazy, lock=None, single_flight=None, timeout=None):
+        """
+        lock is held only around the read and the write, never around f_lazy().
+        with single_flight, concurrent misses of k call f_lazy() once and the others wait for it.
+        """
+        try:
+            return cls.k2get(cache, k, lock=lock)
+        except KeyError:
+            pass  # key not found
+
+        def compute_and_set():
+            v = f_lazy()
+            try:
+                cls.k2set(cache, k, v, lock=lock)
+            except ValueError:
+                pass  # value too large
+            return v
+
+        if single_flight is None:
+            return compute_and_set()
+
+        def read_or_compute():
+            # the previous flight of k may have filled the cache since our miss
+            try:
+                return cls.k2get(cache, k, lock=lock)
+            except KeyError:
+                return compute_and_set()
+
+        return single_flight.run((id(cache), k), read_or_compute, timeout=timeout)
+
     @classmethod
     def delete_key(cls, cache, key, lock=None):
         def delete_if_exists(cache, key):
@@ -176,6 +284,44 @@ class CacheTool:
         else:
             delete_if_exists(cache, key)
 
+    @classmethod
+    def keys2h_k2v(cls, cache, k_list, lock=None):
+        """
+        multi-get under one lock acquisition. missing keys are left out
+        """
+        def keys2h_k2v_unlocked():
+            h_k2v = {}
+            for k in k_list:
+                try:
+                    h_k2v[k] = cache[k]
+                except KeyError:
+                    pass  # key not found
+            return h_k2v
+
+        if lock is not None:
+            with lock:
+                return keys2h_k2v_unlocked()
+        else:
+            return keys2h_k2v_unlocked()
+
+    @classmethod
+    def h_k2v2set(cls, cache, h_k2v, lock=None):
+        """
+        multi-set under one lock acquisition. values too large for the cache are skipped
+        """
+        def h_k2v2set_unlocked():
+            for k, v in h_k2v.items():
+                try:
+                    cache[k] = v
+                except ValueError:
+                    pass  # value too large
+
+        if lock is not None:
+            with lock:
+                h_k2v2set_unlocked()
+        else:
+            h_k2v2set_unlocked()
+
     @classmethod
     def cache_keys2i_list_missing(cls, cache, k_list, lock=None):
         if lock is not None:
@@ -189,7 +335,20 @@ class CacheTool:
 
 class CacheBatchTool:
 
+    @classmethod
+    def args_indexes2filtered(cls, args, indexes_each, indexes):
+        """
+        args of a batch call for the items at indexes only
+        """
+        def j2arg(j):
+            arg = args[j]
+            if j not in indexes_each:
+                return arg
 
+            return lmap(lambda i: arg[i], indexes)
+
+        args_out = [j2arg(j) for j in range(len(args))]
+        return args_out
 
     @classmethod
     def batchrun_missing(cls, f_batch, args, kwargs, cache, indexes_each, k_list, lock=None):
@@ -197,18 +356,7 @@ class CacheBatchTool:
         if not i_list_missing:
             return {}
 
-        def _indexes2args_filtered(indexes):
-            def j2arg(j):
-                arg = args[j]
-                if j not in indexes_each:
-                    return arg
-
-                return lmap(lambda i: arg[i], indexes)
-
-            args_out = [j2arg(j) for j in range(len(args))]
-            return args_out
-
-        args_missing = _indexes2args_filtered(i_list_missing, )
+        args_missing = cls.args_indexes2filtered(args, indexes_each, i_list_missing)
         v_list_missing = f_batch(*args_missing, **kwargs)
 
         assert_equal(len(i_list_missing), len(v_list_missing),
@@ -222,36 +370,60 @@ class CacheBatchTool:
         return h_i2v
 
     @classmethod
-    def batchrun(cls, f_batch, args, kwargs, cache, indexes_each, key, lock=None):
-        logger = FoxylibLogger.func_level2logger(cls.batchrun, logging.DEBUG)
-        # key = key if key else cachetools.keys.hashkey
+    def f_batch2h_k2v(cls, f_batch, args, kwargs, indexes_each, h_k2i, chunk_size=None, executor=None):
+        """
+        f_batch() on the items at h_k2i's indexes, in sub-batches of at most chunk_size.
+        sub-batches run in parallel if executor is given.
+        """
+        k_list = list(h_k2i.keys())
+        i_list = list(h_k2i.values())
 
-        def args_kwargs2k_list(_key, _indexes_each, _args, _kwargs):
-            _args_list = FunctionTool.args2split(_args, _indexes_each)
-            return [key(*_args_each, **_kwargs) for _args_each in _args_list]
-
-        k_list = args_kwargs2k_list(key, indexes_each, args, kwargs)
         n = len(k_list)
+        size = chunk_size if chunk_size else n
+        spans = [(s, min(s + size, n)) for s in range(0, n, size)]
+
+        def span2v_list(span):
+            s, e = span
+            args_chunk = cls.args_indexes2filtered(args, indexes_each, i_list[s:e])
+            v_list = f_batch(*args_chunk, **kwargs)
+
+            assert_equal(e - s, len(v_list),
+                         msg=format_str("f_batch result incorrect: {} vs {}", e - s, len(v_list)),
+                         )
+            return v_list
 
-        h_i2v_missing = cls.batchrun_missing(f_batch, args, kwargs, cache, indexes_each, k_list, lock=lock)
+        if executor is not None and len(spans) > 1:
+            v_lists = list(executor.map(span2v_list, spans))
+        else:
+            v_lists = lmap(span2v_list, spans)
+
+        return dict(zip_strict(k_list, list(chain.from_iterable(v_lists))))
+
+    @classmethod
+    def batchrun(cls, f_batch, args, kwargs, cache, indexes_each, key, lock=None, chunk_size=None, executor=None):
+        """
+        one locked multi-get for the distinct keys, one f_batch() call per sub-batch of the missing ones
+        (each key once, however often it repeats), and one locked multi-set of the results.
+        """
+        logger = FoxylibLogger.func_level2logger(cls.batchrun, logging.DEBUG)
 
-        def index2value(index):
-            # raise Exception({"index": index, "k_list":k_list, "h_i2v_missing": h_i2v_missing})
+        args_list = FunctionTool.args2split(args, indexes_each)
+        k_list = [key(*args_each, **kwargs) for args_each in args_list]
 
-            k = k_list[index]
-            if index not in h_i2v_missing:
-                return CacheTool.k2get(cache, k, lock=lock)
-            else:
-                v = h_i2v_missing[index]
-                CacheTool.k2set(cache, k, v, lock=lock)
-                return v
+        h_k2i = {}  # distinct key -> first index
+        for i, k in enumerate(k_list):
+            h_k2i.setdefault(k, i)
 
-        v_list = lmap(index2value, range(n))
+        h_k2v = CacheTool.keys2h_k2v(cache, h_k2i.keys(), lock=lock)
 
-        # logger.debug({"hex(id(cache))":hex(id(cache)), "cache":cache, "h_i2v_missing":h_i2v_missing})
-        # raise Exception({"h_i2v_missing":h_i2v_missing,"v_list":v_list})
+        h_k2i_missing = {k: i for k, i in h_k2i.items() if k not in h_k2v}
+        if h_k2i_missing:
+            h_k2v_missing = cls.f_batch2h_k2v(f_batch, args, kwargs, indexes_each, h_k2i_missing,
+                                              chunk_size=chunk_size, executor=executor)
+            CacheTool.h_k2v2set(cache, h_k2v_missing, lock=lock)
+            h_k2v.update(h_k2v_missing)
 
-        return v_list
+        return [h_k2v[k] for k in k_list]
 
 
 class Timedvalue:
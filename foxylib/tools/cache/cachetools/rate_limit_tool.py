@@ -0,0 +1,326 @@
+import asyncio
+import math
+import time
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+from functools import wraps
+from threading import Lock, Condition
+
+import cachetools.keys
+from cachetools import TTLCache
+
+from foxylib.tools.cache.cachetools.cachetools_tool import CooldownTool
+from foxylib.tools.metric.metric_tool import CounterMetric, HistogramMetric
+
+
+class RateLimiter:
+    """
+    Base of the keyed limiters. Each key has its own state in `cache`, like CooldownTool has one cooldown per key.
+
+    acquire() waits until the key has room for n units, up to `timeout` seconds (None: no deadline, 0: no wait),
+    and raises RateLimiter.LimitedException otherwise. It fails at once when the wait is known to outlast the deadline.
+    Waiters are not served in FIFO order.
+
+    Subclasses implement _k2delay(), called under the lock:
+    0 after taking n units, else seconds until there may be room (math.inf: until a release()).
+    """
+
+    class LimitedException(CooldownTool.NotCallableException):
+        pass
+
+    class Count:
+        ACQUIRED = "acquired"
+        WAITED = "waited"
+        REJECTED = "rejected"
+
+    class Field:
+        COUNTS = "counts"
+        WAIT = "wait"
+        KEYS = "keys"
+
+    KEY_DEFAULT = ()
+    MAXSIZE_DEFAULT = 4096
+
+    def __init__(self, cache=None):
+        self.cache = cache if cache is not None else {}
+
+        self.lock = Lock()
+        self.cond = Condition(self.lock)
+        self.waiters_async = set()
+
+        self.counter = CounterMetric([self.Count.ACQUIRED, self.Count.WAITED, self.Count.REJECTED])
+        self.wait = HistogramMetric()
+
+    def _k2delay(self, k, n, now):
+        raise NotImplementedError()
+
+    def _delay2secs(self, k, n, delay, deadline, now):
+        """
+        seconds to wait before trying again (math.inf: no limit). raises if the deadline comes first
+        """
+        secs_left = math.inf if deadline is None else deadline - now
+        if secs_left <= 0 or (delay > secs_left and not math.isinf(delay)):
+            self.counter.incr(self.Count.REJECTED)
+            raise self.LimitedException({"k": k, "n": n, "delay": delay})
+
+        return min(delay, secs_left)
+
+    def _acquired(self, time_start, now):
+        self.counter.incr(self.Count.ACQUIRED)
+        if now > time_start:
+            self.counter.incr(self.Count.WAITED)
+        self.wait.add(now - time_start)
+
+    def acquire(self, k=None, n=1, timeout=None):
+        k = self.KEY_DEFAULT if k is None else k
+        time_start = time.monotonic()
+        deadline = None if timeout is None else time_start + timeout
+
+        with self.cond:
+            now = time_start
+            while True:
+                delay = self._k2delay(k, n, now)
+                if delay == 0:
+                    self._acquired(time_start, now)
+                    return
+
+                secs = self._delay2secs(k, n, delay, deadline, now)
+                self.cond.wait(None if math.isinf(secs) else secs)
+                now = time.monotonic()
+
+    async def acquire_async(self, k=None, n=1, timeout=None):
+        """
+        waits on the event loop, never blocking it. release() from any thread or loop wakes it up
+        """
+        k = self.KEY_DEFAULT if k is None else k
+        loop = asyncio.get_event_loop()
+        time_start = time.monotonic()
+        deadline = None if timeout is None else time_start + timeout
+
+        now = time_start
+        while True:
+            with self.lock:
+                delay = self._k2delay(k, n, now)
+                if delay == 0:
+                    self._acquired(time_start, now)
+                    return
+
+                secs = self._delay2secs(k, n, delay, deadline, now)
+                waiter = (loop, loop.create_future())
+                self.waiters_async.add(waiter)
+
+            try:
+                await asyncio.wait([waiter[1]], timeout=None if math.isinf(secs) else secs)
+            finally:
+                with self.lock:
+                    self.waiters_async.discard(waiter)
+            now = time.monotonic()
+
+    def try_acquire(self, k=None, n=1):
+        try:
+            self.acquire(k=k, n=n, timeout=0)
+            return True
+        except self.LimitedException:
+            return False
+
+    def release(self, k=None, n=1):
+        """
+        no-op for rate limits: spent units come back with time
+        """
+        pass
+
+    @classmethod
+    def _future2done(cls, future):
+        if not future.done():
+            future.set_result(None)
+
+    def _notify(self):
+        """
+        call with the lock held
+        """
+        self.cond.notify_all()
+        for loop, future in self.waiters_async:
+            loop.call_soon_threadsafe(self._future2done, future)
+
+    @contextmanager
+    def acquired(self, k=None, n=1, timeout=None):
+        self.acquire(k=k, n=n, timeout=timeout)
+        try:
+            yield
+        finally:
+            self.release(k=k, n=n)
+
+    @asynccontextmanager
+    async def acquired_async(self, k=None, n=1, timeout=None):
+        await self.acquire_async(k=k, n=n, timeout=timeout)
+        try:
+            yield
+        finally:
+            self.release(k=k, n=n)
+
+    def metrics(self):
+        return {self.Field.COUNTS: self.counter.to_dict(),
+                self.Field.WAIT: self.wait.to_dict(),
+                self.Field.KEYS: len(self.cache),
+                }
+
+
+class TokenBucketLimiter(RateLimiter):
+    """
+    `rate` units per second on average, in bursts of up to `capacity` units.
+
+    Idle buckets are full, so the default TTLCache drops keys idle for capacity / rate seconds.
+    """
+
+    def __init__(self, rate, capacity=None, cache=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+
+        if cache is None:
+            cache = TTLCache(maxsize=self.MAXSIZE_DEFAULT, ttl=self.capacity / self.rate)
+        super(TokenBucketLimiter, self).__init__(cache=cache)
+
+    def _k2delay(self, k, n, now):
+        if n > self.capacity:
+            raise ValueError({"n": n, "capacity": self.capacity})
+
+        tokens, time_last = self.cache.get(k) or (self.capacity, now)
+        tokens = min(self.capacity, tokens + (now - time_last) * self.rate)
+
+        if tokens >= n:
+            self.cache[k] = (tokens - n, now)  # setting again also renews the TTL
+            return 0
+
+        self.cache[k] = (tokens, now)
+        return (n - tokens) / self.rate
+
+
+class SlidingWindowLimiter(RateLimiter):
+    """
+    at most `limit` units within any `window` seconds, logging one timestamp per unit.
+
+    Exact, unlike the token bucket, at the cost of up to `limit` timestamps per key.
+    """
+
+    def __init__(self, limit, window, cache=None):
+        self.limit = limit
+        self.window = window
+
+        if cache is None:
+            cache = TTLCache(maxsize=self.MAXSIZE_DEFAULT, ttl=window)
+        super(SlidingWindowLimiter, self).__init__(cache=cache)
+
+    def _k2delay(self, k, n, now):
+        if n > self.limit:
+            raise ValueError({"n": n, "limit": self.limit})
+
+        times = self.cache.get(k) or deque()
+        while times and times[0] <= now - self.window:
+            times.popleft()
+
+        if len(times) + n <= self.limit:
+            times.extend([now] * n)
+            self.cache[k] = times
+            return 0
+
+        # room once the (len + n - limit) oldest units leave the window
+        return times[len(times) + n - self.limit - 1] + self.window - now
+
+
+class ConcurrencyLimiter(RateLimiter):
+    """
+    at most `limit` units in flight per key, i.e. a keyed semaphore. acquire() waits for release().
+
+    Counts live in a plain dict, as evicting one would let too many in. Keys are dropped at zero.
+    """
+
+    class Field(RateLimiter.Field):
+        INFLIGHT = "inflight"
+
+    def __init__(self, limit):
+        self.limit = limit
+        super(ConcurrencyLimiter, self).__init__(cache={})
+
+    def _k2delay(self, k, n, now):
+        if n > self.limit:
+            raise ValueError({"n": n, "limit": self.limit})
+
+        count = self.cache.get(k, 0)
+        if count + n <= self.limit:
+            self.cache[k] = count + n
+            return 0
+
+        return math.inf
+
+    def release(self, k=None, n=1):
+        k = self.KEY_DEFAULT if k is None else k
+
+        with self.lock:
+            count = self.cache[k] - n
+            if count > 0:
+                self.cache[k] = count
+            else:
+                del self.cache[k]
+
+            self._notify()
+
+    def metrics(self):
+        h = super(ConcurrencyLimiter, self).metrics()
+        with self.lock:
+            h[self.Field.INFLIGHT] = sum(self.cache.values())
+        return h
+
+
+class RateLimitTool:
+    """
+    Decorators in the manner of CooldownTool, which waits for room instead of failing while a key cools down.
+
+    key: like cachetools, from the call arguments. hashkey by default, i.e. a limit per distinct arguments.
+    Pass e.g. key=lambda *_, **__: () for one limit over all calls.
+    Stack decorators to combine limits, e.g. a quota and a concurrency cap.
+    """
+
+    @classmethod
+    def func2limited(cls, f, limiter, key, n, timeout, ):
+        if asyncio.iscoroutinefunction(f):
+            @wraps(f)
+            async def wrapped(*_, **__):
+                async with limiter.acquired_async(key(*_, **__), n=n, timeout=timeout):
+                    return await f(*_, **__)
+            return wrapped
+
+        @wraps(f)
+        def wrapped(*_, **__):
+            with limiter.acquired(key(*_, **__), n=n, timeout=timeout):
+                return f(*_, **__)
+        return wrapped
+
+    @classmethod
+    def limited(cls, limiter, key=None, n=1, timeout=None, ):
+        key = key or cachetools.keys.hashkey
+
+        def wrapper(f):
+            return cls.func2limited(f, limiter, key, n, timeout)
+        return wrapper
+
+    @classmethod
+    def limited_method(cls, self2limiter, key=None, n=1, timeout=None, ):
+        """
+        one limiter per instance, e.g. per API client. self is not part of the key
+        """
+        key = key or cachetools.keys.hashkey
+
+        def wrapper(f):
+            if asyncio.iscoroutinefunction(f):
+                @wraps(f)
+                async def wrapped(self, *_, **__):
+                    async with self2limiter(self).acquired_async(key(*_, **__), n=n, timeout=timeout):
+                        return await f(self, *_, **__)
+                return wrapped
+
+            @wraps(f)
+            def wrapped(self, *_, **__):
+                with self2limiter(self).acquired(key(*_, **__), n=n, timeout=timeout):
+                    return f(self, *_, **__)
+            return wrapped
+        return wrapper
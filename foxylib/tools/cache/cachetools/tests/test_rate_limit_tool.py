@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import time
+from concurrent.futures.thread import ThreadPoolExecutor
+from threading import Lock
+from unittest import TestCase
+
+from foxylib.tools.cache.cachetools.cachetools_tool import CooldownTool
+from foxylib.tools.cache.cachetools.rate_limit_tool import TokenBucketLimiter, RateLimiter, \
+    SlidingWindowLimiter, ConcurrencyLimiter, RateLimitTool
+from foxylib.tools.log.foxylib_logger import FoxylibLogger
+
+
+class TestRateLimitTool(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        FoxylibLogger.attach_stderr2loggers(logging.DEBUG)
+
+    def test_01(self):
+        limiter = TokenBucketLimiter(rate=20, capacity=3)
+
+        self.assertEqual([limiter.try_acquire("a") for _ in range(4)], [True, True, True, False])
+        self.assertTrue(limiter.try_acquire("b"))
+
+        # 1 token in 0.05s: fails at once if the deadline is sooner
+        time_start = time.monotonic()
+        with self.assertRaises(RateLimiter.LimitedException):
+            limiter.acquire("a", timeout=0.01)
+        self.assertLess(time.monotonic() - time_start, 0.01)
+
+        with self.assertRaises(CooldownTool.NotCallableException):
+            limiter.acquire("a", timeout=0)
+
+        limiter.acquire("a", timeout=1)
+        self.assertGreater(time.monotonic() - time_start, 0.03)
+
+        with self.assertRaises(ValueError):
+            limiter.acquire("a", n=4)
+
+        h = limiter.metrics()
+        self.assertEqual(h[RateLimiter.Field.COUNTS],
+                         {RateLimiter.Count.ACQUIRED: 5, RateLimiter.Count.WAITED: 1, RateLimiter.Count.REJECTED: 3})
+        self.assertEqual(h[RateLimiter.Field.KEYS], 2)
+
+    def test_02(self):
+        limiter = SlidingWindowLimiter(limit=2, window=0.1)
+
+        time_start = time.monotonic()
+        for _ in range(5):
+            limiter.acquire()
+        secs = time.monotonic() - time_start
+
+        # 2 now, 2 after 0.1s, 1 after 0.2s
+        self.assertGreater(secs, 0.19)
+        self.assertLess(secs, 0.5)
+
+        with self.assertRaises(RateLimiter.LimitedException):
+            limiter.acquire(n=2, timeout=0.05)
+
+    def test_03(self):
+        limiter = ConcurrencyLimiter(limit=2)
+        lock = Lock()
+        inflight = [0]
+        inflight_max = [0]
+
+        @RateLimitTool.limited(limiter, key=lambda *_, **__: "api")
+        def f(x):
+            with lock:
+                inflight[0] += 1
+                inflight_max[0] = max(inflight_max[0], inflight[0])
+            time.sleep(0.02)
+            with lock:
+                inflight[0] -= 1
+            return x
+
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            self.assertEqual(list(executor.map(f, range(12))), list(range(12)))
+
+        self.assertEqual(inflight_max[0], 2)
+        self.assertEqual(limiter.metrics()[ConcurrencyLimiter.Field.INFLIGHT], 0)
+
+        limiter.acquire("k", n=2)
+        with self.assertRaises(RateLimiter.LimitedException):
+            limiter.acquire("k", timeout=0.02)
+        limiter.release("k", n=2)
+        self.assertTrue(limiter.try_acquire("k"))
+
+    def test_04(self):
+        limiter_rate = TokenBucketLimiter(rate=50, capacity=1)
+        limiter_concurrency = ConcurrencyLimiter(limit=1)
+        inflight = [0]
+
+        @RateLimitTool.limited(limiter_rate, key=lambda *_, **__: ())
+        @RateLimitTool.limited(limiter_concurrency, key=lambda *_, **__: ())
+        async def f(x):
+            inflight[0] += 1
+            self.assertEqual(inflight[0], 1)
+            await asyncio.sleep(0.01)
+            inflight[0] -= 1
+            return x
+
+        async def main():
+            time_start = time.monotonic()
+            x_list = await asyncio.gather(*[f(x) for x in range(5)])
+            return x_list, time.monotonic() - time_start
+
+        x_list, secs = asyncio.run(main())
+        self.assertEqual(x_list, list(range(5)))
+        self.assertGreater(secs, 0.07)  # 4 waits of 1/50s
+
+        async def rejected():
+            await limiter_concurrency.acquire_async("k")
+            try:
+                await limiter_concurrency.acquire_async("k", timeout=0.02)
+            finally:
+                limiter_concurrency.release("k")
+
+        with self.assertRaises(RateLimiter.LimitedException):
+            asyncio.run(rejected())
+
+    def test_05(self):
+        """
+        async waiter woken by a release from another thread
+        """
+        limiter = ConcurrencyLimiter(limit=1)
+        limiter.acquire()
+
+        async def main():
+            time_start = time.monotonic()
+            await limiter.acquire_async(timeout=1)
+            return time.monotonic() - time_start
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            executor.submit(lambda: (time.sleep(0.05), limiter.release()))
+            secs = asyncio.run(main())
+
+        self.assertGreater(secs, 0.04)
+        self.assertLess(secs, 0.5)
+
+    def test_06(self):
+        class Client:
+            def __init__(self):
+                self.limiter = TokenBucketLimiter(rate=10, capacity=1)
+
+            @RateLimitTool.limited_method(lambda self: self.limiter, timeout=0)
+            def call(self, channel):
+                return channel
+
+        client = Client()
+        self.assertEqual(client.call("a"), "a")
+        self.assertEqual(client.call("b"), "b")
+        with self.assertRaises(RateLimiter.LimitedException):
+            client.call("a")
+
+        self.assertEqual(Client().call("a"), "a")
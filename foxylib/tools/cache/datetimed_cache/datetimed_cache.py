@@ -1,16 +1,23 @@
 from __future__ import absolute_import
 
 import logging
-from datetime import datetime
+import queue
+import random
+from datetime import datetime, timedelta
+from functools import wraps
+from threading import Lock
 
 import pytz
 from cachetools.keys import hashkey
 # from cachetools import cached, lru, ttl
-from nose.tools import assert_is_not_none
+from nose.tools import assert_is_not_none, assert_false
 
 from foxylib.tools.cache.asymmetric_cache import AsymmetricCache
+from foxylib.tools.cache.cache_registry import CacheRegistry
 from foxylib.tools.cache.cache_tool import CacheTool
 from foxylib.tools.log.foxylib_logger import FoxylibLogger
+from foxylib.tools.metric.metric_tool import CounterMetric
+from foxylib.tools.thread.thread_tool import ThreadTool
 
 
 class DatetimedCache:
@@ -44,6 +51,155 @@ class DatetimedCache:
             cache[k] = (value, dt_pivot)
         return writer
 
+    class Revalidator:
+        """
+        Stale-while-revalidate for DatetimedCache.Decorator.
+
+        A stale entry (pivot moved past it, or soft TTL passed) is returned as is,
+        and one refresh per key runs on a shared executor.
+        An entry more than hard_expiry behind the pivot is recomputed synchronously, like a miss.
+        soft_ttl is wall-clock time since the write, spread by +-jitter (ratio) so that keys written together
+        don't go stale together.
+
+        entry: (value, dt_pivot at write, dt_soft_expiry or None)
+        """
+
+        class Constant:
+            POOL = "DatetimedCache.Revalidator"
+
+        class State:
+            FRESH = "fresh"
+            STALE = "stale"
+            EXPIRED = "expired"
+
+        class Count:
+            FRESH = "fresh"
+            STALE = "stale"
+            EXPIRED = "expired"
+            MISS = "miss"
+            REFRESHED = "refreshed"
+            REFRESH_FAILED = "refresh_failed"
+            REFRESH_DEDUPED = "refresh_deduped"
+            REFRESH_REJECTED = "refresh_rejected"
+
+        def __init__(self, executor=None, hard_expiry=None, soft_ttl=None, jitter=0.1):
+            self.executor = executor
+            self.hard_expiry = hard_expiry
+            self.soft_ttl = soft_ttl
+            self.jitter = jitter
+
+            self.lock = Lock()
+            self.inflight = set()
+            self.counter = CounterMetric([self.Count.FRESH, self.Count.STALE, self.Count.EXPIRED, self.Count.MISS,
+                                          self.Count.REFRESHED, self.Count.REFRESH_FAILED,
+                                          self.Count.REFRESH_DEDUPED, self.Count.REFRESH_REJECTED, ])
+
+        def get_executor(self):
+            if self.executor is not None:
+                return self.executor
+
+            # refreshes are best effort: never block the caller on a full queue
+            return ThreadTool.name2executor(self.Constant.POOL, max_workers=4, max_queue=1024, timeout_submit=0)
+
+        def dt_now2soft_expiry(self, dt_now):
+            if self.soft_ttl is None:
+                return None
+
+            ratio = 1 + random.uniform(-self.jitter, self.jitter) if self.jitter else 1
+            return dt_now + timedelta(seconds=self.soft_ttl.total_seconds() * ratio)
+
+        def value_pivot2entry(self, value, dt_pivot):
+            return value, dt_pivot, self.dt_now2soft_expiry(datetime.now(pytz.utc))
+
+        def entry_pivot2state(self, entry, dt_pivot):
+            _, dt_created, dt_soft = entry
+
+            if dt_pivot > dt_created:
+                if self.hard_expiry is not None and dt_pivot - dt_created > self.hard_expiry:
+                    return self.State.EXPIRED
+                return self.State.STALE
+
+            if dt_soft is not None and datetime.now(pytz.utc) >= dt_soft:
+                return self.State.STALE
+
+            return self.State.FRESH
+
+        def write(self, cache, k, value, dt_pivot, lock=None):
+            entry = self.value_pivot2entry(value, dt_pivot)
+
+            def writer(_cache, _entry):
+                # a slow refresh must not overwrite what a newer pivot already wrote
+                entry_prev = _cache.get(k)
+                if entry_prev is not None and entry_prev[1] > dt_pivot:
+                    return
+                _cache[k] = _entry
+
+            try:
+                CacheTool.writer2set(cache, writer, entry, lock=lock)
+            except ValueError:
+                pass  # value too large
+
+        def refresh(self, cache, k, f_lazy, dt_pivot, lock=None):
+            logger = FoxylibLogger.func_level2logger(self.refresh, logging.DEBUG)
+
+            k_inflight = (id(cache), k)
+            with self.lock:
+                if k_inflight in self.inflight:
+                    self.counter.incr(self.Count.REFRESH_DEDUPED)
+                    return None
+                self.inflight.add(k_inflight)
+
+            def run():
+                try:
+                    self.write(cache, k, f_lazy(), dt_pivot, lock=lock)
+                    self.counter.incr(self.Count.REFRESHED)
+                except Exception:
+                    self.counter.incr(self.Count.REFRESH_FAILED)
+                    logger.exception({"k": k})
+                finally:
+                    with self.lock:
+                        self.inflight.discard(k_inflight)
+
+            try:
+                return self.get_executor().submit(run)
+            except (queue.Full, RuntimeError):
+                with self.lock:
+                    self.inflight.discard(k_inflight)
+                self.counter.incr(self.Count.REFRESH_REJECTED)
+                return None
+
+        def read_or_write(self, f_lazy, cache, k, dt_pivot, lock=None):
+            try:
+                entry = CacheTool.k2get(cache, k, lock=lock)
+            except KeyError:
+                entry = None
+
+            if entry is None:
+                self.counter.incr(self.Count.MISS)
+            else:
+                state = self.entry_pivot2state(entry, dt_pivot)
+                if state == self.State.FRESH:
+                    self.counter.incr(self.Count.FRESH)
+                    return entry[0]
+
+                if state == self.State.STALE:
+                    self.counter.incr(self.Count.STALE)
+                    self.refresh(cache, k, f_lazy, dt_pivot, lock=lock)
+                    return entry[0]
+
+                self.counter.incr(self.Count.EXPIRED)
+
+            v = f_lazy()
+            self.write(cache, k, v, dt_pivot, lock=lock)
+            return v
+
+        def count_inflight(self):
+            with self.lock:
+                return len(self.inflight)
+
+        def metrics(self):
+            return self.counter.to_dict()
+
     # @classmethod
     # def _lookup_or_cache(cls, cache, k, lock, dt_pivot, func):
     #     try:
@@ -66,30 +222,71 @@ class DatetimedCache:
 
     class Decorator:
         @classmethod
-        def cached(cls, func=None, cache=None, key=None, f_pivot=None, lock=None, ):
+        def cached(cls, func=None, cache=None, key=None, f_pivot=None, lock=None, single_flight=None, timeout=None,
+                   revalidator=None, ):
+            """
+            revalidator: DatetimedCache.Revalidator for stale-while-revalidate
+            """
             logger = FoxylibLogger.func_level2logger(cls.cached, logging.DEBUG)
 
             assert_is_not_none(cache)
             assert_is_not_none(f_pivot)
+            assert_false(revalidator is not None and single_flight is not None)
 
             key = key or hashkey
             reader = DatetimedCache.key_pivot2reader(key, f_pivot)
             writer = DatetimedCache.key_pivot2writer(key, f_pivot)
 
-            return AsymmetricCache.Decorator.cached(func=func, cache=cache, reader=reader, writer=writer, lock=lock)
+            def wrapper(f):
+                stats = CacheRegistry.func2stats(f)
+                f_compute = stats.func2timed(f) if stats is not None else f
+                if stats is not None:
+                    stats.cache2registered(cache)
+
+                if revalidator is not None:
+                    @wraps(f)
+                    def wrapped(*_, **__):
+                        return revalidator.read_or_write(lambda: f_compute(*_, **__), cache, key(*_, **__),
+                                                         f_pivot(*_, **__), lock=lock)
+                else:
+                    wrapped = AsymmetricCache.Decorator.cached(func=f_compute, cache=cache,
+                                                               reader=reader, writer=writer, lock=lock,
+                                                               single_flight=single_flight, timeout=timeout,
+                                                               key=key)
+
+                return stats.func2counted(wrapped) if stats is not None else wrapped
+
+            return wrapper(func) if func else wrapper
 
         @classmethod
-        def cachedmethod(cls, func=None, self2cache=None, key=None, f_pivot=None, lock=None, ):
+        def cachedmethod(cls, func=None, self2cache=None, key=None, f_pivot=None, lock=None,
+                         single_flight=None, timeout=None, revalidator=None, ):
             logger = FoxylibLogger.func_level2logger(cls.cachedmethod, logging.DEBUG)
 
             assert_is_not_none(self2cache)
             assert_is_not_none(f_pivot)
+            assert_false(revalidator is not None and single_flight is not None)
 
             key = key or hashkey
             reader = DatetimedCache.key_pivot2reader(key, f_pivot)
             writer = DatetimedCache.key_pivot2writer(key, f_pivot)
 
-            return AsymmetricCache.Decorator.cachedmethod(func=func, self2cache=self2cache,
-                                                          reader=reader, writer=writer, lock=lock)
+            def wrapper(f):
+                stats = CacheRegistry.func2stats(f)
+                f_compute = stats.func2timed(f) if stats is not None else f
+                _self2cache = stats.self2cache2registered(self2cache) if stats is not None else self2cache
+
+                if revalidator is not None:
+                    @wraps(f)
+                    def wrapped(self, *_, **__):
+                        return revalidator.read_or_write(lambda: f_compute(self, *_, **__), _self2cache(self),
+                                                         key(*_, **__), f_pivot(*_, **__), lock=lock)
+                else:
+                    wrapped = AsymmetricCache.Decorator.cachedmethod(func=f_compute, self2cache=_self2cache,
+                                                                     reader=reader, writer=writer, lock=lock,
+                                                                     single_flight=single_flight, timeout=timeout,
+                                                                     key=key)
 
+                return stats.func2counted(wrapped) if stats is not None else wrapped
 
+            return wrapper(func) if func else wrapper
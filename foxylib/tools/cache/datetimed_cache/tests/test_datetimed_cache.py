@@ -1,5 +1,8 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import logging
+from threading import Event
 from functools import lru_cache
 from unittest import TestCase
 
@@ -57,3 +60,81 @@ class TestDatetimedCache(TestCase):
 
         dt_03 = datetime.now(pytz.utc)
         self.assertEqual(a1.f(dt_03, 1), dt_03)
+
+    def test_03(self):
+        """
+        stale-while-revalidate: stale value returned at once, one background refresh per key
+        """
+        executor = ThreadPoolExecutor(max_workers=2)
+        revalidator = DatetimedCache.Revalidator(executor=executor, hard_expiry=timedelta(hours=1))
+        calls = []
+        event = Event()
+
+        @DatetimedCache.Decorator.cached(cache=LRUCache(10), f_pivot=lambda p, *_, **__: p,
+                                         key=lambda p, x, *_, **__: x, revalidator=revalidator)
+        def f(dt_pivot, x):
+            calls.append(dt_pivot)
+            if len(calls) > 1:
+                event.wait(1)
+            return dt_pivot
+
+        dt_01 = datetime.now(pytz.utc)
+        self.assertEqual(f(dt_01, 1), dt_01)
+
+        dt_02 = dt_01 + timedelta(minutes=1)
+        self.assertEqual(f(dt_02, 1), dt_01)  # stale
+        self.assertEqual(f(dt_02, 1), dt_01)  # refresh still running, deduped
+        event.set()
+        executor.shutdown(wait=True)
+
+        self.assertEqual(calls, [dt_01, dt_02])
+        self.assertEqual(f(dt_02, 1), dt_02)
+
+        # beyond hard expiry -> synchronous
+        dt_03 = dt_02 + timedelta(hours=2)
+        self.assertEqual(f(dt_03, 1), dt_03)
+
+        metrics = revalidator.metrics()
+        self.assertEqual(metrics[DatetimedCache.Revalidator.Count.STALE], 2)
+        self.assertEqual(metrics[DatetimedCache.Revalidator.Count.REFRESH_DEDUPED], 1)
+        self.assertEqual(metrics[DatetimedCache.Revalidator.Count.REFRESHED], 1)
+        self.assertEqual(metrics[DatetimedCache.Revalidator.Count.EXPIRED], 1)
+        self.assertEqual(revalidator.count_inflight(), 0)
+
+    def test_04(self):
+        """
+        soft ttl with jitter, failing refresh keeps the stale value
+        """
+        executor = ThreadPoolExecutor(max_workers=1)
+        revalidator = DatetimedCache.Revalidator(executor=executor, soft_ttl=timedelta(milliseconds=20), jitter=0.5)
+        calls = []
+
+        class A:
+            @lru_cache(maxsize=2)  # memleak possible, but using it only for testing
+            def cache(self):
+                return LRUCache(10)
+
+            @DatetimedCache.Decorator.cachedmethod(self2cache=lambda x: x.cache(),
+                                                   f_pivot=lambda p, *_, **__: p,
+                                                   key=lambda p, x, *_, **__: x,
+                                                   revalidator=revalidator)
+            def f(self, dt_pivot, x):
+                calls.append(x)
+                if len(calls) == 2:
+                    raise ValueError(x)
+                return len(calls)
+
+        a = A()
+        dt_pivot = datetime.now(pytz.utc)
+        self.assertEqual(a.f(dt_pivot, 1), 1)
+        self.assertEqual(a.f(dt_pivot, 1), 1)
+        self.assertEqual(len(calls), 1)
+
+        time.sleep(0.05)
+        self.assertEqual(a.f(dt_pivot, 1), 1)  # refresh fails
+        executor.submit(lambda: None).result()
+        self.assertEqual(a.f(dt_pivot, 1), 1)  # refresh succeeds
+        executor.shutdown(wait=True)
+        self.assertEqual(a.f(dt_pivot, 1), 3)
+
+        self.assertEqual(revalidator.metrics()[DatetimedCache.Revalidator.Count.REFRESH_FAILED], 1)
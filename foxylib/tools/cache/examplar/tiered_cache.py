@@ -0,0 +1,303 @@
+import json
+import os
+import pickle
+import struct
+import zlib
+from collections.abc import MutableMapping
+from threading import RLock
+
+import dill
+from cachetools import LRUCache
+
+from foxylib.tools.file.file_tool import FileTool
+
+
+class CacheSerializer:
+    """
+    (dumps, loads) pairs between values and bytes
+    """
+
+    @classmethod
+    def pickle(cls):
+        return (lambda v: pickle.dumps(v, protocol=pickle.HIGHEST_PROTOCOL)), pickle.loads
+
+    @classmethod
+    def dill(cls):
+        return dill.dumps, dill.loads
+
+    @classmethod
+    def json(cls):
+        return (lambda v: json.dumps(v, ensure_ascii=False).encode("utf-8")), (lambda b: json.loads(b.decode("utf-8")))
+
+
+class SegmentFileCache(MutableMapping):
+    """
+    Dict-like cache persisted in one append-only segment file.
+
+    Record: header (key length, value length, crc32), pickled key, serialized value.
+    A delete appends a tombstone record. The offset index of live records is rebuilt by one scan on open,
+    and a torn record at the end (e.g. killed while writing) is cut off.
+
+    max_bytes bounds the live value bytes. The oldest written keys are evicted first.
+    The file is compacted, i.e. rewritten with live records only, when dead bytes exceed compaction_ratio * live bytes.
+    """
+
+    HEADER = struct.Struct("<III")
+    TOMBSTONE = 0xFFFFFFFF
+
+    class Field:
+        FILEPATH = "filepath"
+        COUNT = "count"
+        BYTES_LIVE = "bytes_live"
+        BYTES_FILE = "bytes_file"
+        COMPACTIONS = "compactions"
+
+    def __init__(self, filepath, f_pair=None, max_bytes=None, compaction_ratio=1.0, compaction_min_bytes=2 ** 20):
+        self.filepath = filepath
+        self.dumps, self.loads = f_pair or CacheSerializer.pickle()
+        self.max_bytes = max_bytes
+        self.compaction_ratio = compaction_ratio
+        self.compaction_min_bytes = compaction_min_bytes
+
+        self.lock = RLock()
+        self.h_k2loc = {}  # key -> (offset, size) of the value. insertion order = write order
+        self.bytes_live = 0
+        self.bytes_file = 0
+        self.compactions = 0
+
+        FileTool.makedirs_or_skip(os.path.dirname(os.path.abspath(filepath)))
+        self.f = open(filepath, "a+b")
+        self._load()
+
+    @classmethod
+    def key2bytes(cls, k):
+        return pickle.dumps(k, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def record2bytes(cls, b_key, b_value):
+        size_value = cls.TOMBSTONE if b_value is None else len(b_value)
+        crc = zlib.crc32(b_value or b"", zlib.crc32(b_key))
+        return cls.HEADER.pack(len(b_key), size_value, crc) + b_key + (b_value or b"")
+
+    def _load(self):
+        self.f.seek(0)
+        data = self.f.read()
+
+        offset, n = 0, len(data)
+        while offset + self.HEADER.size <= n:
+            size_key, size_value, crc = self.HEADER.unpack_from(data, offset)
+            is_tombstone = size_value == self.TOMBSTONE
+            offset_value = offset + self.HEADER.size + size_key
+            offset_end = offset_value + (0 if is_tombstone else size_value)
+            if offset_end > n:
+                break
+
+            b_key = data[offset + self.HEADER.size:offset_value]
+            b_value = data[offset_value:offset_end]
+            if zlib.crc32(b_value, zlib.crc32(b_key)) != crc:
+                break
+
+            k = pickle.loads(b_key)
+            self._index_pop(k)
+            if not is_tombstone:
+                self.h_k2loc[k] = (offset_value, size_value)
+                self.bytes_live += size_value
+
+            offset = offset_end
+
+        if offset < n:
+            self.f.truncate(offset)
+        self.bytes_file = offset
+
+    def _index_pop(self, k):
+        loc = self.h_k2loc.pop(k, None)
+        if loc is not None:
+            self.bytes_live -= loc[1]
+        return loc
+
+    def _append(self, b_key, b_value):
+        record = self.record2bytes(b_key, b_value)
+        offset = self.bytes_file
+        self.f.write(record)
+        self.f.flush()
+        self.bytes_file += len(record)
+        return offset + self.HEADER.size + len(b_key)
+
+    def __getitem__(self, k):
+        with self.lock:
+            offset, size = self.h_k2loc[k]
+            self.f.seek(offset)
+            b_value = self.f.read(size)
+
+        return self.loads(b_value)
+
+    def __setitem__(self, k, v):
+        b_value = self.dumps(v)
+        if self.max_bytes is not None and len(b_value) > self.max_bytes:
+            raise ValueError("value too large")
+
+        b_key = self.key2bytes(k)
+        with self.lock:
+            self._index_pop(k)
+            offset_value = self._append(b_key, b_value)
+            self.h_k2loc[k] = (offset_value, len(b_value))
+            self.bytes_live += len(b_value)
+
+            self._evict_if_full()
+            self._compact_if_sparse()
+
+    def __delitem__(self, k):
+        with self.lock:
+            if self._index_pop(k) is None:
+                raise KeyError(k)
+            self._append(self.key2bytes(k), None)
+            self._compact_if_sparse()
+
+    def __contains__(self, k):
+        return k in self.h_k2loc
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.h_k2loc))
+
+    def __len__(self):
+        return len(self.h_k2loc)
+
+    def _evict_if_full(self):
+        if self.max_bytes is None:
+            return
+
+        while self.bytes_live > self.max_bytes:
+            k = next(iter(self.h_k2loc))
+            self._index_pop(k)
+            self._append(self.key2bytes(k), None)
+
+    def _compact_if_sparse(self):
+        bytes_dead = self.bytes_file - self.bytes_live
+        if bytes_dead < self.compaction_min_bytes:
+            return
+        if bytes_dead <= self.bytes_live * self.compaction_ratio:
+            return
+
+        self.compact()
+
+    def compact(self):
+        """
+        rewrite live records only into a new file, then swap it in
+        """
+        with self.lock:
+            filepath_tmp = "{}.tmp".format(self.filepath)
+            h_k2loc = {}
+            with open(filepath_tmp, "wb") as f_tmp:
+                offset_tmp = 0
+                for k, (offset, size) in self.h_k2loc.items():
+                    self.f.seek(offset)
+                    b_value = self.f.read(size)
+                    b_key = self.key2bytes(k)
+
+                    f_tmp.write(self.record2bytes(b_key, b_value))
+                    h_k2loc[k] = (offset_tmp + self.HEADER.size + len(b_key), size)
+                    offset_tmp += self.HEADER.size + len(b_key) + size
+
+                f_tmp.flush()
+                os.fsync(f_tmp.fileno())
+
+            self.f.close()
+            os.replace(filepath_tmp, self.filepath)
+            self.f = open(self.filepath, "a+b")
+
+            self.h_k2loc = h_k2loc
+            self.bytes_file = offset_tmp
+            self.compactions += 1
+
+    def flush(self):
+        with self.lock:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+    def close(self):
+        with self.lock:
+            self.f.close()
+
+    def metrics(self):
+        return {self.Field.FILEPATH: self.filepath,
+                self.Field.COUNT: len(self.h_k2loc),
+                self.Field.BYTES_LIVE: self.bytes_live,
+                self.Field.BYTES_FILE: self.bytes_file,
+                self.Field.COMPACTIONS: self.compactions,
+                }
+
+
+class TieredCache(MutableMapping):
+    """
+    In-memory LRU in front of a persistent dict-like store, e.g. SegmentFileCache or Lines2fileCache.
+
+    Writes go to both tiers. A read that misses memory is served from disk and promoted into memory.
+    Being a plain MutableMapping, it works as cache= of cachetools.cached() and CacheManager.attach_cached().
+    """
+
+    class Field:
+        HITS_MEMORY = "hits_memory"
+        HITS_DISK = "hits_disk"
+        MISSES = "misses"
+
+    def __init__(self, disk, memory=None, maxsize=1024):
+        self.disk = disk
+        self.memory = memory if memory is not None else LRUCache(maxsize=maxsize)
+
+        self.lock = RLock()
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+
+    def __getitem__(self, k):
+        with self.lock:
+            try:
+                v = self.memory[k]
+                self.hits_memory += 1
+                return v
+            except KeyError:
+                pass
+
+        try:
+            v = self.disk[k]
+        except KeyError:
+            self.misses += 1
+            raise
+
+        with self.lock:
+            self.hits_disk += 1
+            try:
+                self.memory[k] = v
+            except ValueError:
+                pass  # too large for memory. stays on disk only
+        return v
+
+    def __setitem__(self, k, v):
+        self.disk[k] = v
+
+        with self.lock:
+            try:
+                self.memory[k] = v
+            except ValueError:
+                self.memory.pop(k, None)
+
+    def __delitem__(self, k):
+        with self.lock:
+            self.memory.pop(k, None)
+        del self.disk[k]
+
+    def __contains__(self, k):
+        return k in self.memory or k in self.disk
+
+    def __iter__(self):
+        return iter(self.disk)
+
+    def __len__(self):
+        return len(self.disk)
+
+    def metrics(self):
+        return {self.Field.HITS_MEMORY: self.hits_memory,
+                self.Field.HITS_DISK: self.hits_disk,
+                self.Field.MISSES: self.misses,
+                }
@@ -0,0 +1,313 @@
+import hashlib
+import multiprocessing
+import pickle
+import struct
+from collections.abc import MutableMapping
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+
+class SharedMemoryCache(MutableMapping):
+    """
+    Dict-like cache in one multiprocessing.shared_memory block, shared by the processes that map it.
+
+    Layout: header, fixed-size open-addressing hash table of slots, append-only arena of records.
+    slot: (64-bit key hash, record offset, key size, record size). offset 0 is empty, 1 is deleted.
+    record: pickled key, pickle header, pickled value, out-of-band buffers (pickle protocol 5).
+
+    Writers serialize on a multiprocessing lock. Readers take no lock: the header holds a sequence number
+    that writers make odd while they change slots, and a reader retries if it changed during its lookup.
+    Records are never overwritten, so once a lookup is validated its record can be read without the lock.
+    Buffers such as numpy arrays come back as read-only views into the shared memory, i.e. zero-copy.
+
+    A full table or arena raises ValueError, which cachetools.cached() treats as "value too large".
+
+    Space is never reclaimed, since zero-copy views may still point into old records: overwriting a key appends a
+    new record, and deleted slots keep counting against LOAD_FACTOR_MAX. Treat it as a fill-once table, e.g. filled
+    by the parent before forking workers, which then read it as is. Under cachetools, a full cache silently stops
+    caching; watch metrics() for slots_load or arena_load near 1, or sets_rejected growing, and build a new one.
+
+    Other processes attach by pickling the cache (e.g. as Pool initargs) or with attach(name, lock).
+    """
+
+    MAGIC = b"FXSMC001"
+    HEADER = struct.Struct("<8sQQQQQQ")  # magic, n_slots, size_arena, used_arena, count, deleted, seq
+    SLOT = struct.Struct("<QQII")
+    RECORD = struct.Struct("<QI")  # pickle size, buffer count
+    BUFFER = struct.Struct("<Q")
+
+    OFFSET_EMPTY = 0
+    OFFSET_DELETED = 1
+    ALIGN = 64
+    LOAD_FACTOR_MAX = 0.75
+    RETRIES_LOCKFREE = 100
+
+    class Field:
+        NAME = "name"
+        COUNT = "count"
+        SLOTS = "slots"
+        SLOTS_DELETED = "slots_deleted"
+        BYTES_ARENA = "bytes_arena"
+        BYTES_USED = "bytes_used"
+        SLOTS_LOAD = "slots_load"
+        ARENA_LOAD = "arena_load"
+        SETS_REJECTED = "sets_rejected"
+
+    def __init__(self, name=None, n_slots=4096, size_arena=2 ** 26, lock=None, create=True):
+        if create:
+            size = self.HEADER.size + self.SLOT.size * n_slots + size_arena
+            self.shm = SharedMemory(name=name, create=True, size=size)
+            self.HEADER.pack_into(self.shm.buf, 0, self.MAGIC, n_slots, size_arena, 0, 0, 0, 0)
+        else:
+            self.shm = SharedMemory(name=name, create=False)
+            # python 3.8 tracks attached blocks too, and would unlink them when this process exits
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+
+        magic, n_slots, size_arena, _, _, _, _ = self.HEADER.unpack_from(self.shm.buf, 0)
+        if magic != self.MAGIC:
+            raise ValueError({"name": self.shm.name})
+
+        self.n_slots = n_slots
+        self.size_arena = size_arena
+        self.offset_table = self.HEADER.size
+        self.offset_arena = self.offset_table + self.SLOT.size * n_slots
+
+        self.lock = lock if lock is not None else multiprocessing.Lock()
+        self.is_owner = create
+        self.sets_rejected = 0  # in this process
+
+    @classmethod
+    def attach(cls, name, lock):
+        return cls(name=name, lock=lock, create=False)
+
+    def __getstate__(self):
+        return self.shm.name, self.lock
+
+    def __setstate__(self, state):
+        name, lock = state
+        self.__init__(name=name, lock=lock, create=False)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    # header
+
+    def _header(self):
+        return self.HEADER.unpack_from(self.shm.buf, 0)
+
+    def _header2updated(self, used_arena, count, deleted, seq):
+        self.HEADER.pack_into(self.shm.buf, 0, self.MAGIC, self.n_slots, self.size_arena,
+                              used_arena, count, deleted, seq)
+
+    def _seq(self):
+        return self.HEADER.unpack_from(self.shm.buf, 0)[6]
+
+    # slots
+
+    @classmethod
+    def key2bytes(cls, k):
+        # cachetools' hashkey() is a tuple subclass, which pickles differently from the equal plain tuple
+        k_plain = tuple(k) if isinstance(k, tuple) else k
+        return pickle.dumps(k_plain, protocol=4)
+
+    @classmethod
+    def bytes2hash(cls, b_key):
+        return int.from_bytes(hashlib.blake2b(b_key, digest_size=8).digest(), "little")
+
+    def _slot(self, i):
+        return self.SLOT.unpack_from(self.shm.buf, self.offset_table + self.SLOT.size * i)
+
+    def _slot2updated(self, i, h, offset, size_key, size_record):
+        self.SLOT.pack_into(self.shm.buf, self.offset_table + self.SLOT.size * i, h, offset, size_key, size_record)
+
+    def _lookup(self, b_key, h):
+        """
+        (slot index, slot) of the key if found, else (first reusable slot index, None)
+        """
+        buf = self.shm.buf
+        i_free = None
+        i = h % self.n_slots
+        for _ in range(self.n_slots):
+            slot = self._slot(i)
+            h_slot, offset, size_key, _ = slot
+
+            if offset == self.OFFSET_EMPTY:
+                return (i if i_free is None else i_free), None
+
+            if offset == self.OFFSET_DELETED:
+                if i_free is None:
+                    i_free = i
+            elif h_slot == h and size_key == len(b_key) and buf[offset:offset + size_key] == b_key:
+                return i, slot
+
+            i = (i + 1) % self.n_slots
+
+        return i_free, None
+
+    def _lookup_lockfree(self, b_key, h):
+        for _ in range(self.RETRIES_LOCKFREE):
+            seq = self._seq()
+            if seq % 2:
+                continue  # write in progress
+
+            i, slot = self._lookup(b_key, h)
+            if self._seq() == seq:
+                return i, slot
+
+        with self.lock:
+            return self._lookup(b_key, h)
+
+    # records
+
+    @classmethod
+    def value2chunks(cls, v):
+        buffers = []
+        b_pickle = pickle.dumps(v, protocol=5, buffer_callback=buffers.append)
+        raws = [b.raw() for b in buffers]
+
+        chunks = [cls.RECORD.pack(len(b_pickle), len(raws))]
+        chunks.extend(cls.BUFFER.pack(raw.nbytes) for raw in raws)
+        chunks.append(b_pickle)
+        return chunks, raws
+
+    def _record2value(self, offset, size_key):
+        buf = self.shm.buf
+        p = offset + size_key
+        size_pickle, n_buffers = self.RECORD.unpack_from(buf, p)
+        p += self.RECORD.size
+
+        sizes = [self.BUFFER.unpack_from(buf, p + self.BUFFER.size * j)[0] for j in range(n_buffers)]
+        p += self.BUFFER.size * n_buffers
+
+        mv_pickle = buf[p:p + size_pickle]
+        p += size_pickle
+
+        buffers = []
+        for size in sizes:
+            p = self.aligned(p)
+            buffers.append(buf[p:p + size].toreadonly())
+            p += size
+
+        return pickle.loads(mv_pickle, buffers=buffers)
+
+    @classmethod
+    def aligned(cls, p):
+        return (p + cls.ALIGN - 1) // cls.ALIGN * cls.ALIGN
+
+    def _append(self, used_arena, b_key, chunks, raws):
+        """
+        writes the record past the used arena, i.e. where no reader looks yet
+        """
+        buf = self.shm.buf
+        offset = self.aligned(self.offset_arena + used_arena)
+
+        p = offset + len(b_key) + sum(len(b) for b in chunks)
+        for raw in raws:
+            p = self.aligned(p) + raw.nbytes
+        if p > self.offset_arena + self.size_arena:
+            raise ValueError("arena full")
+
+        p = offset
+        for b in [b_key] + chunks:
+            buf[p:p + len(b)] = b
+            p += len(b)
+
+        for raw in raws:
+            p = self.aligned(p)
+            buf[p:p + raw.nbytes] = raw.cast("B")
+            p += raw.nbytes
+
+        return offset, p - offset, p - self.offset_arena
+
+    # MutableMapping
+
+    def __getitem__(self, k):
+        b_key = self.key2bytes(k)
+        _, slot = self._lookup_lockfree(b_key, self.bytes2hash(b_key))
+        if slot is None:
+            raise KeyError(k)
+
+        _, offset, size_key, _ = slot
+        return self._record2value(offset, size_key)
+
+    def __contains__(self, k):
+        b_key = self.key2bytes(k)
+        _, slot = self._lookup_lockfree(b_key, self.bytes2hash(b_key))
+        return slot is not None
+
+    def __setitem__(self, k, v):
+        try:
+            self._set(k, v)
+        except ValueError:
+            self.sets_rejected += 1
+            raise
+
+    def _set(self, k, v):
+        b_key = self.key2bytes(k)
+        h = self.bytes2hash(b_key)
+        chunks, raws = self.value2chunks(v)
+
+        with self.lock:
+            _, _, _, used_arena, count, deleted, seq = self._header()
+            i, slot = self._lookup(b_key, h)
+
+            is_new = slot is None
+            if is_new and (i is None or (count + deleted + 1) > self.n_slots * self.LOAD_FACTOR_MAX):
+                raise ValueError("hash table full")
+
+            offset, size_record, used_arena = self._append(used_arena, b_key, chunks, raws)
+
+            is_reused = is_new and self._slot(i)[1] == self.OFFSET_DELETED
+            self._header2updated(used_arena, count, deleted, seq + 1)  # odd: readers retry
+            self._slot2updated(i, h, offset, len(b_key), size_record)
+            self._header2updated(used_arena, count + int(is_new), deleted - int(is_reused), seq + 2)
+
+    def __delitem__(self, k):
+        b_key = self.key2bytes(k)
+        h = self.bytes2hash(b_key)
+
+        with self.lock:
+            _, _, _, used_arena, count, deleted, seq = self._header()
+            i, slot = self._lookup(b_key, h)
+            if slot is None:
+                raise KeyError(k)
+
+            self._header2updated(used_arena, count, deleted, seq + 1)
+            self._slot2updated(i, 0, self.OFFSET_DELETED, 0, 0)
+            self._header2updated(used_arena, count - 1, deleted + 1, seq + 2)
+
+    def __iter__(self):
+        buf = self.shm.buf
+        with self.lock:
+            slots = [self._slot(i) for i in range(self.n_slots)]
+
+        for _, offset, size_key, _ in slots:
+            if offset in {self.OFFSET_EMPTY, self.OFFSET_DELETED}:
+                continue
+            yield pickle.loads(buf[offset:offset + size_key])
+
+    def __len__(self):
+        return self._header()[4]
+
+    def metrics(self):
+        _, n_slots, size_arena, used_arena, count, deleted, _ = self._header()
+        return {self.Field.NAME: self.shm.name,
+                self.Field.COUNT: count,
+                self.Field.SLOTS: n_slots,
+                self.Field.SLOTS_DELETED: deleted,
+                self.Field.BYTES_ARENA: size_arena,
+                self.Field.BYTES_USED: used_arena,
+                self.Field.SLOTS_LOAD: (count + deleted) / (n_slots * self.LOAD_FACTOR_MAX),
+                self.Field.ARENA_LOAD: used_arena / size_arena,
+                self.Field.SETS_REJECTED: self.sets_rejected,
+                }
+
+    def close(self):
+        """
+        values still holding zero-copy views keep the block mapped; close() raises BufferError until they are gone
+        """
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
@@ -0,0 +1,69 @@
+import threading
+
+
+class SingleFlight:
+    """
+    Per-key duplicate call suppression for thread pools: while one caller computes a key,
+    the other callers of the same key wait for its result instead of computing it again.
+
+    The in-flight table is split into stripes, each guarded by its own lock,
+    so callers of unrelated keys rarely contend. The stripe locks are held only to look up the table,
+    never while computing.
+    """
+
+    class TimeoutError(TimeoutError):
+        pass
+
+    class _Call:
+        def __init__(self):
+            self.event = threading.Event()
+            self.thread_id = threading.get_ident()
+            self.result = None
+            self.error = None
+
+    def __init__(self, stripes=64, timeout=None):
+        self.stripes = [(threading.Lock(), {}) for _ in range(stripes)]
+        self.timeout = timeout
+
+    def k2stripe(self, k):
+        return self.stripes[hash(k) % len(self.stripes)]
+
+    def count_inflight(self):
+        return sum(len(h_k2call) for _, h_k2call in self.stripes)
+
+    def run(self, k, f, timeout=None):
+        """
+        f() computed once for concurrent callers of k.
+        waiters get the result, or the error raised by the computing caller.
+        a waiter raises SingleFlight.TimeoutError after timeout seconds, while the computation goes on.
+        """
+        lock, h_k2call = self.k2stripe(k)
+
+        with lock:
+            call = h_k2call.get(k)
+            is_leader = call is None
+            if is_leader:
+                call = h_k2call[k] = self._Call()
+
+        if not is_leader:
+            if call.thread_id == threading.get_ident():
+                return f()  # reentrant call, e.g. recursion. waiting for ourselves would deadlock
+
+            timeout = timeout if timeout is not None else self.timeout
+            if not call.event.wait(timeout):
+                raise self.TimeoutError({"k": k, "timeout": timeout})
+
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = f()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with lock:
+                del h_k2call[k]
+            call.event.set()
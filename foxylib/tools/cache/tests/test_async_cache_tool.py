@@ -0,0 +1,162 @@
+import asyncio
+import logging
+from threading import RLock
+from unittest import TestCase
+
+from cachetools import LRUCache
+
+from foxylib.tools.cache.cache_decorator import CacheDecorator
+from foxylib.tools.cache.cache_manager import CacheManager
+from foxylib.tools.log.foxylib_logger import FoxylibLogger
+
+
+class TestAsyncCacheTool(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        FoxylibLogger.attach_stderr2loggers(logging.DEBUG)
+
+    def test_01(self):
+        """
+        concurrent misses of one key -> one call
+        """
+        calls = []
+
+        @CacheManager.attach_cached_async(cache=LRUCache(maxsize=10))
+        async def f(x):
+            calls.append(x)
+            await asyncio.sleep(0.01)
+            return x * 2
+
+        async def run():
+            return await asyncio.gather(*[f(1) for _ in range(10)], f(2))
+
+        self.assertEqual(asyncio.run(run()), [2] * 10 + [4])
+        self.assertEqual(calls, [1, 2])
+
+        # cached across event loops
+        self.assertEqual(asyncio.run(f(1)), 2)
+        self.assertEqual(calls, [1, 2])
+
+        CacheManager.delete_key(f, args=[1])
+        CacheManager.add2cache(f, 7, args=[3])
+        self.assertEqual(asyncio.run(f(3)), 7)
+        self.assertEqual(asyncio.run(f(1)), 2)
+        self.assertEqual(calls, [1, 2, 1])
+
+    def test_02(self):
+        """
+        errors reach every waiter and are not cached
+        """
+        calls = []
+
+        @CacheManager.attach_cached_async(cache=LRUCache(maxsize=10), lock=RLock())
+        async def f(x):
+            calls.append(x)
+            await asyncio.sleep(0.01)
+            if len(calls) == 1:
+                raise ValueError(x)
+            return x
+
+        async def run():
+            return await asyncio.gather(*[f(1) for _ in range(3)], return_exceptions=True)
+
+        results = asyncio.run(run())
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+
+        self.assertEqual(asyncio.run(run()), [1, 1, 1])
+        self.assertEqual(calls, [1, 1])
+
+    def test_03(self):
+        """
+        cancelling one waiter doesn't cancel the others. cancelling all waiters cancels the call.
+        """
+        calls = []
+        h_cancelled = {}
+
+        @CacheManager.attach_cached_async(cache=LRUCache(maxsize=10))
+        async def f(x):
+            calls.append(x)
+            try:
+                await asyncio.sleep(0.05)
+            except asyncio.CancelledError:
+                h_cancelled[x] = True
+                raise
+            return x
+
+        async def run_partial():
+            t1, t2 = asyncio.ensure_future(f(1)), asyncio.ensure_future(f(1))
+            await asyncio.sleep(0.01)
+            t1.cancel()
+            return await t2, t1.cancelled()
+
+        self.assertEqual(asyncio.run(run_partial()), (1, True))
+        self.assertEqual(calls, [1])
+
+        async def run_all():
+            t1, t2 = asyncio.ensure_future(f(2)), asyncio.ensure_future(f(2))
+            await asyncio.sleep(0.01)
+            t1.cancel()
+            t2.cancel()
+            await asyncio.gather(t1, t2, return_exceptions=True)
+            await asyncio.sleep(0.01)
+
+        asyncio.run(run_all())
+        self.assertEqual(h_cancelled, {2: True})
+
+        # not cached, so the next call runs again
+        self.assertEqual(asyncio.run(f(2)), 2)
+        self.assertEqual(calls, [1, 2, 2])
+
+    class TestClass:
+        def __init__(self):
+            self.calls = []
+
+        @CacheManager.attach_cachedmethod_async(self2cache=lambda x: LRUCache(maxsize=10), lock=lambda x: RLock())
+        async def func(self, x):
+            self.calls.append(x)
+            await asyncio.sleep(0.01)
+            return x + 1
+
+    def test_04(self):
+        cls = self.__class__
+        obj1, obj2 = cls.TestClass(), cls.TestClass()
+
+        async def run():
+            return await asyncio.gather(*[obj1.func(1) for _ in range(5)], obj2.func(1))
+
+        self.assertEqual(asyncio.run(run()), [2] * 6)
+        self.assertEqual(obj1.calls, [1])
+        self.assertEqual(obj2.calls, [1])
+
+        self.assertIn((1,), CacheManager.callable2cache(obj1.func))
+
+        CacheManager.add2cache(obj1.func, 10, args=[5])
+        self.assertEqual(asyncio.run(obj1.func(5)), 10)
+        self.assertEqual(obj1.calls, [1])
+
+    def test_05(self):
+        """
+        cached_each_async(): one batch call for the missing keys, duplicates and in-flight keys shared
+        """
+        batches = []
+
+        @CacheDecorator.cached_each_async(LRUCache(maxsize=100), [0])
+        async def f_batch(xs, y):
+            batches.append(list(xs))
+            await asyncio.sleep(0.01)
+            return [x * y for x in xs]
+
+        async def run():
+            return await asyncio.gather(f_batch([1, 2, 2, 3], 10),
+                                        f_batch([3, 4], 10),
+                                        )
+
+        self.assertEqual(asyncio.run(run()), [[10, 20, 20, 30], [30, 40]])
+        self.assertEqual(batches, [[1, 2, 3], [4]])
+
+        self.assertEqual(asyncio.run(f_batch([4, 1, 5], 10)), [40, 10, 50])
+        self.assertEqual(batches, [[1, 2, 3], [4], [5]])
+
+        # different kwargs -> different keys
+        self.assertEqual(asyncio.run(f_batch([1], y=2)), [2])
+        self.assertEqual(batches[-1], [1])
@@ -1,6 +1,8 @@
 import logging
 import sys
+import time
 from functools import lru_cache
+from threading import RLock
 from unittest import TestCase
 
 from cachetools import LRUCache, cachedmethod
@@ -80,3 +82,83 @@ class TestCacheManager(TestCase):
 
         CacheManager.add2cache(obj2.func2, 5, args=[])
         self.assertEqual(obj2.func2(), 5)
+
+    class TestClassLocked:
+        def __init__(self):
+            self.lock = RLock()
+            self.count = 0
+
+        @CacheManager.attach_cachedmethod(self2cache=lambda x: LRUCache(maxsize=10), lock=lambda x: x.lock)
+        def func1(self, x):
+            self.count += 1
+            return x * 2
+
+        @classmethod
+        @CacheManager.attach_cachedmethod(self2cache=lambda x: LRUCache(maxsize=10), )
+        def func2(cls, x):
+            return [x]
+
+    def test_03(self):
+        cls = self.__class__
+
+        obj = cls.TestClassLocked()
+        CacheManager.add2cache(obj.func1, 100, args=[1])  # before the first call
+        self.assertEqual(obj.func1(1), 100)
+        self.assertEqual(obj.func1(2), 4)
+        self.assertEqual(obj.count, 1)
+
+        CacheManager.delete_key(obj.func1, args=[2])
+        self.assertEqual(obj.func1(2), 4)
+        self.assertEqual(obj.count, 2)
+
+        with CacheManager.update_cache(obj.func1, 7, args=[3]):
+            self.assertNotIn((3,), CacheManager.callable2cache(obj.func1))
+        self.assertEqual(obj.func1(3), 7)
+
+        # classmethod: one cache per class
+        self.assertIs(cls.TestClassLocked.func2(1), cls.TestClassLocked.func2(1))
+        self.assertIn((1,), CacheManager.callable2cache(cls.TestClassLocked.func2))
+
+    def test_04(self):
+        """
+        benchmark: hit latency against functools.lru_cache
+        """
+        logger = FoxylibLogger.func_level2logger(self.test_04, logging.DEBUG)
+
+        class Legacy:
+            # cachedmethod() wrapper built on every call, as the decorator used to do
+            def __init__(self):
+                self.cache = LRUCache(maxsize=2)
+
+            def func(self, x):
+                f_with_cache = cachedmethod(lambda _: self.cache)(Legacy.func_raw)
+                return f_with_cache(self, x)
+
+            def func_raw(self, x):
+                return x
+
+        class Compiled:
+            @CacheManager.attach_cachedmethod(self2cache=lambda x: LRUCache(maxsize=2), )
+            def func(self, x):
+                return x
+
+        class LruCached:
+            @lru_cache(maxsize=2)
+            def func(self, x):
+                return x
+
+        n = 100000
+
+        def obj2secs(obj):
+            obj.func(1)
+            time_start = time.perf_counter()
+            for _ in range(n):
+                obj.func(1)
+            return (time.perf_counter() - time_start) / n
+
+        h = {"usecs cachedmethod per call": obj2secs(Legacy()) * 1e6,
+             "usecs attach_cachedmethod": obj2secs(Compiled()) * 1e6,
+             "usecs lru_cache": obj2secs(LruCached()) * 1e6,
+             }
+        logger.info(h)
+        self.assertLess(h["usecs attach_cachedmethod"], h["usecs cachedmethod per call"])
@@ -0,0 +1,133 @@
+import logging
+import time
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+import pytz
+from cachetools import LRUCache
+
+from foxylib.tools.cache.cache_decorator import CacheDecorator
+from foxylib.tools.cache.cache_manager import CacheManager
+from foxylib.tools.cache.cache_registry import CacheRegistry, CacheStats
+from foxylib.tools.cache.datetimed_cache.datetimed_cache import DatetimedCache
+from foxylib.tools.log.foxylib_logger import FoxylibLogger
+
+
+class TestCacheRegistry(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        FoxylibLogger.attach_stderr2loggers(logging.DEBUG)
+
+    def test_01(self):
+        @CacheManager.attach_cached(cache=LRUCache(maxsize=2))
+        def f(x):
+            return x
+
+        for x in [1, 2, 1, 3, 1, 2]:
+            f(x)
+
+        h = CacheRegistry.snapshot()[CacheRegistry.func2name(f)]
+        self.assertEqual(h[CacheStats.Field.CALLS], 6)
+        self.assertEqual(h[CacheStats.Field.HITS], 2)  # 1, 1
+        self.assertEqual(h[CacheStats.Field.MISSES], 4)
+        self.assertEqual(h[CacheStats.Field.EVICTIONS], 2)
+        self.assertEqual(h[CacheStats.Field.SIZE], 2)
+        self.assertEqual(h[CacheStats.Field.MAXSIZE], 2)
+        self.assertEqual(h[CacheStats.Field.LATENCY]["count"], 4)
+
+        text = CacheRegistry.snapshot2prometheus()
+        label = 'name="{}"'.format(CacheRegistry.func2name(f))
+        self.assertIn("foxylib_cache_hits_total{{{}}} 2".format(label), text)
+        self.assertIn('foxylib_cache_compute_seconds_bucket{{{},le="+Inf"}} 4'.format(label), text)
+        self.assertIn("foxylib_cache_compute_seconds_count{{{}}} 4".format(label), text)
+
+        logline = CacheRegistry.snapshot2logline()
+        self.assertIn("{}(hits=2 misses=4 hit_ratio=0.333 evictions=2 size=2/2".format(CacheRegistry.func2name(f)),
+                      logline)
+
+    class A:
+        @CacheManager.attach_cachedmethod(self2cache=lambda x: LRUCache(maxsize=10))
+        def f(self, x):
+            return x
+
+        @CacheDecorator.cachedmethod_each(lambda x: x.cache_each, [1])
+        def f_batch(self, xs):
+            return list(xs)
+
+        def __init__(self):
+            self.cache_each = LRUCache(maxsize=10)
+
+    def test_02(self):
+        cls = self.__class__
+        a1, a2 = cls.A(), cls.A()
+        a1.f(1), a1.f(1), a2.f(1)
+
+        h = CacheRegistry.snapshot()[CacheRegistry.func2name(cls.A.f)]
+        self.assertEqual(h[CacheStats.Field.CALLS], 3)
+        self.assertEqual(h[CacheStats.Field.HITS], 1)
+        self.assertEqual(h[CacheStats.Field.SIZE], 2)
+        self.assertEqual(h[CacheStats.Field.CACHES], 2)
+
+        a1.f_batch([1, 2, 3])
+        a1.f_batch([2, 3, 4])
+        h = CacheRegistry.snapshot()[CacheRegistry.func2name(cls.A.f_batch)]
+        self.assertEqual(h[CacheStats.Field.CALLS], 6)
+        self.assertEqual(h[CacheStats.Field.MISSES], 4)
+        self.assertEqual(h[CacheStats.Field.LATENCY]["count"], 2)
+
+        # instances gone -> caches gone
+        del a1, a2
+        h = CacheRegistry.snapshot()[CacheRegistry.func2name(cls.A.f)]
+        self.assertEqual(h[CacheStats.Field.CACHES], 0)
+
+        # per-instance dicts can't be weak-referenced, so they are not held at all
+        stats = CacheStats("dict")
+        cache_shared, cache_each = {}, {}
+        stats.cache2registered(cache_shared)
+        stats.self2cache2registered(lambda owner: cache_each)(None)
+        self.assertEqual(len(stats.caches()), 1)
+        self.assertIs(stats.caches()[0], cache_shared)
+
+    def test_03(self):
+        @DatetimedCache.Decorator.cached(cache=LRUCache(10), f_pivot=lambda p, *_, **__: p,
+                                         key=lambda p, x, *_, **__: x)
+        def f(dt_pivot, x):
+            return x
+
+        dt_01 = datetime.now(pytz.utc)
+        f(dt_01, 1), f(dt_01, 1), f(dt_01 + timedelta(seconds=1), 1)
+
+        h = CacheRegistry.snapshot()[CacheRegistry.func2name(f)]
+        self.assertEqual((h[CacheStats.Field.HITS], h[CacheStats.Field.MISSES]), (1, 2))
+
+    def test_04(self):
+        """
+        overhead per cache hit
+        """
+        logger = FoxylibLogger.func_level2logger(self.test_04, logging.DEBUG)
+
+        def f_cached():
+            @CacheManager.attach_cached(cache=LRUCache(maxsize=10))
+            def f(x):
+                return x
+            return f
+
+        n = 100000
+
+        def f2secs(f):
+            f(1)
+            time_start = time.perf_counter()
+            for _ in range(n):
+                f(1)
+            return (time.perf_counter() - time_start) / n
+
+        CacheRegistry.enabled = False
+        try:
+            secs_off = f2secs(f_cached())
+        finally:
+            CacheRegistry.enabled = True
+        secs_on = f2secs(f_cached())
+
+        logger.info({"secs per hit (off)": secs_off, "secs per hit (on)": secs_on,
+                     "overhead": secs_on - secs_off})
+        self.assertLess(secs_on - secs_off, 2e-6)
@@ -1,9 +1,21 @@
+import json
 import logging
+import random
 import sys
+import time
+import weakref
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
+from itertools import chain
+from threading import RLock, Lock
 from unittest import TestCase
 
+from cachetools import LRUCache
+
+from foxylib.tools.cache.cache_decorator import CacheDecorator
+from foxylib.tools.cache.cache_manager import CacheManager
+from foxylib.tools.cache.cache_tool import CacheTool
 from foxylib.tools.log.foxylib_logger import FoxylibLogger
 
 
@@ -58,3 +70,195 @@ class TestNative(TestCase):
         """
         self.assertEqual(c1.f(1), 2)
         self.assertEqual(c1.call_count, {1: 2, })  # 1's call_count is 2. cache fail!
+
+
+class CountingLock:
+    def __init__(self):
+        self.lock = RLock()
+        self.count = 0
+
+    def __enter__(self):
+        self.count += 1
+        return self.lock.__enter__()
+
+    def __exit__(self, *args):
+        return self.lock.__exit__(*args)
+
+
+class TestCacheBatchTool(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        FoxylibLogger.attach_stderr2loggers(logging.DEBUG)
+
+    def test_01(self):
+        lock = CountingLock()
+        batches = []
+
+        @CacheDecorator.cached_each(LRUCache(maxsize=100), [0], lock=lock)
+        def f_batch(xs, y):
+            batches.append(list(xs))
+            return [x * y for x in xs]
+
+        self.assertEqual(f_batch([1, 2, 1, 3, 2], 10), [10, 20, 10, 30, 20])
+        self.assertEqual(batches, [[1, 2, 3]])
+        self.assertEqual(lock.count, 2)  # one multi-get, one multi-set
+
+        self.assertEqual(f_batch([3, 4, 4, 1], 10), [30, 40, 40, 10])
+        self.assertEqual(batches, [[1, 2, 3], [4]])
+        self.assertEqual(lock.count, 4)
+
+        self.assertEqual(f_batch([4, 4], 10), [40, 40])
+        self.assertEqual(lock.count, 5)  # all hits: no multi-set
+
+    def test_02(self):
+        """
+        bounded sub-batches in parallel. results valid even if the cache can't hold the whole batch
+        """
+        batches = []
+        lock_batches = Lock()
+
+        def f_batch(xs):
+            with lock_batches:
+                batches.append(list(xs))
+            return [-x for x in xs]
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            f = CacheDecorator.cached_each(LRUCache(maxsize=10), [0], chunk_size=3, executor=executor)(f_batch)
+            xs = [i % 10 for i in range(30)] + list(range(10, 20))
+            self.assertEqual(f(xs), [-x for x in xs])
+
+        self.assertEqual(sorted(chain.from_iterable(batches)), list(range(20)))
+        self.assertTrue(all(len(b) <= 3 for b in batches))
+
+    def test_03(self):
+        """
+        benchmark: 5k ids with heavy duplication
+        """
+        logger = FoxylibLogger.func_level2logger(self.test_03, logging.DEBUG)
+
+        xs = [i % 500 for i in range(5000)]
+        calls = Counter()
+
+        @CacheDecorator.cached_each(LRUCache(maxsize=10000), [0], lock=RLock())
+        def f_batch(xs):
+            calls.update(xs)
+            return [x + 1 for x in xs]
+
+        time_start = time.perf_counter()
+        f_batch(xs)
+        f_batch(xs)
+        secs = time.perf_counter() - time_start
+
+        logger.info({"secs": secs})
+        self.assertEqual(max(calls.values()), 1)
+        self.assertEqual(len(calls), 500)
+
+
+def payload2nested(rnd, size_bytes):
+    def node(depth):
+        if depth == 0 or rnd.random() < 0.3:
+            return rnd.choice([rnd.randint(0, 10 ** 6), "s{}".format(rnd.randint(0, 10 ** 6)), rnd.random(), None])
+        if rnd.random() < 0.5:
+            return [node(depth - 1) for _ in range(rnd.randint(1, 4))]
+        return {"k{}".format(rnd.randint(0, 100)): node(depth - 1) for _ in range(rnd.randint(1, 4))}
+
+    j = {"items": []}
+    while len(json.dumps(j)) < size_bytes:
+        j["items"].append(node(4))
+    return j
+
+
+class TestCacheToolJSON(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        FoxylibLogger.attach_stderr2loggers(logging.DEBUG)
+
+    def test_01(self):
+        fingerprint = CacheTool.JSON.fingerprint
+
+        self.assertEqual(fingerprint({"a": [1, 2], "b": {"c": None}}), fingerprint({"b": {"c": None}, "a": (1, 2)}))
+        self.assertEqual(len(fingerprint({"a": 1})), 16)
+        self.assertNotEqual(fingerprint({"a": [1, 2]}), fingerprint({"a": [2, 1]}))
+        self.assertNotEqual(fingerprint({"a": "1"}), fingerprint({"a": 1}))
+        self.assertNotEqual(fingerprint("1"), fingerprint(1))
+
+        # not canonical in JSON -> normalize()
+        self.assertEqual(fingerprint({"a": {1, 2}}), CacheTool.JSON.normalize({"a": {1, 2}}))
+
+    def test_02(self):
+        """
+        original arguments passed through, not copies
+        """
+        seen = []
+
+        @CacheTool.cache2hashable(cache=lru_cache(maxsize=10), f_pair=CacheTool.JSON.fingerprint_pair())
+        def f(j, n=None):
+            seen.append(j)
+            return len(j["a"])
+
+        j1 = {"a": [1, 2, 3], "b": {"x": 1}}
+        self.assertEqual(f(j1, n=1), 3)
+        self.assertIs(seen[0], j1)
+
+        self.assertEqual(f({"b": {"x": 1}, "a": [1, 2, 3]}, n=1), 3)
+        self.assertEqual(len(seen), 1)
+        self.assertEqual(f(j1, n=2), 3)
+        self.assertEqual(len(seen), 2)
+
+        # cache keys keep digests, not the arguments
+        class JDict(dict):  # weak-referenceable
+            pass
+
+        j_big = JDict(a=list(range(1000)))
+        j_ref = weakref.ref(j_big)
+        self.assertEqual(f(j_big), 1000)
+        seen.clear()
+        del j_big
+        self.assertIsNone(j_ref())
+
+        calls = []
+
+        @CacheManager.attach_cached(cache=LRUCache(maxsize=10), key=CacheTool.JSON.fingerprint_key)
+        def g(j1, j2):
+            calls.append(1)
+            return j1 is j2
+
+        self.assertTrue(g(j1, j1))
+        self.assertTrue(g(dict(j1), dict(j1)))
+        self.assertEqual(len(calls), 1)
+
+    def test_03(self):
+        """
+        benchmark: key building on nested 1KB and 10KB payloads
+        """
+        logger = FoxylibLogger.func_level2logger(self.test_03, logging.DEBUG)
+        rnd = random.Random(0)
+
+        for size_bytes in [1000, 10000]:
+            payloads = [payload2nested(rnd, size_bytes) for _ in range(20)]
+            n = 10
+
+            time_start = time.perf_counter()
+            for _ in range(n):
+                for j in payloads:
+                    CacheTool.JSON.normalize(j)
+            secs_normalize = (time.perf_counter() - time_start) / (n * len(payloads))
+
+            time_start = time.perf_counter()
+            for _ in range(n):
+                for j in payloads:
+                    CacheTool.JSON.serialize_dill(j)
+            secs_dill = (time.perf_counter() - time_start) / (n * len(payloads))
+
+            time_start = time.perf_counter()
+            for _ in range(n):
+                for j in payloads:
+                    CacheTool.JSON.fingerprint(j)
+            secs_fingerprint = (time.perf_counter() - time_start) / (n * len(payloads))
+
+            logger.info({"size_bytes": size_bytes,
+                         "secs normalize": secs_normalize,
+                         "secs serialize_dill": secs_dill,
+                         "secs fingerprint": secs_fingerprint,
+                         })
+            self.assertLess(secs_fingerprint, secs_normalize)
@@ -0,0 +1,139 @@
+import logging
+import os
+from unittest import TestCase
+
+import numpy as np
+from cachetools.keys import hashkey
+
+from foxylib.tools.cache.cache_manager import CacheManager
+from foxylib.tools.cache.shared_memory_cache import SharedMemoryCache
+from foxylib.tools.log.foxylib_logger import FoxylibLogger
+from foxylib.tools.process.process_tool import ProcessTool
+
+CACHE = None
+
+
+def x2cached(x):
+    return os.getpid(), CACHE[(x,)]
+
+
+def x2written(x):
+    CACHE[("worker", x)] = x * 10
+    return x
+
+
+class TestSharedMemoryCache(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        FoxylibLogger.attach_stderr2loggers(logging.DEBUG)
+
+    def test_01(self):
+        cache = SharedMemoryCache(n_slots=16, size_arena=2 ** 16)
+        try:
+            cache[hashkey("a")] = {"x": [1, 2]}
+            cache[("b", 1)] = "b"
+            cache[("b", 1)] = "b2"
+            cache[("c",)] = None
+            del cache[("c",)]
+
+            self.assertEqual(dict(cache), {("a",): {"x": [1, 2]}, ("b", 1): "b2"})
+            self.assertEqual(len(cache), 2)
+            self.assertNotIn(("c",), cache)
+            with self.assertRaises(KeyError):
+                cache[("c",)]
+
+            # deleted slot reused
+            cache[("c",)] = 3
+            self.assertEqual(cache.metrics()[SharedMemoryCache.Field.SLOTS_DELETED], 0)
+
+            # 16 slots * 0.75
+            with self.assertRaises(ValueError):
+                for i in range(20):
+                    cache[(i,)] = i
+            self.assertEqual(len(cache), 12)
+
+            with self.assertRaises(ValueError):
+                cache[("a",)] = b"x" * 2 ** 16
+            self.assertEqual(cache[("a",)], {"x": [1, 2]})
+
+            # space is not reclaimed: full shows in metrics()
+            h = cache.metrics()
+            self.assertEqual(h[SharedMemoryCache.Field.SLOTS_LOAD], 1)
+            self.assertEqual(h[SharedMemoryCache.Field.SETS_REJECTED], 2)
+            self.assertGreater(h[SharedMemoryCache.Field.ARENA_LOAD], 0)
+        finally:
+            cache.close()
+            cache.unlink()
+
+    def test_02(self):
+        """
+        numpy arrays come back as read-only views into the shared block
+        """
+        cache = SharedMemoryCache(n_slots=16, size_arena=2 ** 20)
+        try:
+            cache[("arr",)] = np.arange(1000, dtype=np.float64)
+
+            arr = cache[("arr",)]
+            self.assertEqual(arr.sum(), 499500)
+            self.assertFalse(arr.flags.writeable)
+            self.assertEqual(arr.ctypes.data % SharedMemoryCache.ALIGN, 0)
+
+            arr2 = cache[("arr",)]
+            self.assertEqual(arr.ctypes.data, arr2.ctypes.data)
+            del arr, arr2
+        finally:
+            cache.close()
+            cache.unlink()
+
+    def test_03(self):
+        """
+        pre-populated before fork, written by workers
+        """
+        global CACHE
+
+        CACHE = SharedMemoryCache(n_slots=256, size_arena=2 ** 20)
+        try:
+            for x in range(10):
+                CACHE[(x,)] = x * x
+
+            pool = ProcessTool.initializer2pool(processes=2)
+            try:
+                result_list = pool.map(x2cached, range(10))
+                self.assertEqual([v for _, v in result_list], [x * x for x in range(10)])
+                self.assertNotIn(os.getpid(), {pid for pid, _ in result_list})
+
+                pool.map(x2written, range(5))
+            finally:
+                pool.close()
+                pool.join()
+
+            self.assertEqual({CACHE[("worker", x)] for x in range(5)}, {0, 10, 20, 30, 40})
+
+            # attach by name, e.g. from a process not forked from the owner
+            cache_attached = SharedMemoryCache.attach(CACHE.name, CACHE.lock)
+            self.assertEqual(cache_attached[(3,)], 9)
+            cache_attached.close()
+        finally:
+            CACHE.close()
+            CACHE.unlink()
+            CACHE = None
+
+    def test_04(self):
+        cache = SharedMemoryCache(n_slots=16, size_arena=2 ** 16)
+        calls = []
+        try:
+            @CacheManager.attach_cached(cache=cache)
+            def f(x):
+                calls.append(x)
+                return [x] * 3
+
+            self.assertEqual(f(1), [1, 1, 1])
+            self.assertEqual(f(1), [1, 1, 1])
+            self.assertEqual(calls, [1])
+
+            CacheManager.delete_key(f, args=[1])
+            self.assertEqual(f(1), [1, 1, 1])
+            self.assertEqual(calls, [1, 1])
+        finally:
+            cache.close()
+            cache.unlink()
@@ -0,0 +1,161 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from unittest import TestCase
+
+import pytz
+from cachetools import LRUCache
+
+from foxylib.tools.cache.cache_manager import CacheManager
+from foxylib.tools.cache.datetimed_cache.datetimed_cache import DatetimedCache
+from foxylib.tools.cache.single_flight import SingleFlight
+from foxylib.tools.log.foxylib_logger import FoxylibLogger
+
+
+def run_concurrently(f, n):
+    barrier = threading.Barrier(n)
+
+    def f_each(i):
+        barrier.wait()
+        try:
+            return f(i)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=n) as executor:
+        return list(executor.map(f_each, range(n)))
+
+
+class TestSingleFlight(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        FoxylibLogger.attach_stderr2loggers(logging.DEBUG)
+
+    def test_01(self):
+        single_flight = SingleFlight(stripes=4)
+        calls = []
+
+        def f():
+            calls.append(1)
+            time.sleep(0.05)
+            return "a"
+
+        self.assertEqual(run_concurrently(lambda i: single_flight.run("k", f), 8), ["a"] * 8)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(single_flight.count_inflight(), 0)
+
+    def test_02(self):
+        """
+        waiters get the error of the computing caller. nothing is left in flight.
+        """
+        single_flight = SingleFlight()
+        calls = []
+
+        def f():
+            calls.append(1)
+            time.sleep(0.05)
+            raise ValueError("failed")
+
+        results = run_concurrently(lambda i: single_flight.run("k", f), 5)
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+        self.assertEqual(len(calls), 1)
+
+        self.assertEqual(single_flight.run("k", lambda: "b"), "b")
+
+    def test_03(self):
+        """
+        timeout on waiters. reentrant calls don't deadlock.
+        """
+        single_flight = SingleFlight(timeout=0.01)
+
+        def f_slow(i):
+            if i == 0:
+                return single_flight.run("k", lambda: time.sleep(0.2) or "slow")
+            time.sleep(0.05)
+            return single_flight.run("k", lambda: "fast")
+
+        results = run_concurrently(f_slow, 3)
+        self.assertEqual(results[0], "slow")
+        self.assertTrue(all(isinstance(r, SingleFlight.TimeoutError) for r in results[1:]))
+
+        def f_recursive(n):
+            return single_flight.run("r", lambda: n if n == 0 else f_recursive(n - 1) + 1)
+
+        self.assertEqual(f_recursive(3), 3)
+
+    def test_04(self):
+        single_flight = SingleFlight()
+        calls = []
+
+        @CacheManager.attach_cached(cache=LRUCache(maxsize=10), lock=threading.RLock(), single_flight=single_flight)
+        def f(x):
+            calls.append(x)
+            time.sleep(0.05)
+            return x * 2
+
+        self.assertEqual(run_concurrently(lambda i: f(i % 2), 8), [0, 2] * 4)
+        self.assertEqual(sorted(calls), [0, 1])
+        self.assertEqual(f(1), 2)
+        self.assertEqual(len(calls), 2)
+
+        CacheManager.add2cache(f, 5, args=[7])
+        self.assertEqual(f(7), 5)
+
+    class TestClass:
+        def __init__(self):
+            self.calls = []
+
+        @CacheManager.attach_cachedmethod(self2cache=lambda x: LRUCache(maxsize=10), single_flight=SingleFlight())
+        def func(self, x):
+            self.calls.append(x)
+            time.sleep(0.05)
+            return x + 1
+
+    def test_05(self):
+        cls = self.__class__
+        obj1, obj2 = cls.TestClass(), cls.TestClass()
+
+        self.assertEqual(run_concurrently(lambda i: (obj1, obj2)[i % 2].func(1), 8), [2] * 8)
+        self.assertEqual(obj1.calls, [1])
+        self.assertEqual(obj2.calls, [1])
+        self.assertIn((1,), CacheManager.callable2cache(obj1.func))
+
+    def test_06(self):
+        single_flight = SingleFlight()
+        calls = []
+
+        @DatetimedCache.Decorator.cached(cache=LRUCache(10), f_pivot=lambda p, *_, **__: p,
+                                         key=lambda p, x, *_, **__: x, single_flight=single_flight)
+        def f(dt_pivot, x):
+            calls.append(x)
+            time.sleep(0.05)
+            return x
+
+        dt_pivot = datetime.now(pytz.utc)
+        self.assertEqual(run_concurrently(lambda i: f(dt_pivot, 1), 6), [1] * 6)
+        self.assertEqual(calls, [1])
+
+        # newer pivot -> outdated -> recomputed once
+        dt_pivot = datetime.now(pytz.utc)
+        self.assertEqual(run_concurrently(lambda i: f(dt_pivot, 1), 6), [1] * 6)
+        self.assertEqual(calls, [1, 1])
+
+    def test_07(self):
+        """
+        flights are keyed by the cache's key function, so unhashable args work
+        """
+        single_flight = SingleFlight()
+        calls = []
+
+        @DatetimedCache.Decorator.cached(cache=LRUCache(10), f_pivot=lambda p, *_, **__: p,
+                                         key=lambda p, l, *_, **__: tuple(l), single_flight=single_flight)
+        def f(dt_pivot, l):
+            calls.append(list(l))
+            time.sleep(0.05)
+            return sum(l)
+
+        dt_pivot = datetime.now(pytz.utc)
+        self.assertEqual(run_concurrently(lambda i: f(dt_pivot, [1, 2]), 6), [3] * 6)
+        self.assertEqual(calls, [[1, 2]])
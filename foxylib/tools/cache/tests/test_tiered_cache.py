@@ -0,0 +1,114 @@
+import logging
+import os
+import tempfile
+from unittest import TestCase
+
+from cachetools.keys import hashkey
+
+from foxylib.tools.cache.cache_manager import CacheManager
+from foxylib.tools.cache.examplar.tiered_cache import SegmentFileCache, TieredCache, CacheSerializer
+from foxylib.tools.log.foxylib_logger import FoxylibLogger
+
+
+class TestSegmentFileCache(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        FoxylibLogger.attach_stderr2loggers(logging.DEBUG)
+
+    def test_01(self):
+        with tempfile.TemporaryDirectory() as dirpath:
+            filepath = os.path.join(dirpath, "cache", "segment.bin")
+
+            cache = SegmentFileCache(filepath)
+            cache[hashkey("a", 1)] = {"x": [1, 2]}
+            cache[hashkey("b")] = "b"
+            cache[hashkey("b")] = "b2"
+            del cache[hashkey("a", 1)]
+            cache[("c",)] = None
+            cache.close()
+
+            # reopened: index rebuilt from the file
+            cache = SegmentFileCache(filepath)
+            self.assertEqual(dict(cache), {("b",): "b2", ("c",): None})
+            self.assertNotIn(("a", 1), cache)
+            with self.assertRaises(KeyError):
+                del cache[("a", 1)]
+            cache.close()
+
+            # torn record at the end is dropped
+            with open(filepath, "ab") as f:
+                f.write(SegmentFileCache.record2bytes(b"garbage", b"value")[:-2])
+
+            cache = SegmentFileCache(filepath)
+            self.assertEqual(dict(cache), {("b",): "b2", ("c",): None})
+            cache[("d",)] = 1
+            cache.close()
+
+            self.assertEqual(dict(SegmentFileCache(filepath)), {("b",): "b2", ("c",): None, ("d",): 1})
+
+    def test_02(self):
+        """
+        size limit and compaction
+        """
+        with tempfile.TemporaryDirectory() as dirpath:
+            filepath = os.path.join(dirpath, "segment.json")
+            cache = SegmentFileCache(filepath, f_pair=CacheSerializer.json(),
+                                     max_bytes=100, compaction_min_bytes=0)
+
+            for i in range(50):
+                cache[(i,)] = "{:08d}".format(i)  # 10 bytes as json
+
+            self.assertLessEqual(cache.bytes_live, 100)
+            self.assertEqual(sorted(cache), [(i,) for i in range(40, 50)])
+            self.assertGreater(cache.compactions, 0)
+            self.assertLess(os.path.getsize(filepath), 1000)
+
+            with self.assertRaises(ValueError):
+                cache[("large",)] = "x" * 200
+
+            cache.compact()
+            self.assertEqual(cache[(45,)], "00000045")
+            cache.close()
+
+            cache = SegmentFileCache(filepath, f_pair=CacheSerializer.json())
+            self.assertEqual(sorted(cache), [(i,) for i in range(40, 50)])
+            self.assertEqual(cache.metrics()[SegmentFileCache.Field.BYTES_FILE], os.path.getsize(filepath))
+            cache.close()
+
+
+class TestTieredCache(TestCase):
+    def test_01(self):
+        with tempfile.TemporaryDirectory() as dirpath:
+            filepath = os.path.join(dirpath, "segment.dill")
+            calls = []
+
+            def f_cached():
+                cache = TieredCache(SegmentFileCache(filepath, f_pair=CacheSerializer.dill()), maxsize=2)
+
+                @CacheManager.attach_cached(cache=cache)
+                def f(x):
+                    calls.append(x)
+                    return lambda: x * 2
+
+                return f, cache
+
+            f, cache = f_cached()
+            self.assertEqual([f(x)() for x in [1, 2, 3, 1]], [2, 4, 6, 2])
+            self.assertEqual(calls, [1, 2, 3])
+            self.assertEqual(cache.metrics()[TieredCache.Field.HITS_DISK], 1)  # 1 was evicted from memory
+            cache.disk.close()
+
+            # "restart": served from disk, then from memory
+            f, cache = f_cached()
+            self.assertEqual([f(x)() for x in [3, 3]], [6, 6])
+            self.assertEqual(calls, [1, 2, 3])
+            self.assertEqual(cache.metrics(), {TieredCache.Field.HITS_MEMORY: 1,
+                                               TieredCache.Field.HITS_DISK: 1,
+                                               TieredCache.Field.MISSES: 0,
+                                               })
+
+            CacheManager.delete_key(f, args=[3])
+            self.assertNotIn((3,), cache.disk)
+            self.assertEqual(f(3)(), 6)
+            self.assertEqual(calls, [1, 2, 3, 3])
+            cache.disk.close()
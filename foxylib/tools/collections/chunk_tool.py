@@ -1,9 +1,12 @@
+import asyncio
+import inspect
 import logging
+import time
+from collections import deque
 from functools import reduce
-from operator import itemgetter as ig
 
-from future.utils import lmap, lfilter
-from nose.tools import assert_true, assert_not_in, assert_false, assert_not_equal, assert_in
+from future.utils import lmap
+from nose.tools import assert_true, assert_equal
 
 from foxylib.tools.collections.iter_tool import IterTool
 from foxylib.tools.log.foxylib_logger import FoxylibLogger
@@ -159,173 +162,303 @@ class ChunkTool:
 
 
 class BatchPoolTool:
+    """
+    cascading batch lookups, e.g. cache, then local DB, then remote API, each tier seeing only what the ones
+    before it could not resolve.
+
+    rich item: (b, x, y). b: resolved, x: input, y: output.
+    f_batch(x_list) -> [(b, y), ...] of the same length. the last tier's answer is final, resolved or not.
+
+    every tier keeps a bounded buffer and yields in input order. a tier calls f_batch when
+    - chunk_size of its items are unresolved,
+    - its buffer holds buffer_size items,
+    - its oldest unresolved item has waited `timeout` seconds (sync: checked as items arrive), or
+    - its input ends.
+    """
+
+    class Reason:
+        CHUNK = "chunk"
+        BUFFER = "buffer"
+        TIMEOUT = "timeout"
+        END = "end"
+
+    class TierStats:
+        """
+        items_in: items sent to f_batch. resolved: items it resolved. passed: items resolved by an earlier tier
+        batches_<reason>: f_batch calls by what triggered them, see Reason
+        """
+
+        class Field:
+            NAME = "name"
+            ITEMS_IN = "items_in"
+            RESOLVED = "resolved"
+            UNRESOLVED = "unresolved"
+            PASSED = "passed"
+            RESOLVE_RATIO = "resolve_ratio"
+            BATCHES = "batches"
+            SECS_BUSY = "secs_busy"
+
+        def __init__(self, name):
+            self.name = name
+
+            self.items_in = 0
+            self.resolved = 0
+            self.passed = 0
+            self.secs_busy = 0.0
+            self.h_reason2batches = {reason: 0 for reason in [BatchPoolTool.Reason.CHUNK,
+                                                              BatchPoolTool.Reason.BUFFER,
+                                                              BatchPoolTool.Reason.TIMEOUT,
+                                                              BatchPoolTool.Reason.END]}
+
+        def to_dict(self):
+            h = {self.Field.NAME: self.name,
+                 self.Field.ITEMS_IN: self.items_in,
+                 self.Field.RESOLVED: self.resolved,
+                 self.Field.UNRESOLVED: self.items_in - self.resolved,
+                 self.Field.PASSED: self.passed,
+                 self.Field.RESOLVE_RATIO: self.resolved / self.items_in if self.items_in else None,
+                 self.Field.BATCHES: sum(self.h_reason2batches.values()),
+                 self.Field.SECS_BUSY: self.secs_busy,
+                 }
+            h.update({"{}_{}".format(self.Field.BATCHES, reason): count
+                      for reason, count in self.h_reason2batches.items()})
+            return h
+
+        @classmethod
+        def size2list(cls, size):
+            return [cls("tier{}".format(j)) for j in range(size)]
+
+    class Buffer:
+        """
+        order-preserving buffer of one tier. O(1) amortized per item.
+        entry: [b, x, y, is_done], is_done once resolved before, or once through f_batch
+        """
+
+        def __init__(self, buffer_size, chunk_size, timeout=None, stats=None):
+            self.buffer_size = buffer_size
+            self.chunk_size = chunk_size
+            self.timeout = timeout
+            self.stats = stats if stats is not None else BatchPoolTool.TierStats(None)
+
+            self.entries = deque()
+            self.pending = deque()  # (entry, time appended) of unresolved entries, oldest first
+
+        def __bool__(self):
+            return bool(self.entries)
+
+        def append(self, rich_item, time_now):
+            b, x, y = rich_item
+            entry = [b, x, y, b]
+            self.entries.append(entry)
+
+            if b:
+                self.stats.passed += 1
+            else:
+                self.pending.append((entry, time_now))
+
+        def time2deadline(self):
+            if self.timeout is None or not self.pending:
+                return None
+            return self.pending[0][1] + self.timeout
+
+        def time2reason(self, time_now):
+            """
+            why f_batch should run now. None if it should not
+            """
+            if len(self.pending) >= self.chunk_size:
+                return BatchPoolTool.Reason.CHUNK
+
+            if not self.pending:
+                return None
+
+            if len(self.entries) >= self.buffer_size:
+                return BatchPoolTool.Reason.BUFFER
+
+            time_deadline = self.time2deadline()
+            if time_deadline is not None and time_now >= time_deadline:
+                return BatchPoolTool.Reason.TIMEOUT
+
+            return None
+
+        def chunk2popped(self, reason):
+            n = min(self.chunk_size, len(self.pending))
+            self.stats.h_reason2batches[reason] += 1
+            self.stats.items_in += n
+            return [self.pending.popleft()[0] for _ in range(n)]
+
+        def chunk_bys2done(self, chunk, by_list, secs):
+            self.stats.secs_busy += secs
+            for entry, (b, y) in zip_strict(chunk, list(by_list)):
+                entry[0], entry[2], entry[3] = b, y, True
+                if b:
+                    self.stats.resolved += 1
+
+        def ready2popped(self):
+            while self.entries and self.entries[0][3]:
+                b, x, y, _ = self.entries.popleft()
+                yield b, x, y
+
+    @classmethod
+    def tier2tuple(cls, tier):
+        """
+        (f_batch, chunk_size) or (f_batch, chunk_size, timeout)
+        """
+        f_batch, chunk_size, *rest = tier
+        timeout = list2singleton(rest) if rest else None
+        return f_batch, chunk_size, timeout
+
     @classmethod
-    @VersionTool.inactive
     def iter2richiter_init(cls, iter):
         for x in iter:
             yield (False, x, None)
 
     @classmethod
-    @VersionTool.inactive
-    def richiter_func_sizes2richiter(cls, rich_iter, f_batch, size_pair):
+    def richiter_func_sizes2richiter(cls, rich_iter, f_batch, size_pair, timeout=None, stats=None):
+        """
+        one tier. size_pair: (buffer_size, chunk_size)
+        """
         buffer_size, chunk_size = size_pair
+        buffer = cls.Buffer(buffer_size, chunk_size, timeout=timeout, stats=stats)
+
+        def reason2run(reason):
+            chunk = buffer.chunk2popped(reason)
+            time_start = time.perf_counter()
+            by_list = f_batch([entry[1] for entry in chunk])
+            buffer.chunk_bys2done(chunk, by_list, time.perf_counter() - time_start)
+            yield from buffer.ready2popped()
+
+        for rich_item in rich_iter:
+            if rich_item[0] and not buffer:
+                buffer.stats.passed += 1
+                yield rich_item
+                continue
 
-        def buffer2is_call_triggered(buffer):
-            if len(buffer) >= buffer_size:
-                return True
-
-            if IterTool.count(filter(ig(0), buffer)) >= chunk_size:
-                return True
-
-            return False
-
-        def buffer_chunksize2rich_iter(buffer, chunk_size):
-            i_list_invalid = lfilter(lambda i: not buffer[i][0], range(len(buffer)))
-            i_list_target = i_list_invalid[:chunk_size]
-            p = i_list_target[-1] + 1
-
-            x_list_part = lmap(lambda i: buffer[i][1], i_list_target)
-            by_list_part = f_batch(x_list_part)
-
-            h_i2by = {i: by_list_part[k] for k, i in enumerate(i_list_target)}
-
-            l_out = []
-            for i in range(p):
-                if buffer[i][0]:
-                    l_out.append( buffer[i] )
-                else:
-                    b, y = h_i2by[i]
-                    x = buffer[i][1]
-                    l_out.append( (b, x, y) )
-            return p, l_out
-
-
-        buffer = []
-        for b,x,y in rich_iter:
-            if b and not buffer:
-                yield (b,x,y)
+            time_now = time.monotonic()
+            buffer.append(rich_item, time_now)
 
-            buffer.append( (b, x, y) )
+            reason = buffer.time2reason(time_now)
+            while reason is not None:
+                yield from reason2run(reason)
+                reason = buffer.time2reason(time_now)
 
-            while buffer2is_call_triggered(buffer):
-                p, l_out = buffer_chunksize2rich_iter(buffer, chunk_size)
-                yield from l_out
+            yield from buffer.ready2popped()
 
-                buffer = buffer[p:]
+        while buffer.pending:
+            yield from reason2run(cls.Reason.END)
 
+        yield from buffer.ready2popped()
 
     @classmethod
-    @VersionTool.inactive
-    def iter2backoff_batches(cls, iter, batch_chunksize_list, buffer_size):
-        logger = FoxylibLogger.func_level2logger(cls.iter2backoff_batches, logging.DEBUG)
-
-        n = buffer_size
+    def iter2backoff_batches(cls, iter, batch_chunksize_list, buffer_size, stats_list=None):
+        """
+        outputs y for each x, in order, trying the tiers of batch_chunksize_list in turn.
+        tier: (f_batch, chunk_size) or (f_batch, chunk_size, timeout). at most buffer_size items held per tier.
+        stats_list: TierStats per tier, e.g. from TierStats.size2list()
+        """
         m = len(batch_chunksize_list)
+        assert_true(m)
+        if stats_list is not None:
+            assert_equal(len(stats_list), m)
 
-        queue_list = [[] for _ in range(m)]
-        h_i2j = {}
-        h_i2out = {}
-        buffer_in = [None] * (n+1)
-
-
-        # f_batch_list = lmap(ig(0), batch_chunksize_list)
-        # chunksize_list = lmap(ig(1), batch_chunksize_list)
-
-
-        def i2next(i): return (i+1) % (n+1)
-
-        def append2j(i,j):
-            h_i2j[i] = j
-            queue_list[j].append(i)
-
-        def iy2out(i,y):
-            h_i2out[i] = y
-            h_i2j.pop(i)
-
-        def i2j_new(i, j_old):
-            j_new = j_old +1
-            h_i2j[i] = j_new
-            queue_list[j_new].append(i)
-
-        def j2batch(j):
-
-            if not queue_list[j]:
-                return
+        rich_iter = cls.iter2richiter_init(iter)
+        for j, tier in enumerate(batch_chunksize_list):
+            f_batch, chunk_size, timeout = cls.tier2tuple(tier)
+            rich_iter = cls.richiter_func_sizes2richiter(rich_iter, f_batch, (buffer_size, chunk_size),
+                                                         timeout=timeout,
+                                                         stats=stats_list[j] if stats_list else None)
 
-            f_batch, chunksize = batch_chunksize_list[j]
+        for b, x, y in rich_iter:
+            yield y
 
-            i_list = queue_list[j][:chunksize]
-            queue_list[j] = queue_list[j][chunksize:]
-
-            x_list = [buffer_in[i] for i in i_list]
-            by_list = f_batch(x_list)
-
-            if j == m-1:
-                ix_list = [(i, buffer_in[i])
-                           for i, (b, y) in zip_strict(i_list, by_list)
-                           if not b]
-                assert_false(ix_list)
-
-            for i,(b,y) in zip_strict(i_list,by_list):
-                if b:
-                    iy2out(i,y)
-                else:
-                    i2j_new(i,j)
-
-            logger.debug({"step": "j2batch", "j": j,  "h_i2out":h_i2out, "h_i2j":h_i2j,})
-
-        def i2yield(i):
-
-
-            assert_in(i, h_i2out)
-            assert_not_in(i, h_i2j)
-
-            y = h_i2out.pop(i)
-
-            logger.debug({"step": "i2yield", "i": i, "y":y})
-            return y
-
-
-        i_head = -1
-        i_tail = -1
-        for x in iter:
-            i_head = i2next(i_head)
-            logger.debug({"i_head":i_head})
-
-            assert_not_in(i_head, h_i2j)
-            buffer_in[i_head] = x
-
-            append2j(i_head, 0)
-
-            if len(h_i2j) + len(h_i2out)<n:
-                continue
-
-            i_tail = i2next(i_tail)
-            logger.debug({"i_tail": i_tail, "h_i2j":h_i2j, "h_i2out":h_i2out,})
+    @classmethod
+    async def arichiter_func_sizes2arichiter(cls, rich_iter, f_batch, size_pair, timeout=None, stats=None):
+        """
+        async richiter_func_sizes2richiter(). f_batch may be a coroutine function.
+        timeouts fire while waiting for input, too.
+        """
+        from foxylib.tools.asyncio.asyncio_tool import AioTool
 
-            assert_not_equal(i_tail in h_i2j, i_tail in h_i2out)
+        buffer_size, chunk_size = size_pair
+        buffer = cls.Buffer(buffer_size, chunk_size, timeout=timeout, stats=stats)
+        aiter = AioTool.aiterable2aiter(rich_iter)
+        loop = asyncio.get_event_loop()
+
+        async def reason2run(reason):
+            chunk = buffer.chunk2popped(reason)
+            time_start = time.perf_counter()
+            by_list = f_batch([entry[1] for entry in chunk])
+            if inspect.isawaitable(by_list):
+                by_list = await by_list
+            buffer.chunk_bys2done(chunk, by_list, time.perf_counter() - time_start)
+
+        task = None
+        try:
+            while True:
+                if task is None:
+                    task = asyncio.ensure_future(aiter.__anext__())
+
+                time_deadline = buffer.time2deadline()
+                secs = None if time_deadline is None else max(time_deadline - loop.time(), 0)
+                done, _ = await asyncio.wait([task], timeout=secs)
+
+                if not done:
+                    await reason2run(cls.Reason.TIMEOUT)
+                    for rich_item in buffer.ready2popped():
+                        yield rich_item
+                    continue
 
-            if i_tail in h_i2out:
-                yield i2yield(i_tail)
-                continue
+                task_done, task = task, None
+                try:
+                    rich_item = task_done.result()
+                except StopAsyncIteration:
+                    break
 
+                if rich_item[0] and not buffer:
+                    buffer.stats.passed += 1
+                    yield rich_item
+                    continue
 
-            j_tail = h_i2j[i_tail]
+                time_now = loop.time()
+                buffer.append(rich_item, time_now)
 
-            for j in range(j_tail,m):
-                j2batch(j)
-                if i_tail not in h_i2out: # not done
-                    continue
+                reason = buffer.time2reason(time_now)
+                while reason is not None:
+                    await reason2run(reason)
+                    reason = buffer.time2reason(time_now)
 
-                yield i2yield(i_tail)
-                break
+                for rich_item in buffer.ready2popped():
+                    yield rich_item
 
-        for j in range(m):
-            while queue_list[j]:
-                j2batch(j)
+            while buffer.pending:
+                await reason2run(cls.Reason.END)
 
-        assert_false(h_i2j)
+            for rich_item in buffer.ready2popped():
+                yield rich_item
+        finally:
+            if task is not None and not task.done():
+                task.cancel()
 
-        while h_i2out:
-            i_tail = i2next(i_tail)
-            yield i2yield(i_tail)
+    @classmethod
+    async def aiter2backoff_batches(cls, aiter, batch_chunksize_list, buffer_size, stats_list=None):
+        """
+        async iter2backoff_batches(). input may be a plain or async iterable
+        """
+        m = len(batch_chunksize_list)
+        assert_true(m)
+        if stats_list is not None:
+            assert_equal(len(stats_list), m)
+
+        async def aiter2richiter_init():
+            from foxylib.tools.asyncio.asyncio_tool import AioTool
+            async for x in AioTool.aiterable2aiter(aiter):
+                yield (False, x, None)
+
+        rich_aiter = aiter2richiter_init()
+        for j, tier in enumerate(batch_chunksize_list):
+            f_batch, chunk_size, timeout = cls.tier2tuple(tier)
+            rich_aiter = cls.arichiter_func_sizes2arichiter(rich_aiter, f_batch, (buffer_size, chunk_size),
+                                                            timeout=timeout,
+                                                            stats=stats_list[j] if stats_list else None)
+
+        async for b, x, y in rich_aiter:
+            yield y
@@ -1,8 +1,13 @@
+import asyncio
+import itertools
 import logging
+import time
 from unittest import TestCase
 
+from future.utils import lmap
+
 from foxylib.tools.log.foxylib_logger import FoxylibLogger
-from foxylib.tools.collections.chunk_tool import ChunkTool
+from foxylib.tools.collections.chunk_tool import ChunkTool, BatchPoolTool
 
 
 class TestChunkTool(TestCase):
@@ -33,4 +38,145 @@ class TestChunkTool(TestCase):
 
         # pprint(hyp)
 
-        self.assertEqual(hyp, ref)
\ No newline at end of file
+        self.assertEqual(hyp, ref)
+
+
+class TestBatchPoolTool(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        FoxylibLogger.attach_stderr2loggers(logging.DEBUG)
+
+    @classmethod
+    def tiers(cls, calls):
+        """
+        cache: multiples of 3. db: multiples of 2. api: the rest
+        """
+        def cache(x_list):
+            calls.append(("cache", list(x_list)))
+            return [(x % 3 == 0, "cache{}".format(x)) for x in x_list]
+
+        def db(x_list):
+            calls.append(("db", list(x_list)))
+            return [(x % 2 == 0, "db{}".format(x)) for x in x_list]
+
+        def api(x_list):
+            calls.append(("api", list(x_list)))
+            return [(True, "api{}".format(x)) for x in x_list]
+
+        return cache, db, api
+
+    @classmethod
+    def x2ref(cls, x):
+        if x % 3 == 0:
+            return "cache{}".format(x)
+        if x % 2 == 0:
+            return "db{}".format(x)
+        return "api{}".format(x)
+
+    def test_01(self):
+        calls = []
+        cache, db, api = self.tiers(calls)
+        stats_list = BatchPoolTool.TierStats.size2list(3)
+
+        y_list = list(BatchPoolTool.iter2backoff_batches(range(100), [(cache, 10), (db, 5), (api, 4)], 20,
+                                                         stats_list=stats_list))
+        self.assertEqual(y_list, lmap(self.x2ref, range(100)))
+
+        # each tier only sees what the ones before could not resolve
+        self.assertEqual(sorted(x for name, l in calls if name == "db" for x in l),
+                         [x for x in range(100) if x % 3])
+        self.assertEqual(sorted(x for name, l in calls if name == "api" for x in l),
+                         [x for x in range(100) if x % 3 and x % 2])
+        self.assertTrue(all(len(l) <= {"cache": 10, "db": 5, "api": 4}[name] for name, l in calls))
+
+        F = BatchPoolTool.TierStats.Field
+        h_list = [stats.to_dict() for stats in stats_list]
+        self.assertEqual([h[F.ITEMS_IN] for h in h_list], [100, 66, 33])
+        self.assertEqual([h[F.RESOLVED] for h in h_list], [34, 33, 33])
+        self.assertEqual([h[F.PASSED] for h in h_list], [0, 34, 67])
+
+    def test_02(self):
+        """
+        bounded buffer: output starts before the input ends, even with an endless input
+        """
+        calls = []
+        cache, db, api = self.tiers(calls)
+
+        y_iter = BatchPoolTool.iter2backoff_batches(itertools.count(), [(cache, 100), (db, 100), (api, 100)], 8)
+        self.assertEqual(list(itertools.islice(y_iter, 50)), lmap(self.x2ref, range(50)))
+        self.assertTrue(all(len(l) <= 8 for _, l in calls))
+
+    def test_03(self):
+        """
+        time flush: a slow input does not hold back resolved items until the chunk fills
+        """
+        calls = []
+        cache, db, api = self.tiers(calls)
+
+        def x_iter():
+            for x in range(6):
+                yield x
+                time.sleep(0.02)
+
+        stats_list = BatchPoolTool.TierStats.size2list(3)
+        y_list = list(BatchPoolTool.iter2backoff_batches(x_iter(), [(cache, 100, 0.01), (db, 100), (api, 100)], 100,
+                                                         stats_list=stats_list))
+        self.assertEqual(y_list, lmap(self.x2ref, range(6)))
+
+        h = stats_list[0].to_dict()
+        self.assertGreater(h["{}_{}".format(BatchPoolTool.TierStats.Field.BATCHES, BatchPoolTool.Reason.TIMEOUT)], 0)
+
+    def test_04(self):
+        calls = []
+        cache, db, api = self.tiers(calls)
+
+        async def db_async(x_list):
+            await asyncio.sleep(0.001)
+            return db(x_list)
+
+        events = []
+
+        async def x_aiter():
+            for x in range(30):
+                yield x
+            await asyncio.sleep(0.5)  # partial chunks flushed on time meanwhile
+            events.append("resumed")
+            for x in range(30, 40):
+                yield x
+
+        async def arun():
+            stats_list = BatchPoolTool.TierStats.size2list(3)
+            tiers = [(cache, 7, 0.01), (db_async, 5, 0.01), (api, 3, 0.01)]
+
+            y_list = []
+            async for y in BatchPoolTool.aiter2backoff_batches(x_aiter(), tiers, 10, stats_list=stats_list):
+                y_list.append(y)
+                events.append(y)
+            return y_list, stats_list
+
+        y_list, stats_list = asyncio.run(arun())
+        self.assertEqual(y_list, lmap(self.x2ref, range(40)))
+
+        # the first 30 outputs did not wait for the rest of the input
+        self.assertEqual(events.index("resumed"), 30)
+
+        F = BatchPoolTool.TierStats.Field
+        self.assertEqual([s.to_dict()[F.ITEMS_IN] for s in stats_list], [40, 26, 13])
+
+    def test_05(self):
+        """
+        benchmark: O(1) amortized per item
+        """
+        logger = FoxylibLogger.func_level2logger(self.test_05, logging.DEBUG)
+
+        def tier(k):
+            return lambda x_list: [(x % k == 0, x) for x in x_list]
+
+        tiers = [(tier(2), 100), (tier(3), 100), (lambda x_list: [(True, x) for x in x_list], 100)]
+
+        for n in [10000, 100000]:
+            time_start = time.perf_counter()
+            c = sum(1 for _ in BatchPoolTool.iter2backoff_batches(range(n), tiers, 1000))
+            secs = time.perf_counter() - time_start
+            logger.debug({"items": n, "secs": secs, "items/sec": n / secs})
+            self.assertEqual(c, n)
@@ -1,15 +1,24 @@
 import logging
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import closing
 from datetime import datetime
+from itertools import count
+from threading import Event, Lock
 
-from elasticsearch import NotFoundError
-from elasticsearch.helpers import bulk, scan
+from elasticsearch import NotFoundError, TransportError
+from elasticsearch.helpers import scan, expand_action, BulkIndexError
+from elasticsearch.serializer import JSONSerializer
 from nose.tools import assert_equal
 
-from foxylib.tools.collections.collections_tool import merge_dicts, vwrite_no_duplicate_key, lchain, f_vwrite2f_hvwrite
+from foxylib.tools.collections.collections_tool import merge_dicts, vwrite_no_duplicate_key, lchain, f_vwrite2f_hvwrite, \
+    vwrite_overwrite
 from foxylib.tools.collections.iter_tool import iter2singleton
 from foxylib.tools.json.json_tool import jdown
 # logger = logging.getLogger(__name__)
 from foxylib.tools.log.foxylib_logger import FoxylibLogger
+from foxylib.tools.metric.metric_tool import LatencyMetric, CounterMetric, MetricTool
 
 
 class ElasticsearchTool:
@@ -78,13 +87,20 @@ class ElasticsearchTool:
         return jdown(j_result, ["hits", "total", "value"])
 
     @classmethod
-    def index2ids(cls, es_client, index):
+    def index2ids(cls, es_client, index, slices=None, size=None):
         if not ESTool.index2exists(es_client, index):
-            raise StopIteration()
+            return
+
+        j_query = {"query": {"match_all": {}}, "stored_fields": []}
+
+        if not slices:
+            j_iter = scan(es_client, query=j_query, index=index,)
+        else:
+            search_kwargs = merge_dicts([{"index": index, "body": j_query},
+                                         {"size": size} if size else {},
+                                         ])
+            j_iter = cls.search_slices2hit_iter(es_client, search_kwargs, "5m", slices)
 
-        j_iter = scan(es_client,
-                         query={"query": {"match_all": {}}, "stored_fields": []},
-                         index=index,)
         for j in j_iter:
             yield j["_id"]
 
@@ -121,19 +137,106 @@ class ElasticsearchTool:
     def item_count2request_timeout_default(cls, item_count):
         return item_count*10
 
+    @classmethod
+    def scroll_id2cleared(cls, es_client, scroll_id):
+        if not scroll_id:
+            return
+
+        try:
+            es_client.clear_scroll(scroll_id=scroll_id)
+        except NotFoundError:
+            pass
+
     @classmethod
     def search_scroll2result_iter(cls, es_client, search_kwargs, scroll, ):
+        """
+        the scroll context is cleared as soon as the iterator is exhausted or closed,
+        instead of waiting for 'scroll' to expire on the server.
+        """
+        scroll_id = None
+        try:
+            j_result = es_client.search(scroll=scroll, **search_kwargs)
+            while True:
+                scroll_id = j_result.get("_scroll_id") or scroll_id
+
+                j_hit_list = ESTool.j_result2j_hit_list(j_result)
+                if not j_hit_list:
+                    break
+
+                yield j_result
+
+                j_result = es_client.scroll(scroll_id=scroll_id, scroll=scroll)
+        finally:
+            cls.scroll_id2cleared(es_client, scroll_id)
+
+    @classmethod
+    def search_kwargs2sliced(cls, search_kwargs, slice_id, slice_max):
+        if slice_max <= 1:
+            return search_kwargs
+
+        body = merge_dicts([search_kwargs.get("body") or {},
+                            {"slice": {"id": slice_id, "max": slice_max}},
+                            ], vwrite=vwrite_no_duplicate_key)
+        return merge_dicts([search_kwargs, {"body": body}], vwrite=vwrite_overwrite)
+
+    @classmethod
+    def search_slices2hit_iter(cls, es_client, search_kwargs, scroll, slices, buffer_size=None):
+        """
+        stream individual hits of a sliced scroll.
+
+        each of the 'slices' slices is scrolled on its own thread. pages go through a queue of
+        'buffer_size' pages (default: slices), so the next pages are fetched while the caller
+        processes the current one, and at most buffer_size + slices pages are held in memory.
+        hits of different slices are interleaved; order within a slice is kept.
+
+        every scroll context is cleared before this iterator finishes, including when the caller
+        stops early or a slice raises. the first exception from a slice is re-raised here.
+        """
+        buffer_size = buffer_size or slices
+        q = queue.Queue(maxsize=buffer_size)
+        event_stop = Event()
+        done = object()
+
+        def put(item):
+            while not event_stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def run(slice_id):
+            try:
+                kwargs = cls.search_kwargs2sliced(search_kwargs, slice_id, slices)
+                with closing(cls.search_scroll2result_iter(es_client, kwargs, scroll)) as j_result_iter:
+                    for j_result in j_result_iter:
+                        if not put(cls.j_result2j_hit_list(j_result)):
+                            return
+            except Exception as e:
+                put(e)
+            finally:
+                put(done)
+
+        executor = ThreadPoolExecutor(max_workers=slices, thread_name_prefix="{}.slice".format(FoxylibLogger.rootname))
+        try:
+            for slice_id in range(slices):
+                executor.submit(run, slice_id)
 
-        j_result = es_client.search(scroll=scroll, **search_kwargs)
-        while True:
-            j_hit_list = ESTool.j_result2j_hit_list(j_result)
-            if not j_hit_list:
-                break
+            count_done = 0
+            while count_done < slices:
+                item = q.get()
+                if item is done:
+                    count_done += 1
+                    continue
 
-            yield j_result
+                if isinstance(item, Exception):
+                    raise item
 
-            scroll_id = cls.j_result2scroll_id(j_result)
-            j_result = es_client.scroll(scroll_id=scroll_id, scroll=scroll)
+                yield from item
+        finally:
+            event_stop.set()
+            executor.shutdown(wait=True)
 
 
     @classmethod
@@ -221,6 +324,308 @@ class ElasticsearchTool:
         return cls.index2settings(client, index, *_, **__)['index']['analysis']
 
 
+class BulkIndexer:
+    """
+    Streaming bulk indexer.
+
+    Actions are read lazily and cut into batches by count and by bytes. Up to max_inflight batches
+    are sent at once. The batch size grows while batches finish under secs_target and shrinks on
+    slow batches or 429 rejections. Only the rejected items of a batch are retried, with exponential backoff.
+
+    Config keys shared with elasticsearch.helpers.bulk keep their meaning there.
+    """
+
+    class Config:
+        class Key:
+            CHUNK_SIZE = "chunk_size"
+            CHUNK_SIZE_MIN = "chunk_size_min"
+            CHUNK_SIZE_MAX = "chunk_size_max"
+            MAX_CHUNK_BYTES = "max_chunk_bytes"
+            MAX_INFLIGHT = "max_inflight"
+            SECS_TARGET = "secs_target"
+            MAX_RETRIES = "max_retries"
+            INITIAL_BACKOFF = "initial_backoff"
+            MAX_BACKOFF = "max_backoff"
+            RAISE_ON_EXCEPTION = "raise_on_exception"
+            EXPAND_ACTION_CALLBACK = "expand_action_callback"
+
+        DEFAULT = {Key.CHUNK_SIZE: 500,
+                   Key.CHUNK_SIZE_MIN: 10,
+                   Key.CHUNK_SIZE_MAX: 10000,
+                   Key.MAX_CHUNK_BYTES: 10 * 1024 * 1024,
+                   Key.MAX_INFLIGHT: 4,
+                   Key.SECS_TARGET: 1.0,
+                   Key.MAX_RETRIES: 5,
+                   Key.INITIAL_BACKOFF: 0.5,
+                   Key.MAX_BACKOFF: 60,
+                   Key.RAISE_ON_EXCEPTION: True,
+                   Key.EXPAND_ACTION_CALLBACK: expand_action,
+                   }
+
+        @classmethod
+        def config2value(cls, config, key):
+            return (config or {}).get(key, cls.DEFAULT[key])
+
+    class Field:
+        BATCH = "batch"
+        COUNT = "count"
+        BYTES = "bytes"
+        SUCCESS = "success"
+        ERRORS = "errors"
+        RETRIES = "retries"
+        REJECTED = "rejected"
+        SECS = "secs"
+        DOCS_PER_SEC = "docs_per_sec"
+        BYTES_PER_SEC = "bytes_per_sec"
+        CHUNK_SIZE = "chunk_size"
+        COUNTS = "counts"
+        LATENCY = "latency"
+
+    STATUS_RETRY = {429}
+
+    def __init__(self, es_client, config=None, es_kwargs=None):
+        self.es_client = es_client
+        self.config = config
+        self.es_kwargs = es_kwargs or {}
+
+        transport = getattr(es_client, "transport", None)
+        self.serializer = getattr(transport, "serializer", None) or JSONSerializer()
+
+        self.lock = Lock()
+        self.chunk_size = self.Config.config2value(config, self.Config.Key.CHUNK_SIZE)
+
+        self.counter = CounterMetric([self.Field.BATCH, self.Field.SUCCESS, self.Field.ERRORS,
+                                      self.Field.RETRIES, self.Field.REJECTED, ])
+        self.latency = LatencyMetric()
+
+    def _config2value(self, key):
+        return self.Config.config2value(self.config, key)
+
+    def action2lines(self, j_action):
+        action, data = self._config2value(self.Config.Key.EXPAND_ACTION_CALLBACK)(j_action)
+
+        lines = [self.serializer.dumps(action)]
+        if data is not None:
+            lines.append(self.serializer.dumps(data))
+        return lines
+
+    @classmethod
+    def lines2bytes(cls, lines):
+        return sum(len(line.encode("utf-8")) + 1 for line in lines)
+
+    def actions2batches(self, j_actions):
+        """
+        yields lists of (j_action, lines). the current chunk_size is read for every batch
+        """
+        max_chunk_bytes = self._config2value(self.Config.Key.MAX_CHUNK_BYTES)
+
+        batch, size_bytes = [], 0
+        for j_action in j_actions:
+            lines = self.action2lines(j_action)
+            n_bytes = self.lines2bytes(lines)
+
+            if batch and size_bytes + n_bytes > max_chunk_bytes:
+                yield batch
+                batch, size_bytes = [], 0
+
+            batch.append((j_action, lines))
+            size_bytes += n_bytes
+
+            if len(batch) >= self.chunk_size:
+                yield batch
+                batch, size_bytes = [], 0
+
+        if batch:
+            yield batch
+
+    def _adapt(self, n_docs, secs, rejected):
+        """
+        multiplicative decrease on rejection or slow batches, gradual increase otherwise
+        """
+        chunk_size_min = self._config2value(self.Config.Key.CHUNK_SIZE_MIN)
+        chunk_size_max = self._config2value(self.Config.Key.CHUNK_SIZE_MAX)
+        secs_target = self._config2value(self.Config.Key.SECS_TARGET)
+
+        with self.lock:
+            if rejected:
+                chunk_size = self.chunk_size // 2
+            elif secs > secs_target:
+                chunk_size = int(self.chunk_size * max(0.5, secs_target / secs))
+            elif n_docs >= self.chunk_size:  # count-bound batch that came back fast
+                chunk_size = self.chunk_size + max(1, self.chunk_size // 4)
+            else:
+                chunk_size = self.chunk_size
+
+            self.chunk_size = min(max(chunk_size, chunk_size_min), chunk_size_max)
+
+    def _lines2bulk(self, lines):
+        body = "\n".join(lines) + "\n"
+        return self.es_client.bulk(body=body, **self.es_kwargs)
+
+    def error_batch2items(self, error, batch):
+        """
+        error items for a batch whose request failed, as helpers.bulk() makes them with raise_on_exception=False
+        """
+        f_expand = self._config2value(self.Config.Key.EXPAND_ACTION_CALLBACK)
+
+        j_item_list = []
+        for j_action, _ in batch:
+            action, data = f_expand(j_action)
+            op_type, j_meta = iter2singleton(action.items())
+
+            j_info = {"error": str(error), "status": error.status_code, "exception": error}
+            if op_type != "delete":
+                j_info["data"] = data
+            j_info.update(j_meta)
+            j_item_list.append({op_type: j_info})
+        return j_item_list
+
+    def batch2result(self, i_batch, batch):
+        max_retries = self._config2value(self.Config.Key.MAX_RETRIES)
+        secs_backoff = self._config2value(self.Config.Key.INITIAL_BACKOFF)
+        max_backoff = self._config2value(self.Config.Key.MAX_BACKOFF)
+
+        n_docs = len(batch)
+        size_bytes = sum(self.lines2bytes(lines) for _, lines in batch)
+
+        time_start = time.perf_counter()
+        secs_first = None
+        success, errors, retries, rejected = 0, [], 0, False
+
+        pending = batch
+        for attempt in range(max_retries + 1):
+            if attempt:
+                retries += 1
+                time.sleep(secs_backoff)
+                secs_backoff = min(secs_backoff * 2, max_backoff)
+
+            time_request = time.perf_counter()
+            try:
+                j_result = self._lines2bulk([line for _, lines in pending for line in lines])
+            except TransportError as e:
+                if e.status_code in self.STATUS_RETRY and attempt < max_retries:
+                    rejected = True
+                    continue
+
+                if self._config2value(self.Config.Key.RAISE_ON_EXCEPTION):
+                    raise
+
+                errors.extend(self.error_batch2items(e, pending))
+                break
+            finally:
+                if secs_first is None:
+                    secs_first = time.perf_counter() - time_request
+
+            retry_list = []
+            for j_item, (j_action, lines) in zip(j_result["items"], pending):
+                op_type, j_info = iter2singleton(j_item.items())
+                status = j_info.get("status", 200)
+
+                if 200 <= status < 300:
+                    success += 1
+                elif status in self.STATUS_RETRY and attempt < max_retries:
+                    retry_list.append((j_action, lines))
+                else:
+                    errors.append(j_item)
+
+            if not retry_list:
+                break
+
+            rejected = True
+            pending = retry_list
+
+        secs = time.perf_counter() - time_start
+        self._adapt(n_docs, secs_first, rejected)
+
+        self.counter.incr(self.Field.BATCH)
+        self.counter.incr(self.Field.SUCCESS, success)
+        self.counter.incr(self.Field.ERRORS, len(errors))
+        self.counter.incr(self.Field.RETRIES, retries)
+        self.counter.incr(self.Field.REJECTED, int(rejected))
+        self.latency.add(secs)
+
+        return {self.Field.BATCH: i_batch,
+                self.Field.COUNT: n_docs,
+                self.Field.BYTES: size_bytes,
+                self.Field.SUCCESS: success,
+                self.Field.ERRORS: errors,
+                self.Field.RETRIES: retries,
+                self.Field.REJECTED: rejected,
+                self.Field.SECS: secs,
+                self.Field.DOCS_PER_SEC: MetricTool.count_secs2rate(n_docs, secs),
+                self.Field.BYTES_PER_SEC: MetricTool.count_secs2rate(size_bytes, secs),
+                self.Field.CHUNK_SIZE: self.chunk_size,
+                }
+
+    def actions2result_iter(self, j_actions):
+        """
+        yields one result dict per batch, in completion order
+        """
+        max_inflight = self._config2value(self.Config.Key.MAX_INFLIGHT)
+
+        batch_iter = self.actions2batches(j_actions)
+        executor = ThreadPoolExecutor(max_workers=max_inflight,
+                                      thread_name_prefix="{}.bulk".format(FoxylibLogger.rootname))
+        futures = set()
+        try:
+            for i_batch in count():
+                if len(futures) >= max_inflight:
+                    done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+
+                batch = next(batch_iter, None)  # cut after waiting, so it sees the latest chunk_size
+                if batch is None:
+                    break
+
+                futures.add(executor.submit(self.batch2result, i_batch, batch))
+
+            while futures:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def bulk(self, j_actions, raise_on_error=True, stats_only=False, ignore_status=(), yield_ok=True):
+        """
+        same return value as elasticsearch.helpers.bulk(): (success count, list of errors),
+        or (success count, error count) if stats_only.
+        ignore_status: item statuses that do not raise, though still counted as errors, as in helpers.bulk()
+        yield_ok: False reports 0 successes, as helpers.bulk() only counts what streaming_bulk() yields
+        """
+        logger = FoxylibLogger.func_level2logger(self.bulk, logging.DEBUG)
+
+        success, errors = 0, []
+        for j_result in self.actions2result_iter(j_actions):
+            success += j_result[self.Field.SUCCESS]
+            errors.extend(j_result[self.Field.ERRORS])
+
+            logger.debug({k: v for k, v in j_result.items() if k != self.Field.ERRORS})
+
+        if isinstance(ignore_status, int):
+            ignore_status = (ignore_status,)
+        errors_raised = [j_item for j_item in errors
+                         if iter2singleton(j_item.values()).get("status") not in ignore_status]
+        if errors_raised and raise_on_error:
+            raise BulkIndexError("%i document(s) failed to index." % len(errors_raised), errors_raised)
+
+        if not yield_ok:
+            success = 0
+
+        if stats_only:
+            return success, len(errors)
+        return success, errors
+
+    def metrics(self):
+        return {self.Field.CHUNK_SIZE: self.chunk_size,
+                self.Field.COUNTS: self.counter.to_dict(),
+                self.Field.LATENCY: self.latency.to_dict(),
+                }
+
+
 class BulkTool:
     class Field:
         ID = "_id"
@@ -244,20 +649,53 @@ class BulkTool:
     @classmethod
     def op_type_default(cls): return "index"
 
+    class HelperKey:
+        """
+        elasticsearch.helpers.bulk() options that are not es_client.bulk() parameters
+        """
+        RAISE_ON_ERROR = "raise_on_error"
+        STATS_ONLY = "stats_only"
+        IGNORE_STATUS = "ignore_status"
+        YIELD_OK = "yield_ok"
+
+        @classmethod
+        def keys(cls):
+            return {cls.RAISE_ON_ERROR, cls.STATS_ONLY, cls.IGNORE_STATUS, cls.YIELD_OK}
+
+    @classmethod
+    def kwargs2config_bulk_es_kwargs(cls, kwargs):
+        """
+        splits helpers.bulk()-style kwargs into BulkIndexer config, BulkIndexer.bulk() kwargs and es_client.bulk() kwargs
+        """
+        kwargs = kwargs or {}
+        keys_config = set(BulkIndexer.Config.DEFAULT.keys())
+        keys_helper = cls.HelperKey.keys()
+
+        config = {k: v for k, v in kwargs.items() if k in keys_config}
+        bulk_kwargs = {k: v for k, v in kwargs.items() if k in keys_helper}
+        es_kwargs = {k: v for k, v in kwargs.items() if k not in keys_config and k not in keys_helper}
+        return config, bulk_kwargs, es_kwargs
+
     @classmethod
     def bulk(cls, es_client, j_action_list, run_bulk=True, es_kwargs=None,):
+        """
+        j_action_list may be any iterable when run_bulk is True.
+        es_kwargs takes BulkIndexer.Config keys (chunk_size, max_retries, raise_on_exception, ...),
+        the other helpers.bulk() options (see HelperKey) as well as es_client.bulk() kwargs.
+        """
         logger = FoxylibLogger.func_level2logger(cls.bulk, logging.DEBUG)
 
-        n = len(j_action_list)
-        count_list = [n*i//100 for i in range(100)]
-
-        _run_bulk = run_bulk and n>1
-        if _run_bulk:
-            return bulk(es_client, j_action_list, **es_kwargs)
+        if run_bulk:
+            config, bulk_kwargs, es_kwargs_bulk = cls.kwargs2config_bulk_es_kwargs(es_kwargs)
+            return BulkIndexer(es_client, config=config, es_kwargs=es_kwargs_bulk).bulk(j_action_list, **bulk_kwargs)
         else:
+            j_action_list = list(j_action_list)
+            n = len(j_action_list)
+            count_set = {n*i//100 for i in range(100)}
+
             result_list = []
             for i, j_action in enumerate(j_action_list):
-                if i in count_list:
+                if i in count_set:
                     logger.debug({"i/n":"{}/{}".format(i+1,n),
                                   # "j_action":j_action,
                                   })
@@ -0,0 +1,310 @@
+import json
+import logging
+import time
+from threading import Lock
+from unittest import TestCase
+
+from elasticsearch import NotFoundError, TransportError
+from elasticsearch.helpers import BulkIndexError
+
+from foxylib.tools.database.elasticsearch.elasticsearch_tool import ElasticsearchTool, BulkIndexer, BulkTool
+from foxylib.tools.log.foxylib_logger import FoxylibLogger
+
+
+class LocalElasticsearch:
+    """
+    stand-in for elasticsearch.Elasticsearch: search/scroll/clear_scroll over an in-memory index
+    """
+
+    class Indices:
+        def __init__(self, client):
+            self.client = client
+
+        def exists(self, index):
+            return index in self.client.h_index2ids
+
+    def __init__(self, h_index2ids, secs_page=0.0, fail_slice=None):
+        self.h_index2ids = h_index2ids
+        self.secs_page = secs_page
+        self.fail_slice = fail_slice
+        self.indices = self.Indices(self)
+
+        self.lock = Lock()
+        self.h_scroll2state = {}
+        self.count_scroll = 0
+        self.count_cleared = 0
+
+    def _page(self, scroll_id):
+        time.sleep(self.secs_page)
+        with self.lock:
+            state = self.h_scroll2state.get(scroll_id)
+            if state is None:
+                raise NotFoundError(404, "search_context_missing_exception")
+
+            if state["slice_id"] == self.fail_slice and state["offset"]:
+                raise ValueError(state["slice_id"])
+
+            offset, size = state["offset"], state["size"]
+            state["offset"] += size
+            ids = state["ids"][offset:offset + size]
+
+        return {"_scroll_id": scroll_id,
+                "hits": {"hits": [{"_id": _id, "_source": {}} for _id in ids]},
+                }
+
+    def search(self, index=None, body=None, scroll=None, size=10):
+        body = body or {}
+        j_slice = body.get("slice") or {"id": 0, "max": 1}
+        ids = [_id for i, _id in enumerate(self.h_index2ids[index]) if i % j_slice["max"] == j_slice["id"]]
+
+        with self.lock:
+            self.count_scroll += 1
+            scroll_id = "scroll-{}".format(self.count_scroll)
+            self.h_scroll2state[scroll_id] = {"ids": ids, "offset": 0, "size": size, "slice_id": j_slice["id"]}
+
+        return self._page(scroll_id)
+
+    def scroll(self, scroll_id=None, scroll=None):
+        return self._page(scroll_id)
+
+    def clear_scroll(self, scroll_id=None):
+        with self.lock:
+            if self.h_scroll2state.pop(scroll_id, None) is None:
+                raise NotFoundError(404, "search_context_missing_exception")
+            self.count_cleared += 1
+
+    def open_scroll_count(self):
+        with self.lock:
+            return len(self.h_scroll2state)
+
+
+class TestElasticsearchToolSlices(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        FoxylibLogger.attach_stderr2loggers(logging.DEBUG)
+
+    def test_01(self):
+        ids = ["d{}".format(i) for i in range(1000)]
+        client = LocalElasticsearch({"idx": ids})
+
+        hits = list(ElasticsearchTool.search_slices2hit_iter(client, {"index": "idx", "size": 37}, "1m", 4))
+        self.assertEqual(sorted(h["_id"] for h in hits), sorted(ids))
+        self.assertEqual(client.count_scroll, 4)
+        self.assertEqual(client.open_scroll_count(), 0)
+
+        self.assertEqual(sorted(ElasticsearchTool.index2ids(client, "idx", slices=3, size=50)), sorted(ids))
+        self.assertEqual(client.open_scroll_count(), 0)
+        self.assertEqual(list(ElasticsearchTool.index2ids(client, "missing", slices=3)), [])
+
+    def test_02(self):
+        """
+        scroll contexts are cleared when the caller stops early
+        """
+        client = LocalElasticsearch({"idx": list(range(10000))})
+
+        hit_iter = ElasticsearchTool.search_slices2hit_iter(client, {"index": "idx", "size": 10}, "1m", 4,
+                                                            buffer_size=2)
+        for _ in range(25):
+            next(hit_iter)
+        self.assertGreater(client.open_scroll_count(), 0)
+
+        hit_iter.close()
+        self.assertEqual(client.open_scroll_count(), 0)
+        self.assertEqual(client.count_cleared, 4)
+
+        # single scroll iterator too
+        result_iter = ElasticsearchTool.search_scroll2result_iter(client, {"index": "idx", "size": 10}, "1m")
+        next(result_iter)
+        result_iter.close()
+        self.assertEqual(client.open_scroll_count(), 0)
+
+    def test_03(self):
+        """
+        an error in one slice is raised to the caller and every context is still cleared
+        """
+        client = LocalElasticsearch({"idx": list(range(1000))}, fail_slice=2)
+
+        with self.assertRaises(ValueError):
+            list(ElasticsearchTool.search_slices2hit_iter(client, {"index": "idx", "size": 10}, "1m", 4))
+
+        self.assertEqual(client.open_scroll_count(), 0)
+
+    def test_04(self):
+        """
+        pages are fetched while the caller is busy with the previous one
+        """
+        logger = FoxylibLogger.func_level2logger(self.test_04, logging.DEBUG)
+
+        secs_page = 0.01
+        client = LocalElasticsearch({"idx": list(range(400))}, secs_page=secs_page)
+        search_kwargs = {"index": "idx", "size": 20}
+
+        def consume(hit_iter):
+            time_start = time.perf_counter()
+            for i, _ in enumerate(hit_iter):
+                if i % 20 == 0:
+                    time.sleep(secs_page)  # caller work per page
+            return time.perf_counter() - time_start
+
+        secs_sequential = consume(h for j_result in ElasticsearchTool.search_scroll2result_iter(client, search_kwargs, "1m")
+                                  for h in ElasticsearchTool.j_result2j_hit_list(j_result))
+        secs_prefetch = consume(ElasticsearchTool.search_slices2hit_iter(client, search_kwargs, "1m", 1))
+        secs_sliced = consume(ElasticsearchTool.search_slices2hit_iter(client, search_kwargs, "1m", 4))
+
+        logger.info({"secs sequential": secs_sequential, "secs prefetch": secs_prefetch, "secs sliced": secs_sliced})
+        self.assertLess(secs_prefetch, secs_sequential)
+        self.assertEqual(client.open_scroll_count(), 0)
+
+
+class LocalBulkElasticsearch:
+    """
+    stand-in for elasticsearch.Elasticsearch.bulk(): rejects items with 429 while overloaded
+    """
+
+    def __init__(self, capacity=None, reject_request_first=False, secs_per_doc=0.0, fail_ids=None, status_request=None):
+        self.capacity = capacity
+        self.reject_request_first = reject_request_first
+        self.status_request = status_request
+        self.secs_per_doc = secs_per_doc
+        self.fail_ids = set(fail_ids or [])
+
+        self.lock = Lock()
+        self.h_id2source = {}
+        self.count_request = 0
+        self.batch_sizes = []
+
+    def bulk(self, body=None, request_timeout=None):
+        lines = body.strip("\n").split("\n")
+        pairs = [(json.loads(lines[i]), json.loads(lines[i + 1])) for i in range(0, len(lines), 2)]
+
+        with self.lock:
+            self.count_request += 1
+            if self.reject_request_first and self.count_request == 1:
+                raise TransportError(429, "es_rejected_execution_exception", {})
+            if self.status_request is not None:
+                raise TransportError(self.status_request, "request failed", {})
+            self.batch_sizes.append(len(pairs))
+
+        time.sleep(self.secs_per_doc * len(pairs))
+
+        items = []
+        for i, (j_action, j_source) in enumerate(pairs):
+            _id = j_action["index"]["_id"]
+            if _id in self.fail_ids:
+                status = 400
+            elif self.capacity is not None and i >= self.capacity:
+                status = 429
+            else:
+                status = 201
+                with self.lock:
+                    self.h_id2source[_id] = j_source
+            items.append({"index": {"_id": _id, "status": status}})
+
+        return {"errors": any(item["index"]["status"] >= 300 for item in items), "items": items}
+
+
+def j_action_iter(n):
+    for i in range(n):
+        yield {"_index": "idx", "_id": str(i), "_source": {"i": i, "text": "x" * (i % 50)}}
+
+
+class TestBulkIndexer(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        FoxylibLogger.attach_stderr2loggers(logging.DEBUG)
+
+    def test_01(self):
+        client = LocalBulkElasticsearch()
+        config = {"chunk_size": 100, "max_inflight": 3}
+
+        success, errors = BulkIndexer(client, config=config).bulk(j_action_iter(1000))
+        self.assertEqual((success, errors), (1000, []))
+        self.assertEqual(len(client.h_id2source), 1000)
+        self.assertEqual(client.h_id2source["7"], {"i": 7, "text": "x" * 7})
+
+    def test_02(self):
+        """
+        batches are cut by bytes as well as count
+        """
+        client = LocalBulkElasticsearch()
+        indexer = BulkIndexer(client, config={"chunk_size": 1000, "max_chunk_bytes": 2000})
+        self.assertEqual(indexer.bulk(j_action_iter(300))[0], 300)
+        self.assertLess(max(client.batch_sizes), 40)
+
+    def test_03(self):
+        """
+        only rejected items are retried, and the batch size backs off
+        """
+        client = LocalBulkElasticsearch(capacity=50, reject_request_first=True)
+        config = {"chunk_size": 200, "initial_backoff": 0.001, "max_retries": 10, "max_inflight": 1}
+        indexer = BulkIndexer(client, config=config)
+
+        j_result_list = list(indexer.actions2result_iter(j_action_iter(1000)))
+        self.assertEqual(sum(j[BulkIndexer.Field.SUCCESS] for j in j_result_list), 1000)
+        self.assertEqual(len(client.h_id2source), 1000)
+        self.assertTrue(j_result_list[0][BulkIndexer.Field.REJECTED])
+        self.assertLessEqual(indexer.chunk_size, 100)
+
+        # retried requests carry only the rejected items
+        self.assertEqual(client.batch_sizes[:4], [200, 150, 100, 50])
+
+        j_metrics = indexer.metrics()
+        self.assertEqual(j_metrics[BulkIndexer.Field.COUNTS][BulkIndexer.Field.SUCCESS], 1000)
+
+    def test_04(self):
+        """
+        item errors other than 429 are not retried; BulkTool.bulk raises like helpers.bulk
+        """
+        client = LocalBulkElasticsearch(fail_ids={"3", "5"})
+
+        success, errors = BulkIndexer(client).bulk(j_action_iter(10), raise_on_error=False)
+        self.assertEqual(success, 8)
+        self.assertEqual(sorted(j["index"]["_id"] for j in errors), ["3", "5"])
+        self.assertEqual(client.count_request, 1)
+
+        with self.assertRaises(BulkIndexError):
+            BulkTool.bulk(client, j_action_iter(10), es_kwargs={"chunk_size": 4, "request_timeout": 30})
+
+        # helpers.bulk() options are not sent to es_client.bulk()
+        es_kwargs = {"raise_on_error": False, "stats_only": True, "raise_on_exception": True}
+        self.assertEqual(BulkTool.bulk(client, j_action_iter(10), es_kwargs=es_kwargs), (8, 2))
+        self.assertEqual(BulkTool.bulk(client, j_action_iter(10), es_kwargs={"ignore_status": 400})[0], 8)
+
+        es_kwargs = {"yield_ok": False, "raise_on_error": False}
+        self.assertEqual(BulkTool.bulk(client, j_action_iter(10), es_kwargs=es_kwargs)[0], 0)
+
+    def test_06(self):
+        """
+        raise_on_exception=False reports the items of a failed request as errors, like helpers.bulk()
+        """
+        client = LocalBulkElasticsearch(status_request=500)
+        es_kwargs = {"raise_on_exception": False, "raise_on_error": False, "chunk_size": 4}
+
+        success, errors = BulkTool.bulk(client, j_action_iter(10), es_kwargs=es_kwargs)
+        self.assertEqual(success, 0)
+        self.assertEqual([j["index"]["_id"] for j in errors], [str(i) for i in range(10)])
+        self.assertEqual(errors[3]["index"]["status"], 500)
+        self.assertEqual(errors[3]["index"]["data"], {"i": 3, "text": "xxx"})
+
+        with self.assertRaises(BulkIndexError):
+            BulkTool.bulk(client, j_action_iter(10), es_kwargs={"raise_on_exception": False})
+
+        with self.assertRaises(TransportError):
+            BulkTool.bulk(client, j_action_iter(10))
+
+    def test_05(self):
+        """
+        batch size grows while batches come back under secs_target
+        """
+        logger = FoxylibLogger.func_level2logger(self.test_05, logging.DEBUG)
+
+        client = LocalBulkElasticsearch(secs_per_doc=0.00001)
+        config = {"chunk_size": 20, "secs_target": 0.5, "max_inflight": 2}
+        indexer = BulkIndexer(client, config=config)
+
+        j_result_list = list(indexer.actions2result_iter(j_action_iter(5000)))
+        self.assertEqual(sum(j[BulkIndexer.Field.SUCCESS] for j in j_result_list), 5000)
+        self.assertGreater(indexer.chunk_size, 20)
+        self.assertIsNotNone(j_result_list[-1][BulkIndexer.Field.DOCS_PER_SEC])
+
+        logger.info({"metrics": indexer.metrics(), "batches": len(j_result_list)})
@@ -0,0 +1,78 @@
+class ShapeConverter:
+    """
+    Leaf conversion over dict/list/set/tuple trees, compiled per shape.
+
+    Same result as TraversileTool.tree2traversed(tree, func) where func checks leaf types with an isinstance chain,
+    but the chain is resolved once per type, and once per dict shape, i.e. the dict type and the types of its values.
+    Dicts of a known shape are copied in C and only the values that need converting are visited.
+    """
+
+    class Handler:
+        IDENTITY = None
+
+    def __init__(self, type_func_pairs, maxsize=1024):
+        # order matters like an isinstance chain: the first matching type wins
+        self.type_func_pairs = list(type_func_pairs)
+        self.maxsize = maxsize
+
+        self.h_type2handler = {}
+        self.h_shape2plan = {}
+
+    def type2handler(self, t):
+        handler = self.h_type2handler.get(t, self)
+        if handler is not self:
+            return handler
+
+        if issubclass(t, dict):
+            handler = self.dict2converted
+        elif issubclass(t, (list, set, tuple)):
+            handler = self.seq2converted
+        else:
+            handler = next((func for type_, func in self.type_func_pairs if issubclass(t, type_)),
+                           self.Handler.IDENTITY)
+
+        self.h_type2handler[t] = handler
+        return handler
+
+    def convert(self, x):
+        handler = self.type2handler(type(x))
+        if handler is self.Handler.IDENTITY:
+            return x
+        return handler(x)
+
+    def shape2plan(self, shape):
+        """
+        plan: (position, handler) of every value that is not passed through as is
+        """
+        plan = self.h_shape2plan.get(shape)
+        if plan is not None:
+            return plan
+
+        _, value_types = shape
+        plan = [(i, handler) for i, handler in enumerate(map(self.type2handler, value_types))
+                if handler is not self.Handler.IDENTITY]
+
+        if len(self.h_shape2plan) >= self.maxsize:
+            self.h_shape2plan.clear()
+        self.h_shape2plan[shape] = plan
+        return plan
+
+    def dict2converted(self, h):
+        t = type(h)
+        plan = self.shape2plan((t, tuple(map(type, h.values()))))
+        if not plan:
+            return t(h)
+
+        values = list(h.values())
+        for i, handler in plan:
+            values[i] = handler(values[i])
+        return t(zip(h.keys(), values))
+
+    def seq2converted(self, l):
+        t = type(l)
+        handlers = set(map(self.type2handler, set(map(type, l))))
+        if handlers <= {self.Handler.IDENTITY}:
+            return t(l)
+
+        convert = self.convert
+        return t([convert(x) for x in l])
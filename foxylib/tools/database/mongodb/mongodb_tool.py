@@ -1,20 +1,26 @@
 import decimal
 import logging
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime, timedelta
 from decimal import Decimal
 from functools import lru_cache, wraps
-from itertools import chain
+from itertools import chain, count, islice
+from threading import Lock
 from pprint import pformat
 from typing import Callable, Optional
 
 import pytz
 from bson import ObjectId, Decimal128, Timestamp
+from bson.codec_options import CodecOptions, TypeRegistry, TypeDecoder, TypeEncoder
 from bson.decimal128 import create_decimal128_context
 from future.utils import lmap
 from nose.tools import assert_in
 from pymongo import UpdateOne, InsertOne, WriteConcern, ReadPreference
-from pymongo.errors import BulkWriteError
+from pymongo.errors import BulkWriteError, AutoReconnect
 from pymongo.read_concern import ReadConcern
+from pymongo.results import BulkWriteResult
 
 from foxylib.tools.collections.collections_tool import vwrite_no_duplicate_key, \
     merge_dicts, DictTool, lchain, \
@@ -23,11 +29,11 @@ from foxylib.tools.collections.dicttree.dictschema_tool import \
     DictschemaTool
 from foxylib.tools.collections.groupby_tool import dict_groupby_tree
 from foxylib.tools.collections.iter_tool import IterTool
-from foxylib.tools.collections.traversile.traversile_tool import TraversileTool
+from foxylib.tools.database.mongodb.bson_converter import ShapeConverter
 from foxylib.tools.datetime.datetime_tool import DatetimeTool, DatetimeUnit, \
     TimedeltaTool
-from foxylib.tools.json.json_tool import JsonTool
 from foxylib.tools.log.foxylib_logger import FoxylibLogger
+from foxylib.tools.metric.metric_tool import LatencyMetric, CounterMetric, MetricTool
 from foxylib.tools.native.native_tool import is_not_none
 from foxylib.tools.native.object_tool import ObjectTool
 from foxylib.tools.span.interval_tool import IntervalTool
@@ -93,6 +99,49 @@ class BulkWriteResultTool:
         N_MATCHED = "nMatched"
         N_MODIFIED = "nModified"
         N_REMOVED = "nRemoved"
+        WRITE_ERRORS = "writeErrors"
+        WRITE_CONCERN_ERRORS = "writeConcernErrors"
+        INDEX = "index"
+        CODE = "code"
+
+    @classmethod
+    def count_fields(cls):
+        return [cls.Field.N_INSERTED, cls.Field.N_UPSERTED, cls.Field.N_MATCHED,
+                cls.Field.N_MODIFIED, cls.Field.N_REMOVED, ]
+
+    @classmethod
+    def raw_indexes2rebased(cls, raw, indexes):
+        """
+        raw of a bulk_write() over a subset of operations -> raw indexed like the full operation list.
+        indexes[i] is the position in the full list of the i-th operation sent.
+        """
+        def item2rebased(item):
+            return merge_dicts([item, {cls.Field.INDEX: indexes[item[cls.Field.INDEX]]}], vwrite=vwrite_overwrite)
+
+        h_rebased = {cls.Field.UPSERTED: lmap(item2rebased, raw.get(cls.Field.UPSERTED) or []),
+                     cls.Field.WRITE_ERRORS: lmap(item2rebased, raw.get(cls.Field.WRITE_ERRORS) or []),
+                     }
+        return merge_dicts([raw, h_rebased], vwrite=vwrite_overwrite)
+
+    @classmethod
+    def raws2merged(cls, raws):
+        raw_list = list(raws)
+
+        def key2items_sorted(key):
+            items = lchain(*[raw.get(key) or [] for raw in raw_list])
+            return sorted(items, key=lambda item: item[cls.Field.INDEX])
+
+        h_count = {field: sum(raw.get(field) or 0 for raw in raw_list) for field in cls.count_fields()}
+        h_items = {cls.Field.UPSERTED: key2items_sorted(cls.Field.UPSERTED),
+                   cls.Field.WRITE_ERRORS: key2items_sorted(cls.Field.WRITE_ERRORS),
+                   cls.Field.WRITE_CONCERN_ERRORS: lchain(*[raw.get(cls.Field.WRITE_CONCERN_ERRORS) or []
+                                                            for raw in raw_list]),
+                   }
+        return merge_dicts([h_count, h_items], vwrite=vwrite_no_duplicate_key)
+
+    @classmethod
+    def results2merged(cls, results):
+        return BulkWriteResult(cls.raws2merged(map(cls.result2raw, results)), True)
 
     @classmethod
     def result2raw(cls, result):
@@ -141,6 +190,245 @@ class BulkWriteResultTool:
         return j_result
 
 
+class BulkUpsertWriter:
+    """
+    Streaming upsert writer for (filter, update) pairs.
+
+    Pairs are cut into chunks of chunk_size operations and sent as unordered bulk_write() calls,
+    max_inflight chunks at a time. Operations that fail with a transient error are resent with
+    exponential backoff; other write errors are collected. A chunk whose whole request fails with
+    AutoReconnect is resent as a whole, which is safe for upserts ($set) but may duplicate InsertOne.
+
+    Pairs with the same filter should not appear twice if the last write must win,
+    since neither unordered writes nor concurrent chunks keep their order.
+    With ordered=True, chunks are sent one at a time as ordered bulk_write() calls and writing stops at the
+    first permanent error, like a single ordered bulk_write().
+    """
+
+    class Config:
+        class Key:
+            CHUNK_SIZE = "chunk_size"
+            MAX_INFLIGHT = "max_inflight"
+            MAX_RETRIES = "max_retries"
+            INITIAL_BACKOFF = "initial_backoff"
+            MAX_BACKOFF = "max_backoff"
+            ORDERED = "ordered"
+
+        DEFAULT = {Key.CHUNK_SIZE: 1000,
+                   Key.MAX_INFLIGHT: 4,
+                   Key.MAX_RETRIES: 5,
+                   Key.INITIAL_BACKOFF: 0.1,
+                   Key.MAX_BACKOFF: 10,
+                   Key.ORDERED: False,
+                   }
+
+        @classmethod
+        def config2value(cls, config, key):
+            return (config or {}).get(key, cls.DEFAULT[key])
+
+    class Field:
+        CHUNK = "chunk"
+        OFFSET = "offset"
+        COUNT = "count"
+        RETRIES = "retries"
+        ERRORS = "errors"
+        SECS = "secs"
+        OPS_PER_SEC = "ops_per_sec"
+        RAW = "raw"
+        COUNTS = "counts"
+        LATENCY_CHUNK = "latency_chunk"
+
+    # https://github.com/mongodb/mongo/blob/master/src/mongo/base/error_codes.yml
+    CODES_TRANSIENT = {6,  # HostUnreachable
+                       7,  # HostNotFound
+                       50,  # MaxTimeMSExpired
+                       89,  # NetworkTimeout
+                       91,  # ShutdownInProgress
+                       112,  # WriteConflict
+                       189,  # PrimarySteppedDown
+                       262,  # ExceededTimeLimit
+                       9001,  # SocketException
+                       10107,  # NotWritablePrimary
+                       11600,  # InterruptedAtShutdown
+                       11602,  # InterruptedDueToReplStateChange
+                       13435,  # NotPrimaryNoSecondaryOk
+                       13436,  # NotPrimaryOrSecondary
+                       }
+
+    def __init__(self, collection, config=None, bulk_kwargs=None):
+        self.collection = collection
+        self.config = config
+        self.bulk_kwargs = bulk_kwargs or {}
+
+        self.lock = Lock()
+        self.secs_elapsed = 0.0
+        self.counter = CounterMetric([self.Field.CHUNK, self.Field.COUNT, self.Field.RETRIES, self.Field.ERRORS, ])
+        self.latency_chunk = LatencyMetric()
+
+    def _config2value(self, key):
+        return self.Config.config2value(self.config, key)
+
+    def pairs2chunks(self, j_pairs):
+        """
+        yields (offset, operation list)
+        """
+        chunk_size = self._config2value(self.Config.Key.CHUNK_SIZE)
+        j_pair_iter = iter(j_pairs)
+
+        for offset in count(0, chunk_size):
+            ops = [MongoDBTool.pair2operation_upsert(*j_pair) for j_pair in islice(j_pair_iter, chunk_size)]
+            if not ops:
+                break
+            yield offset, ops
+
+    @classmethod
+    def error2is_transient(cls, j_error):
+        return j_error.get(BulkWriteResultTool.Field.CODE) in cls.CODES_TRANSIENT
+
+    def chunk2result(self, i_chunk, offset, ops):
+        max_retries = self._config2value(self.Config.Key.MAX_RETRIES)
+        secs_backoff = self._config2value(self.Config.Key.INITIAL_BACKOFF)
+        max_backoff = self._config2value(self.Config.Key.MAX_BACKOFF)
+        ordered = self._config2value(self.Config.Key.ORDERED)
+
+        time_start = time.perf_counter()
+        raw_list, retries = [], 0
+
+        indexes = list(range(len(ops)))
+        for attempt in range(max_retries + 1):
+            if attempt:
+                retries += 1
+                time.sleep(secs_backoff)
+                secs_backoff = min(secs_backoff * 2, max_backoff)
+
+            try:
+                result = self.collection.bulk_write([ops[i] for i in indexes], ordered=ordered, **self.bulk_kwargs)
+                raw = BulkWriteResultTool.result2raw(result)
+            except BulkWriteError as e:
+                raw = e.details
+            except AutoReconnect:
+                if attempt == max_retries:
+                    raise
+                continue
+
+            j_error_list = raw.get(BulkWriteResultTool.Field.WRITE_ERRORS) or []
+            is_retry = attempt < max_retries
+            retry_list = [j_error[BulkWriteResultTool.Field.INDEX] for j_error in j_error_list
+                          if is_retry and self.error2is_transient(j_error)]
+            retry_set = set(retry_list)
+
+            raw_kept = merge_dicts([raw,
+                                    {BulkWriteResultTool.Field.WRITE_ERRORS:
+                                         [j_error for j_error in j_error_list
+                                          if j_error[BulkWriteResultTool.Field.INDEX] not in retry_set]},
+                                    ], vwrite=vwrite_overwrite)
+            raw_list.append(BulkWriteResultTool.raw_indexes2rebased(raw_kept, [offset + i for i in indexes]))
+
+            if not retry_list:
+                break
+
+            if ordered:  # the failed op and everything after it were not executed
+                indexes = indexes[min(retry_list):]
+            else:
+                indexes = [indexes[i] for i in sorted(retry_list)]
+
+        raw_chunk = BulkWriteResultTool.raws2merged(raw_list)
+        n_errors = len(raw_chunk[BulkWriteResultTool.Field.WRITE_ERRORS])
+        secs = time.perf_counter() - time_start
+
+        self.counter.incr(self.Field.CHUNK)
+        self.counter.incr(self.Field.COUNT, len(ops))
+        self.counter.incr(self.Field.RETRIES, retries)
+        self.counter.incr(self.Field.ERRORS, n_errors)
+        self.latency_chunk.add(secs)
+
+        return {self.Field.CHUNK: i_chunk,
+                self.Field.OFFSET: offset,
+                self.Field.COUNT: len(ops),
+                self.Field.RETRIES: retries,
+                self.Field.ERRORS: n_errors,
+                self.Field.SECS: secs,
+                self.Field.OPS_PER_SEC: MetricTool.count_secs2rate(len(ops), secs),
+                self.Field.RAW: raw_chunk,
+                }
+
+    def pairs2result_iter(self, j_pairs):
+        """
+        yields one result dict per chunk, in completion order.
+        indexes in the raw results refer to positions in j_pairs.
+        """
+        max_inflight = self._config2value(self.Config.Key.MAX_INFLIGHT)
+        ordered = self._config2value(self.Config.Key.ORDERED)
+
+        time_start = time.perf_counter()
+        chunk_iter = enumerate(self.pairs2chunks(j_pairs))
+
+        if ordered:
+            try:
+                for i_chunk, (offset, ops) in chunk_iter:
+                    j_result = self.chunk2result(i_chunk, offset, ops)
+                    yield j_result
+
+                    if j_result[self.Field.ERRORS]:
+                        break
+            finally:
+                with self.lock:
+                    self.secs_elapsed += time.perf_counter() - time_start
+            return
+
+        executor = ThreadPoolExecutor(max_workers=max_inflight,
+                                      thread_name_prefix="{}.upsert".format(FoxylibLogger.rootname))
+        futures = set()
+        try:
+            for i_chunk, (offset, ops) in chunk_iter:
+                if len(futures) >= max_inflight:
+                    done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+
+                futures.add(executor.submit(self.chunk2result, i_chunk, offset, ops))
+
+            while futures:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+            with self.lock:
+                self.secs_elapsed += time.perf_counter() - time_start
+
+    def write(self, j_pairs, raise_on_error=True):
+        """
+        BulkWriteResult over all pairs. raises BulkWriteError after every chunk is done, like unordered bulk_write()
+        """
+        logger = FoxylibLogger.func_level2logger(self.write, logging.DEBUG)
+
+        raw_list = []
+        for j_result in self.pairs2result_iter(j_pairs):
+            raw_list.append(j_result[self.Field.RAW])
+            logger.debug({k: v for k, v in j_result.items() if k != self.Field.RAW})
+
+        raw = BulkWriteResultTool.raws2merged(raw_list)
+        has_error = raw[BulkWriteResultTool.Field.WRITE_ERRORS] or raw[BulkWriteResultTool.Field.WRITE_CONCERN_ERRORS]
+        if has_error and raise_on_error:
+            raise BulkWriteError(raw)
+
+        return BulkWriteResult(raw, True)
+
+    def metrics(self):
+        with self.lock:
+            secs_elapsed = self.secs_elapsed
+
+        h_count = self.counter.to_dict()
+        return {self.Field.COUNTS: h_count,
+                self.Field.OPS_PER_SEC: MetricTool.count_secs2rate(h_count[self.Field.COUNT], secs_elapsed),
+                self.Field.LATENCY_CHUNK: self.latency_chunk.to_dict(),
+                }
+
+
 class MongoDBQueryvalue:
     @classmethod
     def array_not_empty(cls):
@@ -360,35 +648,139 @@ class MongoDBTool:
         return b_in
 
     @classmethod
-    def bson2native(cls, b_in):
-        logger = FoxylibLogger.func_level2logger(cls.bson2native, logging.DEBUG)
+    def decimal1282decimal(cls, b):
+        """
+        same as Decimal128.to_decimal(), decoding the significand with int() instead of per-digit python code
+        """
+        high, low = struct.unpack("<QQ", b.bid)[::-1]
+        if (high & 0x6000000000000000) == 0x6000000000000000:  # inf, nan or non-canonical
+            return b.to_decimal()
+
+        sign = "-" if high & 0x8000000000000000 else ""
+        exponent = ((high & 0x7fff800000000000) >> 49) - 6176
+        significand = ((high & 0x1ffffffffffff) << 64) | low
+        return Decimal("{}{}E{}".format(sign, significand, exponent))
+
+    @classmethod
+    def decimal2decimal128(cls, v):
+        with decimal.localcontext(cls.decimal128_context()) as ctx:
+            return Decimal128(ctx.create_decimal(str(v)))
 
+    @classmethod
+    @lru_cache(maxsize=2)
+    def bson2native_converter(cls):
+        # same leaf rules as bson_node2native()
+        pairs = [(ObjectId, str),
+                 (Timestamp, lambda b: b.time),
+                 (Decimal128, cls.decimal1282decimal),
+                 (datetime, lambda dt: DatetimeTool.astimezone(dt, pytz.utc)),
+                 ]
+        return ShapeConverter(pairs)
+
+    @classmethod
+    @lru_cache(maxsize=2)
+    def native2bson_converter(cls):
+        pairs = [(Decimal, cls.decimal2decimal128),
+                 (timedelta, TimedeltaTool.timedelta2rune),
+                 ]
+        return ShapeConverter(pairs)
+
+    @classmethod
+    def bson2native(cls, b_in):
         if b_in is None:
             return None
 
-        j_out = TraversileTool.tree2traversed(b_in, cls.bson_node2native,)
-        return j_out
+        return cls.bson2native_converter().convert(b_in)
+
+    @classmethod
+    def _id2oid_pinpointed(cls, b_in):
+        # JsonTool.convert_pinpoint(b_in, {"_id": cls.id2oid}) on a tree that is already a fresh copy
+        if isinstance(b_in, (tuple, list, set, frozenset)):
+            return type(b_in)([cls._id2oid_pinpointed(x) for x in b_in])
+
+        if isinstance(b_in, dict) and cls.Field._ID in b_in:
+            b_in[cls.Field._ID] = cls.id2oid(b_in[cls.Field._ID])
+
+        return b_in
 
     @classmethod
     def native2bson(cls, h_in):
         if h_in is None:
             return None
 
-        def native2bson_node(v):
-            if isinstance(v, Decimal):
-                with decimal.localcontext(cls.decimal128_context()) as ctx:
-                    return Decimal128(ctx.create_decimal(str(v)))
+        b_tmp = cls.native2bson_converter().convert(h_in)
+        return cls._id2oid_pinpointed(b_tmp)
+
+    @classmethod
+    def bson_iter2native_iter(cls, bson_iter):
+        """
+        lazy. documents are converted one by one as the caller consumes them
+        """
+        converter = cls.bson2native_converter()
+        for b in bson_iter:
+            yield None if b is None else converter.convert(b)
 
-            if isinstance(v, timedelta):
-                return TimedeltaTool.timedelta2rune(v)
+    @classmethod
+    def cursor2native_iter(cls, cursor, batch_size=None):
+        if batch_size is not None:
+            cursor = cursor.batch_size(batch_size)
 
-            return v
+        return cls.bson_iter2native_iter(cursor)
 
-        pinpoint_tree = {cls.Field._ID: cls.id2oid}
+    class Codec:
+        """
+        TypeRegistry for bson2native()/native2bson() rules, so that documents are converted while being decoded.
+        with these codec options find() returns native documents already, and Decimal/timedelta values are encoded on write.
+
+        differences from bson2native()/native2bson():
+        - datetimes are decoded tz-aware in UTC (bson2native() gives naive datetimes the local timezone).
+        - "_id" strings in documents or filters are not turned into ObjectId. use id2oid() for them.
+        """
+
+        class ObjectIdDecoder(TypeDecoder):
+            bson_type = ObjectId
+
+            def transform_bson(self, value):
+                return str(value)
+
+        class TimestampDecoder(TypeDecoder):
+            bson_type = Timestamp
+
+            def transform_bson(self, value):
+                return value.time
+
+        class Decimal128Decoder(TypeDecoder):
+            bson_type = Decimal128
+
+            def transform_bson(self, value):
+                return MongoDBTool.decimal1282decimal(value)
+
+        class DecimalEncoder(TypeEncoder):
+            python_type = Decimal
 
-        b_tmp = TraversileTool.tree2traversed(h_in, native2bson_node, )
-        b_out = JsonTool.convert_pinpoint(b_tmp, pinpoint_tree)
-        return b_out
+            def transform_python(self, value):
+                return MongoDBTool.decimal2decimal128(value)
+
+        class TimedeltaEncoder(TypeEncoder):
+            python_type = timedelta
+
+            def transform_python(self, value):
+                return TimedeltaTool.timedelta2rune(value)
+
+        @classmethod
+        @lru_cache(maxsize=2)
+        def type_registry(cls):
+            return TypeRegistry([cls.ObjectIdDecoder(), cls.TimestampDecoder(), cls.Decimal128Decoder(),
+                                 cls.DecimalEncoder(), cls.TimedeltaEncoder(), ])
+
+        @classmethod
+        @lru_cache(maxsize=2)
+        def codec_options(cls):
+            return CodecOptions(tz_aware=True, tzinfo=pytz.utc, type_registry=cls.type_registry())
+
+        @classmethod
+        def collection2native(cls, collection):
+            return collection.with_options(codec_options=cls.codec_options())
 
     @classmethod
     def ids2dict_id2doc(cls, collection, ids):
@@ -475,24 +867,26 @@ class MongoDBTool:
         return UpdateOne(j_filter, {"$set": j_update}, upsert=True, )
 
     @classmethod
-    def j_pair_list2upsert(cls, collection, j_pair_list, ):
+    def j_pair_list2upsert(cls, collection, j_pair_list, config=None):
+        """
+        j_pair_list may be any iterable. see BulkUpsertWriter for config.
+        ordered, i.e. sequential and last write wins, unless config has ordered=False
+        """
         logger = FoxylibLogger.func_level2logger(cls.j_pair_list2upsert, logging.DEBUG)
 
-        # def j_pair2operation_upsertone(j_pair, ):
-        #     j_filter, j_update = j_pair
-        #     return UpdateOne(j_filter, {"$set": j_update}, upsert=True, )
-
-        op_list = lmap(lambda j_pair: cls.pair2operation_upsert(*j_pair), j_pair_list)
-        logger.debug({"op_list":op_list})
-
-        # op_list = lmap(j_pair2operation_upsertone, j_pair_list)
-        # bulk_write = ErrorTool.log_if_error(collection.bulk_write, logger)
+        config_ordered = merge_dicts([{BulkUpsertWriter.Config.Key.ORDERED: True}, config or {}],
+                                     vwrite=vwrite_overwrite)
+        writer = BulkUpsertWriter(collection, config=config_ordered)
         try:
-            result = collection.bulk_write(op_list)
+            return writer.write(j_pair_list)
         except BulkWriteError as e:
-            print(e.details)
-            raise e
-        return result
+            j_error_list = e.details.get(BulkWriteResultTool.Field.WRITE_ERRORS) or []
+            logger.error({"write_errors": len(j_error_list),
+                          "write_concern_errors": len(e.details.get(BulkWriteResultTool.Field.WRITE_CONCERN_ERRORS)
+                                                      or []),
+                          "write_errors_head": j_error_list[:3],
+                          })
+            raise
 
     @classmethod
     def doc2id(cls, doc):
@@ -0,0 +1,144 @@
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from decimal import Decimal
+from unittest import TestCase
+
+import bson
+import pytz
+from bson import ObjectId, Decimal128, Timestamp
+
+from foxylib.tools.collections.traversile.traversile_tool import TraversileTool
+from foxylib.tools.database.mongodb.bson_converter import ShapeConverter
+from foxylib.tools.database.mongodb.mongodb_tool import MongoDBTool
+from foxylib.tools.json.json_tool import JsonTool
+from foxylib.tools.log.foxylib_logger import FoxylibLogger
+
+
+def bson2native_legacy(b_in):
+    return TraversileTool.tree2traversed(b_in, MongoDBTool.bson_node2native, )
+
+
+def native2bson_legacy(h_in):
+    def native2bson_node(v):
+        if isinstance(v, Decimal):
+            return MongoDBTool.decimal2decimal128(v)
+
+        if isinstance(v, timedelta):
+            return MongoDBTool.native2bson_converter().convert(v)
+
+        return v
+
+    b_tmp = TraversileTool.tree2traversed(h_in, native2bson_node, )
+    return JsonTool.convert_pinpoint(b_tmp, {MongoDBTool.Field._ID: MongoDBTool.id2oid})
+
+
+def i2doc(i):
+    doc = {"_id": ObjectId(),
+           "name": "doc{}".format(i),
+           "count": i,
+           "price": Decimal128("{}.25".format(i)),
+           "created_at": datetime(2020, 1, 1, tzinfo=pytz.utc),
+           "tags": ["a", "b", "c"],
+           "meta": {"ts": Timestamp(i, 1), "flag": True, "scores": [1.5, Decimal128("2.5")]},
+           }
+    if i % 3 == 0:
+        doc["extra"] = None
+    return doc
+
+
+class TestShapeConverter(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        FoxylibLogger.attach_stderr2loggers(logging.DEBUG)
+
+    def test_01(self):
+        converter = ShapeConverter([(int, lambda x: x + 1)])
+        x_in = OrderedDict([("a", 1), ("b", ["x", (2, {3})]), ("c", "s")])
+
+        hyp = converter.convert(x_in)
+        self.assertEqual(hyp, OrderedDict([("a", 2), ("b", ["x", (3, {4})]), ("c", "s")]))
+        self.assertIsInstance(hyp, OrderedDict)
+
+        # same shape, different keys
+        self.assertEqual(converter.convert({"z": 1, "y": ["x", (2, {3})], "w": "s"}),
+                         {"z": 2, "y": ["x", (3, {4})], "w": "s"})
+
+        # containers are copied even when nothing is converted
+        h = {"s": "t", "l": ["u"]}
+        h_out = converter.convert(h)
+        self.assertEqual(h_out, h)
+        self.assertIsNot(h_out, h)
+
+
+class TestBsonConverter(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        FoxylibLogger.attach_stderr2loggers(logging.DEBUG)
+
+    def test_01(self):
+        doc_list = [i2doc(i) for i in range(10)]
+        self.assertEqual([MongoDBTool.bson2native(doc) for doc in doc_list],
+                         [bson2native_legacy(doc) for doc in doc_list])
+        self.assertEqual(list(MongoDBTool.bson_iter2native_iter(iter(doc_list))),
+                         [bson2native_legacy(doc) for doc in doc_list])
+
+        oid = ObjectId()
+        h_list = [{"_id": str(oid), "d": Decimal("1.10"), "td": timedelta(days=1, seconds=5), "l": [{"_id": "x"}]},
+                  [{"_id": oid, "v": Decimal("3")}],
+                  ]
+        for h in h_list:
+            self.assertEqual(MongoDBTool.native2bson(h), native2bson_legacy(h))
+        self.assertEqual(h_list[0]["_id"], str(oid))  # input left untouched
+
+    def test_02(self):
+        """
+        codec options convert during decode and encode
+        """
+        codec_options = MongoDBTool.Codec.codec_options()
+
+        doc = i2doc(7)
+        hyp = bson.decode(bson.encode(doc), codec_options=codec_options)
+        self.assertEqual(hyp, MongoDBTool.bson2native(doc))
+
+        h = {"d": Decimal("1.10"), "td": timedelta(hours=2)}
+        hyp = bson.decode(bson.encode(h, codec_options=codec_options))
+        self.assertEqual(hyp, MongoDBTool.native2bson(h))
+
+    def test_03(self):
+        """
+        benchmark: 10k documents
+        """
+        logger = FoxylibLogger.func_level2logger(self.test_03, logging.DEBUG)
+
+        doc_list = [i2doc(i) for i in range(10000)]
+
+        time_start = time.perf_counter()
+        ref = [bson2native_legacy(doc) for doc in doc_list]
+        secs_legacy = time.perf_counter() - time_start
+
+        time_start = time.perf_counter()
+        hyp = list(MongoDBTool.bson_iter2native_iter(doc_list))
+        secs_compiled = time.perf_counter() - time_start
+
+        data = b"".join(bson.encode(doc) for doc in doc_list)
+        time_start = time.perf_counter()
+        hyp_codec = bson.decode_all(data, MongoDBTool.Codec.codec_options())
+        secs_codec = time.perf_counter() - time_start
+
+        time_start = time.perf_counter()
+        bson.decode_all(data)
+        secs_decode = time.perf_counter() - time_start
+
+        logger.info({"secs legacy": secs_legacy, "secs compiled": secs_compiled,
+                     "secs codec decode": secs_codec, "secs plain decode": secs_decode})
+        self.assertEqual(hyp, ref)
+        self.assertEqual(hyp_codec, ref)
+        self.assertLess(secs_compiled, secs_legacy)
+
+    def test_04(self):
+        for v in ["0", "-0", "0.00", "1E+10", "-1.5E-300", "NaN", "-Infinity", "1E-6176",
+                  "9999999999999999999999999999999999", "9.999999999999999999999999999999999E+6144"]:
+            b = Decimal128(v)
+            self.assertEqual(str(MongoDBTool.decimal1282decimal(b)), str(b.to_decimal()))
@@ -0,0 +1,166 @@
+import logging
+from threading import Lock
+from unittest import TestCase
+
+from bson import ObjectId
+from pymongo import InsertOne
+from pymongo.errors import BulkWriteError, AutoReconnect
+from pymongo.results import BulkWriteResult
+
+from foxylib.tools.database.mongodb.mongodb_tool import BulkUpsertWriter, BulkWriteResultTool, MongoDBTool
+from foxylib.tools.log.foxylib_logger import FoxylibLogger
+
+
+class LocalCollection:
+    """
+    stand-in for pymongo Collection.bulk_write() over UpdateOne($set, upsert)/InsertOne
+    """
+
+    def __init__(self, h_key2failures=None, keys_invalid=None, reconnect_first=False):
+        self.h_key2failures = dict(h_key2failures or {})
+        self.keys_invalid = set(keys_invalid or [])
+        self.reconnect_first = reconnect_first
+
+        self.lock = Lock()
+        self.h_key2doc = {}
+        self.calls = []
+
+    def bulk_write(self, ops, ordered=True):
+        with self.lock:
+            self.calls.append((len(ops), ordered))
+            if self.reconnect_first and len(self.calls) == 1:
+                raise AutoReconnect("not master")
+
+            raw = {"nInserted": 0, "nUpserted": 0, "nMatched": 0, "nModified": 0, "nRemoved": 0,
+                   "upserted": [], "writeErrors": [], "writeConcernErrors": [], }
+            for i, op in enumerate(ops):
+                if ordered and raw["writeErrors"]:
+                    break  # ordered writes stop at the first error
+
+                if isinstance(op, InsertOne):
+                    raw["nInserted"] += 1
+                    continue
+
+                key = op._filter["key"]
+                if key in self.keys_invalid:
+                    raw["writeErrors"].append({"index": i, "code": 121, "errmsg": "validation"})
+                    continue
+
+                if self.h_key2failures.get(key):
+                    self.h_key2failures[key] -= 1
+                    raw["writeErrors"].append({"index": i, "code": 112, "errmsg": "WriteConflict"})
+                    continue
+
+                if key in self.h_key2doc:
+                    raw["nMatched"] += 1
+                    raw["nModified"] += 1
+                    self.h_key2doc[key].update(op._doc["$set"])
+                else:
+                    _id = ObjectId()
+                    raw["nUpserted"] += 1
+                    raw["upserted"].append({"index": i, "_id": _id})
+                    self.h_key2doc[key] = dict(op._doc["$set"], _id=_id)
+
+        if raw["writeErrors"]:
+            raise BulkWriteError(raw)
+        return BulkWriteResult(raw, True)
+
+
+def j_pair_iter(n):
+    for i in range(n):
+        yield {"key": i}, {"key": i, "value": i * i}
+
+
+class TestBulkUpsertWriter(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        FoxylibLogger.attach_stderr2loggers(logging.DEBUG)
+
+    def test_01(self):
+        collection = LocalCollection()
+        writer = BulkUpsertWriter(collection, config={"chunk_size": 100, "max_inflight": 3})
+
+        result = writer.write(j_pair_iter(1050))
+        raw = BulkWriteResultTool.result2raw(result)
+        self.assertEqual(raw["nUpserted"], 1050)
+        self.assertEqual([j["index"] for j in raw["upserted"]], list(range(1050)))
+        self.assertEqual(collection.h_key2doc[1049]["_id"], raw["upserted"][1049]["_id"])
+        self.assertEqual(len(collection.calls), 11)
+        self.assertTrue(all(not ordered for _, ordered in collection.calls))
+
+        j_metrics = writer.metrics()
+        self.assertEqual(j_metrics[BulkUpsertWriter.Field.COUNTS][BulkUpsertWriter.Field.COUNT], 1050)
+        self.assertIsNotNone(j_metrics[BulkUpsertWriter.Field.OPS_PER_SEC])
+
+        # second write matches instead of upserting
+        result = MongoDBTool.j_pair_list2upsert(collection, [({"key": 3}, {"value": 0})])
+        self.assertEqual(BulkWriteResultTool.result2count_matched(result), 1)
+        self.assertEqual(collection.h_key2doc[3]["value"], 0)
+
+    def test_02(self):
+        """
+        only ops with transient errors are resent; indexes refer to the input
+        """
+        collection = LocalCollection(h_key2failures={5: 2, 17: 1}, reconnect_first=True)
+        writer = BulkUpsertWriter(collection, config={"chunk_size": 10, "max_inflight": 1, "initial_backoff": 0.001})
+
+        result = writer.write(j_pair_iter(20))
+        raw = BulkWriteResultTool.result2raw(result)
+        self.assertEqual(raw["nUpserted"], 20)
+        self.assertEqual(raw["writeErrors"], [])
+        self.assertEqual(sorted(j["index"] for j in raw["upserted"]), list(range(20)))
+
+        # reconnect resends the whole chunk, retries carry the failed op only
+        self.assertEqual([n for n, _ in collection.calls], [10, 10, 1, 1, 10, 1])
+        self.assertEqual(writer.metrics()[BulkUpsertWriter.Field.COUNTS][BulkUpsertWriter.Field.RETRIES], 4)
+
+    def test_03(self):
+        """
+        permanent errors are not retried and raised once every chunk is written
+        """
+        collection = LocalCollection(keys_invalid={3, 12})
+        writer = BulkUpsertWriter(collection, config={"chunk_size": 10, "initial_backoff": 0.001})
+
+        with self.assertRaises(BulkWriteError) as cm:
+            writer.write(j_pair_iter(20))
+
+        raw = cm.exception.details
+        self.assertEqual([j["index"] for j in raw["writeErrors"]], [3, 12])
+        self.assertEqual(raw["nUpserted"], 18)
+        self.assertEqual(len(collection.calls), 2)
+
+    def test_04(self):
+        raw_list = [BulkWriteResultTool.raw_indexes2rebased({"nUpserted": 1, "upserted": [{"index": 0, "_id": 1}]},
+                                                            [7]),
+                    {"nUpserted": 1, "nMatched": 2, "upserted": [{"index": 2, "_id": 2}]},
+                    ]
+        result = BulkWriteResultTool.results2merged([BulkWriteResult(raw, True) for raw in raw_list])
+
+        hyp = BulkWriteResultTool.result2raw(result)
+        self.assertEqual(hyp["nUpserted"], 2)
+        self.assertEqual(hyp["nMatched"], 2)
+        self.assertEqual(hyp["upserted"], [{"index": 2, "_id": 2}, {"index": 7, "_id": 1}])
+
+    def test_05(self):
+        """
+        j_pair_list2upsert() is ordered by default: sequential chunks, last write wins, stops at the first error
+        """
+        collection = LocalCollection(h_key2failures={4: 1}, keys_invalid={"invalid"})
+        j_pair_list = [({"key": i % 10 if i != 13 else "invalid"}, {"value": i}) for i in range(20)]
+
+        with self.assertRaises(BulkWriteError) as cm:
+            MongoDBTool.j_pair_list2upsert(collection, j_pair_list,
+                                           config={"chunk_size": 6, "initial_backoff": 0.001})
+
+        self.assertTrue(all(ordered for _, ordered in collection.calls))
+        self.assertEqual([j["index"] for j in cm.exception.details["writeErrors"]], [13])
+
+        # transient error at 4 resends 4 and what follows in its chunk. nothing after 13 is written
+        self.assertEqual([n for n, _ in collection.calls], [6, 2, 6, 6])
+        self.assertEqual(collection.h_key2doc[1]["value"], 11)
+        self.assertEqual(collection.h_key2doc[2]["value"], 12)
+        self.assertEqual(collection.h_key2doc[4]["value"], 4)
+
+        collection = LocalCollection()
+        MongoDBTool.j_pair_list2upsert(collection, j_pair_list, config={"ordered": False, "chunk_size": 5})
+        self.assertTrue(all(not ordered for _, ordered in collection.calls))
@@ -1,6 +1,7 @@
 import logging
 import os
 import sys
+from contextlib import contextmanager
 from functools import reduce, lru_cache
 
 from foxylib.tools.log.logger_tool import LoggerTool, FoxylibLogFormatter
@@ -13,6 +14,9 @@ class FoxylibLogger:
     rootname = os.path.basename(REPO_DIR)
     # level = logging.DEBUG
 
+    _h_func_level2logger = {}
+    _noop = False
+
     @classmethod
     def rootname_list(cls):
         return [cls.rootname, ]
@@ -23,10 +27,54 @@ class FoxylibLogger:
 
     @classmethod
     def func_level2logger(cls, func, level):
+        """
+        memoized by (function, level). bound methods are keyed by their underlying function.
+        logging.getLogger() and setLevel() run only on the first lookup,
+        because setLevel() clears the level cache of every logger in the process.
+        """
+        if cls._noop:
+            return cls.logger_noop()
+
+        k = (getattr(func, "__func__", func), level)
+        logger = cls._h_func_level2logger.get(k)
+        if logger is not None:
+            return logger
+
         logger = logging.getLogger(cls.func2name(func))
-        logger.setLevel(level)
+        if logger.level != level:
+            logger.setLevel(level)
+
+        cls._h_func_level2logger[k] = logger
+        return logger
+
+    @classmethod
+    @lru_cache(maxsize=2)
+    def logger_noop(cls):
+        logger = logging.Logger(".".join([cls.rootname, "noop"]))
+        logger.disabled = True
         return logger
 
+    @classmethod
+    def set_noop(cls, noop):
+        """
+        noop=True makes func_level2logger() return a disabled logger without any lookup.
+        """
+        cls._noop = bool(noop)
+
+    @classmethod
+    @contextmanager
+    def noop(cls):
+        noop_prev = cls._noop
+        cls.set_noop(True)
+        try:
+            yield
+        finally:
+            cls.set_noop(noop_prev)
+
+    @classmethod
+    def clear_loggers(cls):
+        cls._h_func_level2logger.clear()
+
     # @classmethod
     # def func2logger(cls, func):
     #     return cls.func_level2logger(func, cls.level)
@@ -0,0 +1,85 @@
+import logging
+import time
+from datetime import datetime
+from unittest import TestCase, mock
+
+import pytz
+from bson import ObjectId, Decimal128
+
+from foxylib.tools.database.mongodb.mongodb_tool import MongoDBTool
+from foxylib.tools.log.foxylib_logger import FoxylibLogger
+from foxylib.tools.log.logger_tool import LoggerTool
+
+
+class TestFoxylibLogger(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        FoxylibLogger.attach_stderr2loggers(logging.DEBUG)
+
+    def test_01(self):
+        logger1 = FoxylibLogger.func_level2logger(self.test_01, logging.DEBUG)
+        logger2 = FoxylibLogger.func_level2logger(self.test_01, logging.DEBUG)
+
+        self.assertIs(logger1, logger2)
+        self.assertEqual(logger1.name, FoxylibLogger.func2name(self.test_01))
+        self.assertEqual(logger1.level, logging.DEBUG)
+
+    def test_02(self):
+        with FoxylibLogger.noop():
+            logger = FoxylibLogger.func_level2logger(self.test_02, logging.DEBUG)
+            self.assertIs(logger, FoxylibLogger.logger_noop())
+            self.assertFalse(logger.isEnabledFor(logging.CRITICAL))
+
+        logger = FoxylibLogger.func_level2logger(self.test_02, logging.DEBUG)
+        self.assertIsNot(logger, FoxylibLogger.logger_noop())
+
+    def test_03(self):
+        """
+        micro-benchmark: per-call overhead of MongoDBTool.bson2native() over 10k documents
+        """
+        logger = FoxylibLogger.func_level2logger(self.test_03, logging.DEBUG)
+
+        dt = datetime(2020, 1, 1, tzinfo=pytz.utc)
+        doc_list = [{"_id": ObjectId(), "i": i, "d": Decimal128("1.1"), "dt": dt, "l": [i, str(i)]}
+                    for i in range(10000)]
+
+        def func_level2logger_legacy(func, level):
+            return LoggerTool.name_level2logger(FoxylibLogger.func2name(func), level)
+
+        def docs2secs():
+            time_start = time.perf_counter()
+            result = [MongoDBTool.bson2native(doc) for doc in doc_list]
+            return time.perf_counter() - time_start, result
+
+        with mock.patch.object(FoxylibLogger, "func_level2logger", side_effect=func_level2logger_legacy):
+            secs_legacy, result_legacy = docs2secs()
+
+        secs_memoized, result_memoized = docs2secs()
+
+        with FoxylibLogger.noop():
+            secs_noop, result_noop = docs2secs()
+
+        logger.info({"usec/call legacy": secs_legacy * 1e6 / len(doc_list),
+                     "usec/call memoized": secs_memoized * 1e6 / len(doc_list),
+                     "usec/call noop": secs_noop * 1e6 / len(doc_list),
+                     })
+
+        self.assertEqual(result_legacy, result_memoized)
+        self.assertEqual(result_legacy, result_noop)
+
+        # logger acquisition only
+        n = 10000
+        time_start = time.perf_counter()
+        for _ in range(n):
+            func_level2logger_legacy(MongoDBTool.bson2native, logging.DEBUG)
+        secs_acquire_legacy = time.perf_counter() - time_start
+
+        time_start = time.perf_counter()
+        for _ in range(n):
+            FoxylibLogger.func_level2logger(MongoDBTool.bson2native, logging.DEBUG)
+        secs_acquire_memoized = time.perf_counter() - time_start
+
+        logger.info({"usec/acquire legacy": secs_acquire_legacy * 1e6 / n,
+                     "usec/acquire memoized": secs_acquire_memoized * 1e6 / n,
+                     })
+        self.assertLess(secs_acquire_memoized, secs_acquire_legacy)
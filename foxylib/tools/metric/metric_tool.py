@@ -0,0 +1,137 @@
+import time
+from bisect import bisect_left
+from itertools import accumulate
+from threading import Lock
+
+
+class LatencyMetric:
+    """
+    thread-safe count/total/max of durations in seconds
+    """
+
+    class Field:
+        COUNT = "count"
+        TOTAL = "total"
+        MEAN = "mean"
+        MAX = "max"
+
+    def __init__(self):
+        self.lock = Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, secs):
+        with self.lock:
+            self.count += 1
+            self.total += secs
+            if secs > self.max:
+                self.max = secs
+
+    def reset(self):
+        with self.lock:
+            self.count = 0
+            self.total = 0.0
+            self.max = 0.0
+
+    def to_dict(self):
+        with self.lock:
+            count, total, max_ = self.count, self.total, self.max
+
+        return {self.Field.COUNT: count,
+                self.Field.TOTAL: total,
+                self.Field.MEAN: total / count if count else None,
+                self.Field.MAX: max_,
+                }
+
+
+class CounterMetric:
+    """
+    thread-safe dict of named counters
+    """
+
+    def __init__(self, names=None):
+        self.lock = Lock()
+        self.h_name2count = {name: 0 for name in (names or [])}
+
+    def incr(self, name, n=1):
+        with self.lock:
+            self.h_name2count[name] = self.h_name2count.get(name, 0) + n
+
+    def name2count(self, name):
+        return self.h_name2count.get(name, 0)
+
+    def reset(self):
+        with self.lock:
+            self.h_name2count = {name: 0 for name in self.h_name2count}
+
+    def to_dict(self):
+        with self.lock:
+            return dict(self.h_name2count)
+
+
+class HistogramMetric:
+    """
+    thread-safe histogram of durations in seconds over fixed bucket upper bounds, Prometheus style
+    """
+
+    BOUNDS_DEFAULT = (1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0, 10.0)
+
+    class Field:
+        COUNT = "count"
+        TOTAL = "total"
+        MEAN = "mean"
+        MAX = "max"
+        BUCKETS = "buckets"
+
+    def __init__(self, bounds=None):
+        self.bounds = tuple(sorted(bounds if bounds is not None else self.BOUNDS_DEFAULT))
+
+        self.lock = Lock()
+        self.counts = [0] * (len(self.bounds) + 1)  # last one is +Inf
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, secs):
+        i = bisect_left(self.bounds, secs)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.total += secs
+            if secs > self.max:
+                self.max = secs
+
+    def reset(self):
+        with self.lock:
+            self.counts = [0] * (len(self.bounds) + 1)
+            self.count = 0
+            self.total = 0.0
+            self.max = 0.0
+
+    def to_dict(self):
+        """
+        buckets: [(upper bound, cumulative count), ...], the last bound being None for +Inf
+        """
+        with self.lock:
+            counts, count, total, max_ = list(self.counts), self.count, self.total, self.max
+
+        return {self.Field.COUNT: count,
+                self.Field.TOTAL: total,
+                self.Field.MEAN: total / count if count else None,
+                self.Field.MAX: max_,
+                self.Field.BUCKETS: list(zip(list(self.bounds) + [None], accumulate(counts))),
+                }
+
+
+class MetricTool:
+    @classmethod
+    def secs_elapsed(cls, time_start):
+        return time.perf_counter() - time_start
+
+    @classmethod
+    def count_secs2rate(cls, count, secs):
+        if not secs:
+            return None
+        return count / secs
+
@@ -0,0 +1,52 @@
+import logging
+from unittest import TestCase
+
+from foxylib.tools.log.foxylib_logger import FoxylibLogger
+from foxylib.tools.metric.metric_tool import LatencyMetric, CounterMetric, MetricTool, HistogramMetric
+
+
+class TestLatencyMetric(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        FoxylibLogger.attach_stderr2loggers(logging.DEBUG)
+
+    def test_01(self):
+        metric = LatencyMetric()
+        self.assertEqual(metric.to_dict()["mean"], None)
+
+        metric.add(1.0)
+        metric.add(3.0)
+
+        hyp = metric.to_dict()
+        ref = {"count": 2, "total": 4.0, "mean": 2.0, "max": 3.0}
+        self.assertEqual(hyp, ref)
+
+
+class TestCounterMetric(TestCase):
+    def test_01(self):
+        metric = CounterMetric(["a"])
+        metric.incr("a")
+        metric.incr("b", 3)
+
+        self.assertEqual(metric.to_dict(), {"a": 1, "b": 3})
+
+        metric.reset()
+        self.assertEqual(metric.to_dict(), {"a": 0, "b": 0})
+
+
+class TestMetricTool(TestCase):
+    def test_01(self):
+        self.assertEqual(MetricTool.count_secs2rate(10, 2), 5)
+        self.assertIsNone(MetricTool.count_secs2rate(10, 0))
+
+
+class TestHistogramMetric(TestCase):
+    def test_01(self):
+        metric = HistogramMetric(bounds=[1, 10])
+        for secs in [0.5, 1, 5, 100]:
+            metric.add(secs)
+
+        hyp = metric.to_dict()
+        self.assertEqual(hyp["buckets"], [(1, 2), (10, 3), (None, 4)])
+        self.assertEqual(hyp["count"], 4)
+        self.assertEqual(hyp["max"], 100)
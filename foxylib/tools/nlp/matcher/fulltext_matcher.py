@@ -11,14 +11,19 @@ from foxylib.tools.collections.collections_tool import lchain, DictTool, \
 from future.utils import lmap
 
 from foxylib.tools.log.foxylib_logger import FoxylibLogger
+from foxylib.tools.nlp.matcher.matcher_index import MatcherIndex
 from foxylib.tools.regex.regex_tool import RegexTool
 from foxylib.tools.string.string_tool import StringTool
 
 
 class FulltextMatcher:
-    def __init__(self, dict_value2texts, config=None):
+    def __init__(self, dict_value2texts, config=None, index=None):
+        """
+        index: prebuilt MatcherIndex or MmapMatcherIndex over normalized texts. built from dict_value2texts if None
+        """
         self.dict_value2texts = dict_value2texts or {}
         self.config = config
+        self._index = index
 
     class Config:
         class Key:
@@ -51,34 +56,46 @@ class FulltextMatcher:
 
         return dict_text2values
 
-    @CacheManager.attach_cachedmethod(self2cache=lambda x: LRUCache(maxsize=2),)
+    def index(self):
+        cls = self.__class__
+
+        if self._index is None:
+            dict_value2texts = self.dict_value2texts
+            normalizer = cls.Config.config2normalizer(self.config)
+            dict_value2norms = cls.dict2normalized(dict_value2texts, normalizer) if normalizer else dict_value2texts
+            self._index = MatcherIndex.dict2index(dict_value2norms)
+
+        return self._index
+
     def _dict_text2values(self):
+        return self.index().to_dict_text2values()
+
+    def warmup(self):
+        self.index()
+
+    def text2norm(self, text):
         cls = self.__class__
 
-        dict_value2texts = self.dict_value2texts
         normalizer = cls.Config.config2normalizer(self.config)
-        dict_value2norms = cls.dict2normalized(dict_value2texts, normalizer) if normalizer else dict_value2texts
-        dict_norm2values = cls.dict2reversed(dict_value2norms)
-        # raise Exception({
-        #     "dict_value2norms":dict_value2norms,
-        #     "dict_norm2values":dict_norm2values,
-        # })
-        return dict_norm2values
+        return normalizer(text) if normalizer else text
 
-    def warmup(self):
-        self._dict_text2values()
+    def add_value(self, value, texts):
+        self.index().add(value, lmap(self.text2norm, texts))
+
+    def remove_value(self, value):
+        self.index().remove(value)
+
+    def update_value(self, value, texts):
+        self.index().update(value, lmap(self.text2norm, texts))
 
     def text2values(self, text):
         logger = FoxylibLogger.func_level2logger(self.text2values,
                                                  logging.DEBUG)
 
-        cls = self.__class__
-        normalizer = cls.Config.config2normalizer(self.config)
-        text_norm = normalizer(text) if normalizer else text
-        h = self._dict_text2values()
-        values = h.get(text_norm) or []
+        text_norm = self.text2norm(text)
+        values = self.index().text2values(text_norm) or []
 
-        # logger.debug({"text":text, "text_norm":text_norm, 'h':h})
+        # logger.debug({"text":text, "text_norm":text_norm, })
 
         return values
 
@@ -10,19 +10,29 @@ from foxylib.tools.collections.collections_tool import lchain, DictTool, merge_d
 from future.utils import lmap
 
 from foxylib.tools.log.foxylib_logger import FoxylibLogger
+from foxylib.tools.nlp.matcher.matcher_index import MatcherIndex
 from foxylib.tools.regex.regex_tool import RegexTool
 from foxylib.tools.string.string_tool import StringTool
 
 
 class GazetteerMatcher:
-    def __init__(self, dict_value2texts, config=None):
+    def __init__(self, dict_value2texts, config=None, index=None):
+        """
+        index: prebuilt MatcherIndex or MmapMatcherIndex over normalized texts. built from dict_value2texts if None
+        """
         self.dict_value2texts = dict_value2texts or {}
         self.config = config
+        self._index = index
+
+    class Backend:
+        REGEX = "regex"
+        TRIE = "trie"
 
     class Config:
         class Key:
             NORMALIZER = "normalizer"
-            TEXTS2PATTERN = "texts2pattern"
+            TEXTS2PATTERN = "texts2pattern"  # regex backend only
+            BACKEND = "backend"
 
         @classmethod
         def config2normalizer(cls, config):
@@ -32,6 +42,10 @@ class GazetteerMatcher:
         def config2pattern_generator(cls, config):
             return DictTool.lookup(config, cls.Key.TEXTS2PATTERN)
 
+        @classmethod
+        def config2backend(cls, config):
+            return DictTool.lookup(config, cls.Key.BACKEND, GazetteerMatcher.Backend.REGEX)
+
     @classmethod
     def append_value2texts(cls, dict_value2texts):
         return {value: lchain(texts, [value])
@@ -60,14 +74,32 @@ class GazetteerMatcher:
 
         return dict_text2values
 
-    @CacheManager.attach_cachedmethod(self2cache=lambda x: LRUCache(maxsize=2),)
-    def _dict_text2values(self):
+    def index(self):
         cls = self.__class__
 
-        dict_value2texts = self.dict_value2texts
-        normalizer = cls.Config.config2normalizer(self.config)
-        dict_value2norms = cls.dict2normalized(dict_value2texts, normalizer) if normalizer else dict_value2texts
-        return cls.dict2reversed(dict_value2norms)
+        if self._index is None:
+            dict_value2texts = self.dict_value2texts
+            normalizer = cls.Config.config2normalizer(self.config)
+            dict_value2norms = cls.dict2normalized(dict_value2texts, normalizer) if normalizer else dict_value2texts
+            self._index = MatcherIndex.dict2index(dict_value2norms)
+
+        return self._index
+
+    def _dict_text2values(self):
+        return self.index().to_dict_text2values()
+
+    def _index2updated(self, f_update):
+        f_update(self.index())
+        CacheManager.delete_key(self.pattern)  # recompiled lazily
+
+    def add_value(self, value, texts):
+        self._index2updated(lambda index: index.add(value, lmap(self.text2norm, texts)))
+
+    def remove_value(self, value):
+        self._index2updated(lambda index: index.remove(value))
+
+    def update_value(self, value, texts):
+        self._index2updated(lambda index: index.update(value, lmap(self.text2norm, texts)))
 
     class Default:
         @classmethod
@@ -84,29 +116,81 @@ class GazetteerMatcher:
     def pattern(self):
         cls = self.__class__
         texts2pattern = cls.Config.config2pattern_generator(self.config) or cls.Default.texts2pattern_word
-        return texts2pattern(self._dict_text2values().keys())
+        return texts2pattern(self.index().texts())
 
     def warmup(self):
-        self.pattern()
-        self._dict_text2values()
+        cls = self.__class__
 
-    def text2matches(self, text):
+        self.index()
+        if cls.Config.config2backend(self.config) != cls.Backend.TRIE:
+            self.pattern()
+
+    def text2norm(self, text):
         cls = self.__class__
 
         normalizer = cls.Config.config2normalizer(self.config)
-        text_norm = normalizer(text) if normalizer else text
+        return normalizer(text) if normalizer else text
 
-        return self.pattern().finditer(text_norm)
+    def text2matches(self, text):
+        return self.pattern().finditer(self.text2norm(text))
 
     def match2span_value_iter(self, match):
-        _dict_text2values = self._dict_text2values()
-        for v in _dict_text2values[match.group()]:
+        for v in self.index().text2values(match.group()):
             yield (match.span(), v,)
 
+    @classmethod
+    def index_text2spans_wordbounded(cls, index, text):
+        """
+        same spans as Default.texts2pattern_word(), i.e. leftmost and longest,
+        non-overlapping, bounded by whitespace, word boundary or string ends
+        """
+        n = len(text)
+        is_word = [c.isalnum() or c == "_" for c in text]
+        is_space = [c.isspace() for c in text]
+
+        def is_bound_left(i):
+            if i == 0:
+                return True
+            return is_space[i - 1] or is_word[i - 1] != is_word[i]
+
+        def is_bound_right(i):
+            if i == n:
+                return True
+            return is_space[i] or is_word[i - 1] != is_word[i]
+
+        i = 0
+        while i < n:
+            if not is_bound_left(i):
+                i += 1
+                continue
+
+            ends = index.text_start2ends(text, i)
+            end = next((e for e in reversed(ends) if is_bound_right(e)), None)
+            if end is None:
+                i += 1
+                continue
+
+            yield i, end
+            i = end
+
     def text2span_value_iter(self, text):
-        matches = self.text2matches(text)
-        for match in matches:
-            yield from self.match2span_value_iter(match)
+        cls = self.__class__
+
+        if cls.Config.config2backend(self.config) != cls.Backend.TRIE:
+            for match in self.text2matches(text):
+                yield from self.match2span_value_iter(match)
+            return
+
+        text_norm = self.text2norm(text)
+        index = self.index()
+        for span in cls.index_text2spans_wordbounded(index, text_norm):
+            s, e = span
+            for v in index.text2values(text_norm[s:e]):
+                yield (span, v,)
+
+    def texts2span_value_lists(self, texts):
+        self.warmup()
+        return [list(self.text2span_value_iter(text)) for text in texts]
 
     def text2sub(self, text):
         span_value_list = list(self.text2span_value_iter(text))
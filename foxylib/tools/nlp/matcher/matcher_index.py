@@ -0,0 +1,222 @@
+import mmap
+import os
+import pickle
+import struct
+from bisect import bisect_left
+
+import numpy as np
+
+from foxylib.tools.collections.iter_tool import IterTool
+from foxylib.tools.file.file_tool import FileTool
+from foxylib.tools.string.trie.trie_tool import TrieTool
+
+
+class MatcherIndex:
+    """
+    Incrementally updatable index of (normalized) text -> values,
+    shared by FulltextMatcher and GazetteerMatcher.
+
+    dump() writes a read-only file that MmapMatcherIndex opens without rebuilding anything,
+    so worker processes can share one prebuilt index.
+    """
+
+    def __init__(self):
+        self.dict_value2texts = {}
+        self.dict_text2values = {}
+        self.trie = {}
+        self.version = 0
+
+    @classmethod
+    def dict2index(cls, dict_value2texts):
+        index = cls()
+        for value, texts in dict_value2texts.items():
+            index.add(value, texts)
+        return index
+
+    def add(self, value, texts):
+        texts_prev = set(self.dict_value2texts.get(value, []))
+        texts_new = [text for text in IterTool.uniq(texts) if text not in texts_prev]  # normalizers may collide
+        if not texts_new:
+            return self
+
+        self.dict_value2texts.setdefault(value, []).extend(texts_new)
+        for text in texts_new:
+            values = self.dict_text2values.get(text)
+            if values is None:
+                values = self.dict_text2values[text] = set()
+                TrieTool.trie_text2added(self.trie, text)
+            values.add(value)
+
+        self.version += 1
+        return self
+
+    def remove(self, value):
+        texts = self.dict_value2texts.pop(value, None)
+        if texts is None:
+            return self
+
+        for text in texts:
+            values = self.dict_text2values.get(text)
+            if values is None:
+                continue
+
+            values.discard(value)
+            if not values:
+                self.dict_text2values.pop(text, None)
+                TrieTool.trie_text2removed(self.trie, text)
+
+        self.version += 1
+        return self
+
+    def update(self, value, texts):
+        self.remove(value)
+        return self.add(value, texts)
+
+    def texts(self):
+        return self.dict_text2values.keys()
+
+    def to_dict_text2values(self):
+        return self.dict_text2values
+
+    def text2values(self, text):
+        return self.dict_text2values.get(text) or set()
+
+    def text_start2ends(self, text, start):
+        return TrieTool.trie_text_start2ends(self.trie, text, start)
+
+    def dump(self, filepath):
+        MmapMatcherIndex.index2file(self, filepath)
+
+
+class MmapMatcherIndex:
+    """
+    Read-only MatcherIndex over a memory-mapped file.
+
+    Layout: MAGIC, key count n, key offsets (n+1), value offsets (n+1),
+    utf-8 keys sorted bytewise, pickled value list per key.
+    Keys with a common prefix are contiguous, so prefix lookups are binary searches.
+    """
+
+    MAGIC = b"FXMI0001"
+
+    class ReadOnlyException(Exception):
+        """
+        to update, convert with to_index() and dump() again
+        """
+        pass
+
+    class _KeySequence:
+        def __init__(self, index):
+            self.index = index
+
+        def __len__(self):
+            return self.index.count
+
+        def __getitem__(self, i):
+            return self.index.i2key(i)
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+
+        with open(filepath, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.mm[:len(self.MAGIC)] != self.MAGIC:
+            raise ValueError({"filepath": filepath})
+
+        offset = len(self.MAGIC)
+        self.count, = struct.unpack_from("<Q", self.mm, offset)
+        offset += 8
+
+        self.offsets_key = np.frombuffer(self.mm, dtype="<u8", count=self.count + 1, offset=offset)
+        offset += 8 * (self.count + 1)
+
+        self.offsets_value = np.frombuffer(self.mm, dtype="<u8", count=self.count + 1, offset=offset)
+        self.keys = self._KeySequence(self)
+
+    @classmethod
+    def index2file(cls, index, filepath):
+        keys = sorted(text.encode("utf-8") for text in index.texts())
+        values = [pickle.dumps(list(index.text2values(key.decode("utf-8")))) for key in keys]
+
+        n = len(keys)
+        base_key = len(cls.MAGIC) + 8 + 2 * 8 * (n + 1)
+        offsets_key = np.cumsum([base_key] + [len(k) for k in keys], dtype=np.uint64)
+        offsets_value = np.cumsum([int(offsets_key[-1])] + [len(v) for v in values], dtype=np.uint64)
+
+        FileTool.makedirs_or_skip(os.path.dirname(filepath))
+        filepath_tmp = "{}.tmp".format(filepath)
+        with open(filepath_tmp, "wb") as f:
+            f.write(cls.MAGIC)
+            f.write(struct.pack("<Q", n))
+            f.write(offsets_key.astype("<u8").tobytes())
+            f.write(offsets_value.astype("<u8").tobytes())
+            f.writelines(keys)
+            f.writelines(values)
+        os.replace(filepath_tmp, filepath)
+
+    @classmethod
+    def filepath2index(cls, filepath):
+        return cls(filepath)
+
+    def close(self):
+        self.offsets_key = self.offsets_value = None
+        self.mm.close()
+
+    def i2key(self, i):
+        return self.mm[int(self.offsets_key[i]):int(self.offsets_key[i + 1])]
+
+    def i2values(self, i):
+        return pickle.loads(self.mm[int(self.offsets_value[i]):int(self.offsets_value[i + 1])])
+
+    def _key2i(self, key):
+        i = bisect_left(self.keys, key)
+        if i < self.count and self.i2key(i) == key:
+            return i
+        return None
+
+    def texts(self):
+        return [self.i2key(i).decode("utf-8") for i in range(self.count)]
+
+    def text2values(self, text):
+        i = self._key2i(text.encode("utf-8"))
+        if i is None:
+            return set()
+        return set(self.i2values(i))
+
+    def to_dict_text2values(self):
+        return {self.i2key(i).decode("utf-8"): set(self.i2values(i)) for i in range(self.count)}
+
+    def add(self, value, texts):
+        raise self.ReadOnlyException({"filepath": self.filepath, "value": value})
+
+    def remove(self, value):
+        raise self.ReadOnlyException({"filepath": self.filepath, "value": value})
+
+    def update(self, value, texts):
+        raise self.ReadOnlyException({"filepath": self.filepath, "value": value})
+
+    def text_start2ends(self, text, start):
+        ends = []
+        lo, hi = 0, self.count
+        for j in range(start, len(text)):
+            prefix = text[start:j + 1].encode("utf-8")
+
+            lo = bisect_left(self.keys, prefix, lo, hi)
+            hi = bisect_left(self.keys, prefix + b"\xff", lo, hi)  # 0xff never occurs in utf-8
+            if lo >= hi:
+                break
+
+            if self.i2key(lo) == prefix:
+                ends.append(j + 1)
+
+        return ends
+
+    def to_index(self):
+        dict_value2texts = {}
+        for i in range(self.count):
+            text = self.i2key(i).decode("utf-8")
+            for value in self.i2values(i):
+                dict_value2texts.setdefault(value, []).append(text)
+
+        return MatcherIndex.dict2index(dict_value2texts)
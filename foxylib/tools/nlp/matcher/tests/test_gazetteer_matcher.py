@@ -1,4 +1,6 @@
 import logging
+import random
+import time
 from unittest import TestCase
 
 from foxylib.tools.collections.collections_tool import DictTool
@@ -82,6 +84,72 @@ class TestGazetteerMatcher(TestCase):
         # pprint(hyp)
         self.assertEqual(hyp, ref)
 
+    def test_06(self):
+        config = {"backend": GazetteerMatcher.Backend.TRIE, "normalizer": str2lower}
+        dict_value2texts = DictTool.append_key2values({"ReD": ["scarleTT", "radish"]})
 
+        gazetteer = GazetteerMatcher(dict_value2texts, config=config)
+        hyp = gazetteer.texts2span_value_lists(["red scarlett blue radish", "redish scarletts"])
+        ref = [[((0, 3), 'ReD'), ((4, 12), 'ReD'), ((18, 24), 'ReD')],
+               [],
+               ]
+        self.assertEqual(hyp, ref)
 
-
+    def test_07(self):
+        """
+        trie backend returns the same (span, value) stream as regex backend
+        """
+        dict_value2texts = {"a": ["new york", "new york city", "york", "c++", "c", "ab_c", "b.c", "é"],
+                            "b": ["york", "new", "c+", "+", "city!", "!"],
+                            }
+        texts = ["new york city is in new york",
+                 "c++ c+ c + ab_c ab_c_ b.c b.cd",
+                 "city! city!! !york york! (new) new-york",
+                 "é éa aé é.",
+                 "  new  york\nnew york\n",
+                 ]
+
+        gazetteer_regex = GazetteerMatcher(dict_value2texts)
+        gazetteer_trie = GazetteerMatcher(dict_value2texts, config={"backend": GazetteerMatcher.Backend.TRIE})
+
+        for text in texts:
+            hyp = sorted(gazetteer_trie.text2span_value_iter(text))
+            ref = sorted(gazetteer_regex.text2span_value_iter(text))
+            self.assertEqual(hyp, ref, text)
+
+    def test_08(self):
+        """
+        benchmark: compile time and scan throughput, regex vs trie backend
+        """
+        logger = FoxylibLogger.func_level2logger(self.test_08, logging.DEBUG)
+
+        rnd = random.Random(0)
+        letters = "abcdefghij"
+
+        def random_word():
+            return "".join(rnd.choice(letters) for _ in range(rnd.randint(3, 8)))
+
+        dict_value2texts = {i: [" ".join(random_word() for _ in range(rnd.randint(1, 3)))]
+                            for i in range(20000)}
+        texts = [" ".join(random_word() for _ in range(200)) for _ in range(50)]
+
+        h_backend2secs = {}
+        h_backend2result = {}
+        for backend in [GazetteerMatcher.Backend.REGEX, GazetteerMatcher.Backend.TRIE]:
+            gazetteer = GazetteerMatcher(dict_value2texts, config={"backend": backend})
+
+            time_start = time.perf_counter()
+            gazetteer.warmup()
+            secs_compile = time.perf_counter() - time_start
+
+            time_start = time.perf_counter()
+            h_backend2result[backend] = gazetteer.texts2span_value_lists(texts)
+            secs_scan = time.perf_counter() - time_start
+
+            h_backend2secs[backend] = {"secs compile": secs_compile,
+                                       "chars/sec scan": sum(map(len, texts)) / secs_scan,
+                                       }
+
+        logger.info(h_backend2secs)
+        self.assertEqual(h_backend2result[GazetteerMatcher.Backend.REGEX],
+                         h_backend2result[GazetteerMatcher.Backend.TRIE])
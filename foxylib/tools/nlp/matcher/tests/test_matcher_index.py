@@ -0,0 +1,130 @@
+import logging
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from foxylib.tools.log.foxylib_logger import FoxylibLogger
+from foxylib.tools.nlp.matcher.fulltext_matcher import FulltextMatcher
+from foxylib.tools.nlp.matcher.gazetteer_matcher import GazetteerMatcher
+from foxylib.tools.nlp.matcher.matcher_index import MatcherIndex, MmapMatcherIndex
+from foxylib.tools.string.string_tool import str2lower
+
+
+class TestMatcherIndex(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        FoxylibLogger.attach_stderr2loggers(logging.DEBUG)
+
+    def test_01(self):
+        index = MatcherIndex.dict2index({"a": ["x", "xy"], "b": ["xy"]})
+        self.assertEqual(index.text2values("xy"), {"a", "b"})
+        self.assertEqual(index.text_start2ends("xyz", 0), [1, 2])
+
+        index.remove("a")
+        self.assertEqual(index.text2values("x"), set())
+        self.assertEqual(index.text_start2ends("xyz", 0), [2])
+
+        index.update("b", ["z"])
+        self.assertEqual(set(index.texts()), {"z"})
+        self.assertEqual(index.trie, {"z": {"": True}})
+
+    def test_02(self):
+        index = MatcherIndex.dict2index({"a": ["new", "new york", "é"], 1: ["new york"]})
+
+        with tempfile.TemporaryDirectory() as dirpath:
+            filepath = os.path.join(dirpath, "index.bin")
+            index.dump(filepath)
+
+            index_mmap = MmapMatcherIndex.filepath2index(filepath)
+            self.assertEqual(index_mmap.text2values("new york"), {"a", 1})
+            self.assertEqual(index_mmap.text2values("york"), set())
+            self.assertEqual(index_mmap.text_start2ends("new york city", 0), [3, 8])
+            self.assertEqual(index_mmap.text_start2ends("é!", 0), [1])
+            self.assertEqual(sorted(index_mmap.texts()), sorted(index.texts()))
+
+            index_copy = index_mmap.to_index()
+            self.assertEqual(index_copy.dict_text2values, index.dict_text2values)
+            self.assertEqual(index_mmap.to_dict_text2values(), index.dict_text2values)
+
+            with self.assertRaises(MmapMatcherIndex.ReadOnlyException):
+                index_mmap.add("b", ["new"])
+
+            matcher = FulltextMatcher({}, index=index_mmap)
+            self.assertEqual(matcher._dict_text2values(), index.dict_text2values)
+            with self.assertRaises(MmapMatcherIndex.ReadOnlyException):
+                matcher.remove_value("a")
+            index_mmap.close()
+
+    def test_03(self):
+        """
+        texts colliding after normalization are stored once
+        """
+        gazetteer = GazetteerMatcher({"apple": ["Apple", "apple"]}, config={"normalizer": str.lower})
+        self.assertEqual(gazetteer.index().dict_value2texts, {"apple": ["apple"]})
+
+        gazetteer.update_value("apple", ["APPLE", "pear"])
+        self.assertEqual(list(gazetteer.text2span_value_iter("a pear")), [((2, 6), "apple")])
+
+        gazetteer.remove_value("apple")
+        self.assertEqual(gazetteer._dict_text2values(), {})
+
+
+class TestMatcherIndexIncremental(TestCase):
+    def test_01(self):
+        matcher = FulltextMatcher({"ReD": ["scarleTT"]}, config={"normalizer": str2lower})
+        self.assertEqual(list(matcher.text2values("Scarlett")), ["ReD"])
+
+        matcher.add_value("BluE", ["NAVY"])
+        self.assertEqual(list(matcher.text2values("navy")), ["BluE"])
+
+        matcher.update_value("ReD", ["crimson"])
+        self.assertEqual(list(matcher.text2values("scarlett")), [])
+        self.assertEqual(list(matcher.text2values("Crimson")), ["ReD"])
+
+        matcher.remove_value("BluE")
+        self.assertEqual(list(matcher.text2values("navy")), [])
+
+    def test_02(self):
+        for backend in [GazetteerMatcher.Backend.REGEX, GazetteerMatcher.Backend.TRIE]:
+            gazetteer = GazetteerMatcher({"red": ["scarlett"]}, config={"backend": backend})
+            self.assertEqual(list(gazetteer.text2span_value_iter("scarlett navy")), [((0, 8), "red")])
+
+            gazetteer.add_value("blue", ["navy"])
+            self.assertEqual(list(gazetteer.text2span_value_iter("scarlett navy")),
+                             [((0, 8), "red"), ((9, 13), "blue")])
+
+            gazetteer.remove_value("red")
+            self.assertEqual(list(gazetteer.text2span_value_iter("scarlett navy")), [((9, 13), "blue")])
+
+    def test_03(self):
+        """
+        matcher started from a prebuilt memory-mapped index
+        """
+        logger = FoxylibLogger.func_level2logger(self.test_03, logging.DEBUG)
+
+        dict_value2texts = {i: ["word{}".format(i), "word{} x".format(i)] for i in range(20000)}
+        text = " ".join("word{}".format(i) for i in range(0, 20000, 7)) + " x"
+
+        time_start = time.perf_counter()
+        gazetteer = GazetteerMatcher(dict_value2texts, config={"backend": GazetteerMatcher.Backend.TRIE})
+        ref = list(gazetteer.text2span_value_iter(text))
+        secs_build = time.perf_counter() - time_start
+
+        with tempfile.TemporaryDirectory() as dirpath:
+            filepath = os.path.join(dirpath, "index.bin")
+            gazetteer.index().dump(filepath)
+
+            time_start = time.perf_counter()
+            index = MmapMatcherIndex.filepath2index(filepath)
+            gazetteer_mmap = GazetteerMatcher(None, config={"backend": GazetteerMatcher.Backend.TRIE}, index=index)
+            secs_open = time.perf_counter() - time_start
+
+            hyp = list(gazetteer_mmap.text2span_value_iter(text))
+            self.assertEqual(hyp, ref)
+
+            matcher = FulltextMatcher(None, index=index)
+            self.assertEqual(list(matcher.text2values("word7 x")), [7])
+
+            logger.info({"secs build+scan": secs_build, "secs open mmap": secs_open})
+            index.close()
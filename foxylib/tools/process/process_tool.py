@@ -1,9 +1,13 @@
+import asyncio
+import atexit
 import logging
 import os
+import pickle
 import time
 from concurrent.futures.process import ProcessPoolExecutor
-from functools import partial
+from functools import partial, lru_cache
 from multiprocessing.pool import Pool
+from threading import Lock
 
 import dill
 from future.utils import lmap, lfilter
@@ -16,6 +20,13 @@ from foxylib.tools.string.string_tool import format_str
 
 
 class ProcessTool:
+    class Constant:
+        POOL_DEFAULT = "default"
+
+    _h_name2pool = {}
+    _pid_pool = os.getpid()
+    _lock_pool = Lock()
+
     @classmethod
     def _func2dillstr(cls, f):
         # python only allows "real" function to parallelize
@@ -27,6 +38,174 @@ class ProcessTool:
         f = dill.loads(str_dill)
         return f()
 
+    @classmethod
+    def _func2payload(cls, f):
+        """
+        plain pickle for module-level functions (and partials of them). dill only as fallback
+        """
+        try:
+            return False, pickle.dumps(f)
+        except (pickle.PicklingError, AttributeError, TypeError):
+            return True, dill.dumps(f)
+
+    @classmethod
+    def _payload2func(cls, payload):
+        is_dill, s = payload
+        return dill.loads(s) if is_dill else pickle.loads(s)
+
+    @classmethod
+    @lru_cache(maxsize=256)
+    def _payload2func_cached(cls, payload):
+        return cls._payload2func(payload)
+
+    @classmethod
+    def _payload2run(cls, payload):
+        f = cls._payload2func(payload)
+        return f()
+
+    @classmethod
+    def _payload_x2run(cls, payload, x):
+        # same func is sent with every chunk. deserialize once per worker
+        f = cls._payload2func_cached(payload)
+        return f(x)
+
+    @classmethod
+    def _func2picklable(cls, f):
+        try:
+            pickle.dumps(f)
+            return f
+        except (pickle.PicklingError, AttributeError, TypeError):
+            return partial(cls._payload_x2run, cls._func2payload(f))
+
+    @classmethod
+    def _initializer_payload2run(cls, payload, initargs):
+        f = cls._payload2func(payload)
+        f(*initargs)
+
+    @classmethod
+    def initializer2pool(cls, processes=None, initializer=None, initargs=None):
+        """
+        initializer runs once in each worker, e.g. to warm up caches
+        """
+        if initializer is None:
+            return Pool(processes=processes)
+
+        return Pool(processes=processes,
+                    initializer=cls._initializer_payload2run,
+                    initargs=(cls._func2payload(initializer), tuple(initargs or [])),
+                    )
+
+    @classmethod
+    def name2pool(cls, name=None, processes=None, initializer=None, initargs=None):
+        """
+        process-wide registry of long-lived pools.
+        the pool is created on the first lookup of the name; later arguments for the same name are ignored.
+        """
+        name = name if name is not None else cls.Constant.POOL_DEFAULT
+        cls._forget_pools_if_forked()
+
+        pool = cls._h_name2pool.get(name)
+        if pool is not None:
+            return pool
+
+        with cls._lock_pool:
+            if name not in cls._h_name2pool:
+                cls._h_name2pool[name] = cls.initializer2pool(processes=processes,
+                                                              initializer=initializer,
+                                                              initargs=initargs,
+                                                              )
+            return cls._h_name2pool[name]
+
+    @classmethod
+    def _forget_pools_if_forked(cls):
+        """
+        pools inherited through fork belong to the parent. never reuse or join them
+        """
+        pid = os.getpid()
+        if cls._pid_pool == pid:
+            return
+
+        with cls._lock_pool:
+            if cls._pid_pool != pid:
+                cls._h_name2pool = {}
+                cls._pid_pool = pid
+
+    @classmethod
+    def shutdown_pool(cls, name):
+        cls._forget_pools_if_forked()
+        with cls._lock_pool:
+            pool = cls._h_name2pool.pop(name, None)
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    @classmethod
+    def shutdown_pools(cls):
+        cls._forget_pools_if_forked()
+        with cls._lock_pool:
+            pools = list(cls._h_name2pool.values())
+            cls._h_name2pool.clear()
+
+        for pool in pools:
+            pool.close()
+            pool.join()
+
+    @classmethod
+    def pool_func_x_iter2result_iter(cls, pool, func, x_iter, chunksize=None, ordered=True):
+        """
+        imap-style dispatch of func(x) for each x, chunksize items per IPC round trip.
+        ordered=False yields results as they complete.
+        """
+        f = cls._func2picklable(func)
+        imap = pool.imap if ordered else pool.imap_unordered
+        yield from imap(f, x_iter, chunksize=chunksize or 1)
+
+    @classmethod
+    def pool_funcs2result_iter(cls, pool, funcs, chunksize=None, ordered=True):
+        payloads = map(cls._func2payload, funcs)
+        imap = pool.imap if ordered else pool.imap_unordered
+        yield from imap(cls._payload2run, payloads, chunksize=chunksize or 1)
+
+    @classmethod
+    def func_x_iter2result_iter(cls, func, x_iter, chunksize=None, ordered=True, pool=None):
+        yield from cls.pool_func_x_iter2result_iter(cls.name2pool(pool), func, x_iter,
+                                                    chunksize=chunksize, ordered=ordered)
+
+    @classmethod
+    def funcs2result_iter(cls, funcs, chunksize=None, ordered=True, pool=None):
+        yield from cls.pool_funcs2result_iter(cls.name2pool(pool), funcs,
+                                              chunksize=chunksize, ordered=ordered)
+
+    @classmethod
+    def pool_func_x2aio_future(cls, pool, func, x):
+        """
+        func(x) on the pool, as an asyncio future of the running loop
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        def result2set(result):
+            if not future.done():
+                future.set_result(result)
+
+        def error2set(error):
+            if not future.done():
+                future.set_exception(error)
+
+        def on_loop(f, v):
+            # runs on the pool's result handler thread, which an exception here would kill
+            try:
+                loop.call_soon_threadsafe(f, v)
+            except RuntimeError:
+                pass  # loop closed, e.g. the caller was cancelled
+
+        pool.apply_async(cls._func2picklable(func), (x,),
+                         callback=partial(on_loop, result2set),
+                         error_callback=partial(on_loop, error2set),
+                         )
+        return future
+
     @classmethod
     def max_workers2executor(cls, max_workers):
         return ProcessPoolExecutor(max_workers=max_workers)
@@ -97,8 +276,7 @@ class ProcessTool:
     def func_iter2buffered_result_iter(cls, func_iter, buffer_size):
         # be careful because Pool() object should be able to see the target function definition
         # https://stackoverflow.com/questions/2782961/yet-another-confusion-with-multiprocessing-error-module-object-has-no-attribu
-        with Pool() as pool:
-            yield from cls.pool_func_iter2buffered_result_iter(pool, func_iter, buffer_size)
+        yield from cls.pool_func_iter2buffered_result_iter(cls.name2pool(), func_iter, buffer_size)
 
 
     @classmethod
@@ -193,3 +371,6 @@ class ProcessTool:
     #     import psutil
     #     process = psutil.Process(os.getpid())
     #     return process.memory_info().rss
+
+
+atexit.register(ProcessTool.shutdown_pools)
@@ -1,13 +1,33 @@
 import logging
+import os
+import time
+from multiprocessing.pool import Pool
 from unittest import TestCase
 
 from functools import partial
 from time import sleep
 
+from foxylib.tools.log.foxylib_logger import FoxylibLogger
 from foxylib.tools.process.process_tool import ProcessTool
 
 logger = logging.getLogger(__name__)
 
+
+def square(x):
+    return x * x
+
+
+class Warmer:
+    value = None
+
+    @classmethod
+    def warmup(cls, value):
+        cls.value = value
+
+    @classmethod
+    def x2value(cls, x):
+        return cls.value, x
+
 class PP:
     @classmethod
     def f(cls, proc_name, secs):
@@ -64,3 +84,73 @@ class ProcessToolTest(TestCase):
         ProcessTool.func2forked(f)
         print("i'm parent")
 
+
+
+class TestProcessToolPool(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        FoxylibLogger.attach_stderr2loggers(logging.DEBUG)
+
+    def test_01(self):
+        hyp = list(ProcessTool.func_x_iter2result_iter(square, range(100), chunksize=10))
+        self.assertEqual(hyp, [x * x for x in range(100)])
+
+        hyp = sorted(ProcessTool.func_x_iter2result_iter(square, range(100), chunksize=10, ordered=False))
+        self.assertEqual(hyp, [x * x for x in range(100)])
+
+        # long-lived
+        self.assertIs(ProcessTool.name2pool(), ProcessTool.name2pool())
+
+    def test_02(self):
+        # not picklable natively. falls back to dill
+        offset = 3
+        f = lambda x: x + offset
+
+        hyp = list(ProcessTool.func_x_iter2result_iter(f, range(10), chunksize=4))
+        self.assertEqual(hyp, [x + 3 for x in range(10)])
+
+        funcs = [partial(square, 2), lambda: offset]
+        self.assertEqual(list(ProcessTool.funcs2result_iter(funcs)), [4, 3])
+
+    def test_03(self):
+        name = "TestProcessToolPool.test_03"
+        pool = ProcessTool.name2pool(name, processes=2, initializer=Warmer.warmup, initargs=["warm"])
+
+        hyp = list(ProcessTool.pool_func_x_iter2result_iter(pool, Warmer.x2value, range(4)))
+        self.assertEqual(hyp, [("warm", x) for x in range(4)])
+
+        ProcessTool.shutdown_pool(name)
+
+    def test_04(self):
+        """
+        throughput benchmark: fresh Pool() with per-item apply_async vs long-lived pool with chunked dispatch
+        """
+        logger = FoxylibLogger.func_level2logger(self.test_04, logging.DEBUG)
+
+        n = 5000
+        funcs = [partial(square, x) for x in range(n)]
+        ref = [x * x for x in range(n)]
+
+        time_start = time.perf_counter()
+        with Pool() as pool:
+            hyp_legacy = list(ProcessTool.pool_func_iter2buffered_result_iter(pool, funcs, n))
+        secs_legacy = time.perf_counter() - time_start
+
+        ProcessTool.name2pool()  # warm up
+        time_start = time.perf_counter()
+        hyp_funcs = list(ProcessTool.funcs2result_iter(funcs, chunksize=100))
+        secs_funcs = time.perf_counter() - time_start
+
+        time_start = time.perf_counter()
+        hyp_map = list(ProcessTool.func_x_iter2result_iter(square, range(n), chunksize=100))
+        secs_map = time.perf_counter() - time_start
+
+        logger.info({"cpu_count": os.cpu_count(),
+                     "tasks/sec legacy": n / secs_legacy,
+                     "tasks/sec funcs chunked": n / secs_funcs,
+                     "tasks/sec map chunked": n / secs_map,
+                     })
+
+        self.assertEqual(hyp_legacy, ref)
+        self.assertEqual(hyp_funcs, ref)
+        self.assertEqual(hyp_map, ref)
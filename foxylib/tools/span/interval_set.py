@@ -0,0 +1,332 @@
+import numpy as np
+
+from foxylib.tools.span.interval_tool import IntervalTool
+
+
+class IntervalCoord:
+    """
+    Integer coordinates for interval endpoints over a sorted table of n distinct values.
+
+    For the value of rank r, coordinate 2r+1 is the value itself and 2r is the open gap right below it.
+    2n is the gap above the last value. Every interval then becomes an inclusive integer range [a, b],
+    so open/closed endpoints and infinities need no special casing.
+    """
+
+    @classmethod
+    def values2array(cls, values):
+        """
+        native dtype if every value is int (or every value is float), so that numpy compares in C.
+        object dtype otherwise (Decimal, datetime, mixed types), which keeps values as they are.
+        """
+        value_list = list(values)
+        types = set(map(type, value_list))
+
+        if types == {int}:
+            try:
+                return np.array(value_list, dtype=np.int64)
+            except OverflowError:
+                pass
+
+        if types == {float}:
+            return np.array(value_list, dtype=np.float64)
+
+        return np.array(value_list, dtype=object)
+
+    @classmethod
+    def values2table(cls, values):
+        return np.unique(cls.values2array(values))
+
+    @classmethod
+    def tables2table(cls, tables):
+        dtypes = {t.dtype for t in tables if len(t)}
+        if len(dtypes) > 1:
+            tables = [t.astype(object) for t in tables]
+        return np.unique(np.concatenate(tables))
+
+    @classmethod
+    def table_index2value(cls, table, i):
+        v = table[i]
+        return v.item() if isinstance(v, np.generic) else v
+
+    @classmethod
+    def table_values2ranks(cls, table, values):
+        return np.searchsorted(table, values).astype(np.int64)
+
+    @classmethod
+    def table_values2coords(cls, table, values):
+        n = len(table)
+        x = cls.values2array(values)
+        r = np.searchsorted(table, x).astype(np.int64)
+
+        if not n:
+            return 2 * r
+
+        r_clipped = np.minimum(r, n - 1)
+        is_eq = (r < n) & np.asarray(table[r_clipped] == x, dtype=bool)
+        return 2 * r + is_eq
+
+    @classmethod
+    def intervals2table_ranges(cls, intervals):
+        m = len(intervals)
+
+        values, inexes = [], []
+        for spoint, epoint in intervals:
+            values.append(IntervalTool.Point.point2value(spoint))
+            values.append(IntervalTool.Point.point2value(epoint))
+            inexes.append(IntervalTool.Point.point2inex(spoint))
+            inexes.append(IntervalTool.Point.point2inex(epoint))
+
+        is_inf = np.fromiter((v is None for v in values), dtype=bool, count=2 * m)
+        table, inverse = np.unique(cls.values2array(v for v in values if v is not None), return_inverse=True)
+        n = len(table)
+
+        ranks = np.zeros(2 * m, dtype=np.int64)
+        ranks[~is_inf] = inverse
+        is_closed = np.array(inexes, dtype=bool)
+
+        s_ranks, e_ranks = ranks[0::2], ranks[1::2]
+        s_closed, e_closed = is_closed[0::2], is_closed[1::2]
+
+        starts = np.where(is_inf[0::2], 0, np.where(s_closed, 2 * s_ranks + 1, 2 * s_ranks + 2))
+        ends = np.where(is_inf[1::2], 2 * n, np.where(e_closed, 2 * e_ranks + 1, 2 * e_ranks))
+        return table, starts.astype(np.int64), ends.astype(np.int64)
+
+    @classmethod
+    def table_start2point(cls, table, a):
+        if a == 0:
+            return IntervalTool.Point.value2point(None, IntervalTool.Clusivity.EX)
+
+        if a % 2:
+            return IntervalTool.Point.value2point(cls.table_index2value(table, (a - 1) // 2),
+                                                  IntervalTool.Clusivity.IN)
+
+        return IntervalTool.Point.value2point(cls.table_index2value(table, a // 2 - 1),
+                                              IntervalTool.Clusivity.EX)
+
+    @classmethod
+    def table_end2point(cls, table, b):
+        if b == 2 * len(table):
+            return IntervalTool.Point.value2point(None, IntervalTool.Clusivity.EX)
+
+        if b % 2:
+            return IntervalTool.Point.value2point(cls.table_index2value(table, (b - 1) // 2),
+                                                  IntervalTool.Clusivity.IN)
+
+        return IntervalTool.Point.value2point(cls.table_index2value(table, b // 2),
+                                              IntervalTool.Clusivity.EX)
+
+    @classmethod
+    def ranges2normalized(cls, starts, ends):
+        """
+        sorted, disjoint, non-adjacent ranges. O(n log n)
+        """
+        is_valid = starts <= ends
+        starts, ends = starts[is_valid], ends[is_valid]
+        if not len(starts):
+            return starts, ends
+
+        order = np.argsort(starts, kind="stable")
+        starts, ends = starts[order], ends[order]
+        ends_max = np.maximum.accumulate(ends)
+
+        is_new = np.empty(len(starts), dtype=bool)
+        is_new[0] = True
+        is_new[1:] = starts[1:] > ends_max[:-1] + 1
+
+        i_starts = np.flatnonzero(is_new)
+        i_ends = np.append(i_starts[1:] - 1, len(starts) - 1)
+        return starts[i_starts], ends_max[i_ends]
+
+    @classmethod
+    def weighted_ranges2filtered(cls, starts, ends, weights, f_cond):
+        """
+        ranges where f_cond(sum of weights covering the coordinate) holds
+        """
+        if not len(starts):
+            return starts, ends
+
+        positions = np.concatenate([starts, ends + 1])
+        deltas = np.concatenate([weights, -weights])
+
+        order = np.argsort(positions, kind="stable")
+        positions, deltas = positions[order], deltas[order]
+        coverage = np.cumsum(deltas)
+
+        # coverage after all events at the same position
+        is_last = np.append(positions[1:] != positions[:-1], True)
+        positions, coverage = positions[is_last], coverage[is_last]
+
+        is_kept = f_cond(coverage[:-1])
+        return cls.ranges2normalized(positions[:-1][is_kept], positions[1:][is_kept] - 1)
+
+    @classmethod
+    def table2rebased(cls, table_old, table_new, starts, ends):
+        n_old, n_new = len(table_old), len(table_new)
+        ranks = cls.table_values2ranks(table_new, table_old) if n_old else np.zeros(0, dtype=np.int64)
+
+        ranks_lo = np.concatenate([[-1], ranks]).astype(np.int64)
+        ranks_hi = np.concatenate([ranks, [n_new]]).astype(np.int64)
+
+        starts_new = np.where(starts % 2,
+                              2 * ranks_hi[(starts - 1) // 2] + 1,
+                              2 * ranks_lo[starts // 2] + 2)
+        ends_new = np.where(ends % 2,
+                            2 * ranks_hi[(ends - 1) // 2] + 1,
+                            2 * ranks_hi[ends // 2])
+        return starts_new.astype(np.int64), ends_new.astype(np.int64)
+
+
+class IntervalSet:
+    """
+    Union of intervals backed by sorted NumPy arrays.
+    Converts losslessly to and from IntervalTool's dict intervals.
+    """
+
+    def __init__(self, table, starts, ends):
+        # use intervals2set() instead. starts/ends must already be normalized
+        self.table = table
+        self.starts = starts
+        self.ends = ends
+
+    @classmethod
+    def empty(cls):
+        return cls(IntervalCoord.values2table([]), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+
+    @classmethod
+    def intervals2set(cls, intervals):
+        table, starts, ends = IntervalCoord.intervals2table_ranges(list(intervals))
+        return cls(table, *IntervalCoord.ranges2normalized(starts, ends))
+
+    def to_intervals(self):
+        return [(IntervalCoord.table_start2point(self.table, a),
+                 IntervalCoord.table_end2point(self.table, b),
+                 )
+                for a, b in zip(self.starts.tolist(), self.ends.tolist())]
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __bool__(self):
+        return bool(len(self.starts))
+
+    def __eq__(self, other):
+        if not isinstance(other, IntervalSet):
+            return NotImplemented
+        return self.to_intervals() == other.to_intervals()
+
+    def __repr__(self):
+        return "IntervalSet({})".format(self.to_intervals())
+
+    def _rebased(self, table):
+        if table is self.table:
+            return self.starts, self.ends
+        return IntervalCoord.table2rebased(self.table, table, self.starts, self.ends)
+
+    @classmethod
+    def sets2table(cls, interval_sets):
+        tables = [s.table for s in interval_sets]
+        if all(t is tables[0] for t in tables):
+            return tables[0]
+
+        return IntervalCoord.tables2table(tables)
+
+    @classmethod
+    def _sets_weights2combined(cls, interval_sets, weights, f_cond):
+        table = cls.sets2table(interval_sets)
+        ranges_list = [s._rebased(table) for s in interval_sets]
+
+        starts = np.concatenate([r[0] for r in ranges_list])
+        ends = np.concatenate([r[1] for r in ranges_list])
+        weights = np.concatenate([np.full(len(r[0]), w, dtype=np.int64)
+                                  for r, w in zip(ranges_list, weights)])
+
+        return cls(table, *IntervalCoord.weighted_ranges2filtered(starts, ends, weights, f_cond))
+
+    @classmethod
+    def union_all(cls, interval_sets):
+        interval_sets = list(interval_sets)
+        if not interval_sets:
+            return cls.empty()
+
+        weights = [1] * len(interval_sets)
+        return cls._sets_weights2combined(interval_sets, weights, lambda c: c >= 1)
+
+    @classmethod
+    def intersect_all(cls, interval_sets):
+        interval_sets = list(interval_sets)
+        if not interval_sets:
+            return cls.empty()
+
+        n = len(interval_sets)
+        return cls._sets_weights2combined(interval_sets, [1] * n, lambda c: c == n)
+
+    def union(self, *others):
+        return self.union_all([self, *others])
+
+    def intersect(self, *others):
+        return self.intersect_all([self, *others])
+
+    def difference(self, *others):
+        other = self.union_all(others) if len(others) != 1 else others[0]
+        return self._sets_weights2combined([self, other], [1, 2], lambda c: c == 1)
+
+    def __or__(self, other):
+        return self.union(other)
+
+    def __and__(self, other):
+        return self.intersect(other)
+
+    def __sub__(self, other):
+        return self.difference(other)
+
+    def values2indexes(self, values):
+        """
+        stabbing query: index of the interval containing each value, -1 if none
+        """
+        coords = IntervalCoord.table_values2coords(self.table, values)
+        indexes = np.searchsorted(self.starts, coords, side="right") - 1
+
+        if not len(self.starts):
+            return indexes
+
+        is_in = (indexes >= 0) & (self.ends[np.maximum(indexes, 0)] >= coords)
+        return np.where(is_in, indexes, -1)
+
+    def values2contained(self, values):
+        return self.values2indexes(values) >= 0
+
+    def __contains__(self, value):
+        return bool(self.values2contained([value])[0])
+
+
+class IntervalIndex:
+    """
+    Stabbing queries over intervals that keep their identity, i.e. not merged like IntervalSet.
+    """
+
+    def __init__(self, intervals):
+        self.intervals = list(intervals)
+
+        self.table, starts, ends = IntervalCoord.intervals2table_ranges(self.intervals)
+
+        # empty intervals would count as ended without having started. dropped as in ranges2normalized()
+        i_valid = np.flatnonzero(starts <= ends)
+        self.order = i_valid[np.argsort(starts[i_valid], kind="stable")]
+        self.starts = starts[self.order]
+        self.ends = ends[self.order]
+        self.ends_sorted = np.sort(ends[i_valid])
+
+    def values2counts(self, values):
+        """
+        number of intervals containing each value. O((n + q) log n)
+        """
+        coords = IntervalCoord.table_values2coords(self.table, values)
+        count_started = np.searchsorted(self.starts, coords, side="right")
+        count_ended = np.searchsorted(self.ends_sorted, coords, side="left")
+        return count_started - count_ended
+
+    def value2indexes(self, value):
+        coord = IntervalCoord.table_values2coords(self.table, [value])[0]
+        i = np.searchsorted(self.starts, coord, side="right")
+        indexes = self.order[:i][self.ends[:i] >= coord]
+        return np.sort(indexes).tolist()
@@ -0,0 +1,149 @@
+import logging
+import random
+import time
+from datetime import datetime
+from decimal import Decimal
+from unittest import TestCase
+
+import pytz
+
+from foxylib.tools.log.foxylib_logger import FoxylibLogger
+from foxylib.tools.span.interval_set import IntervalSet, IntervalIndex
+from foxylib.tools.span.interval_tool import IntervalTool
+
+
+def random_interval(rnd):
+    s, e = sorted([rnd.randint(0, 20), rnd.randint(0, 20)])
+    policy = rnd.choice([IntervalTool.Policy.ININ, IntervalTool.Policy.INEX,
+                         IntervalTool.Policy.EXIN, IntervalTool.Policy.EXEX, ])
+    span = [None if rnd.random() < 0.05 else s,
+            None if rnd.random() < 0.05 else e]
+    return IntervalTool.span2interval(span, policy)
+
+
+def is_in_any(v, intervals):
+    return any(IntervalTool.is_in(v, interval) for interval in intervals)
+
+
+class TestIntervalSet(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        FoxylibLogger.attach_stderr2loggers(logging.DEBUG)
+
+    def test_01(self):
+        intervals = [IntervalTool.span2interval([1, 2], IntervalTool.Policy.INEX),
+                     IntervalTool.span2interval([2, 3], IntervalTool.Policy.INEX),
+                     IntervalTool.span2interval([5, 5], IntervalTool.Policy.ININ),
+                     IntervalTool.span2interval([7, 7], IntervalTool.Policy.INEX),  # empty
+                     ]
+        hyp = IntervalSet.intervals2set(intervals).to_intervals()
+        ref = [IntervalTool.span2interval([1, 3], IntervalTool.Policy.INEX),
+               IntervalTool.span2interval([5, 5], IntervalTool.Policy.ININ),
+               ]
+        self.assertEqual(hyp, ref)
+
+    def test_02(self):
+        # open intervals touching at one value must stay apart
+        intervals = [IntervalTool.span2interval([1, 2], IntervalTool.Policy.EXEX),
+                     IntervalTool.span2interval([2, 3], IntervalTool.Policy.EXEX),
+                     ]
+        interval_set = IntervalSet.intervals2set(intervals)
+        self.assertEqual(interval_set.to_intervals(), intervals)
+        self.assertNotIn(2, interval_set)
+        self.assertIn(Decimal("1.5"), interval_set)
+
+        self.assertEqual(IntervalSet.intervals2set([IntervalTool.inf()]).to_intervals(),
+                         [IntervalTool.span2interval([None, None], IntervalTool.Policy.INEX)])
+
+    def test_03(self):
+        dt1 = datetime(2020, 1, 1, tzinfo=pytz.utc)
+        dt2 = datetime(2020, 1, 2, tzinfo=pytz.utc)
+        dt3 = datetime(2020, 1, 3, tzinfo=pytz.utc)
+
+        set1 = IntervalSet.intervals2set([IntervalTool.span2interval([dt1, dt3], IntervalTool.Policy.INEX)])
+        set2 = IntervalSet.intervals2set([IntervalTool.span2interval([dt2, None], IntervalTool.Policy.INEX)])
+
+        self.assertEqual((set1 & set2).to_intervals(),
+                         [IntervalTool.span2interval([dt2, dt3], IntervalTool.Policy.INEX)])
+        self.assertEqual((set1 - set2).to_intervals(),
+                         [IntervalTool.span2interval([dt1, dt2], IntervalTool.Policy.INEX)])
+        self.assertEqual((set1 | set2).to_intervals(),
+                         [IntervalTool.span2interval([dt1, None], IntervalTool.Policy.INEX)])
+
+    def test_04(self):
+        """
+        compare against IntervalTool on random intervals
+        """
+        rnd = random.Random(0)
+        values = [x / 2 for x in range(-2, 44)]
+
+        for _ in range(200):
+            intervals1 = [random_interval(rnd) for _ in range(rnd.randint(0, 4))]
+            intervals2 = [random_interval(rnd) for _ in range(rnd.randint(0, 4))]
+            set1 = IntervalSet.intervals2set(intervals1)
+            set2 = IntervalSet.intervals2set(intervals2)
+
+            set_union, set_intersect, set_diff = set1 | set2, set1 & set2, set1 - set2
+            for v in values:
+                in1, in2 = is_in_any(v, intervals1), is_in_any(v, intervals2)
+                self.assertEqual(v in set1, in1)
+                self.assertEqual(v in set_union, in1 or in2)
+                self.assertEqual(v in set_intersect, in1 and in2)
+                self.assertEqual(v in set_diff, in1 and not in2)
+
+            # lossless round trip
+            self.assertEqual(IntervalSet.intervals2set(set_union.to_intervals()), set_union)
+
+            if len(intervals1) == 1 and len(intervals2) == 1:
+                interval_ref = IntervalTool.intersect([intervals1[0], intervals2[0]])
+                self.assertEqual(set_intersect.to_intervals(), [interval_ref] if interval_ref else [])
+
+    def test_05(self):
+        intervals = [IntervalTool.span2interval([1, 5], IntervalTool.Policy.ININ),
+                     IntervalTool.span2interval([3, 8], IntervalTool.Policy.EXEX),
+                     IntervalTool.span2interval([None, 3], IntervalTool.Policy.INEX),
+                     ]
+        index = IntervalIndex(intervals)
+
+        self.assertEqual(index.values2counts([0, 1, 3, 4, 8]).tolist(), [1, 2, 1, 2, 0])
+        self.assertEqual(index.value2indexes(3), [0])
+        self.assertEqual(index.value2indexes(4), [0, 1])
+
+        interval_set = IntervalSet.intervals2set(intervals)
+        self.assertEqual(interval_set.values2indexes([0, 8, 100]).tolist(), [0, -1, -1])
+
+        # empty intervals contain nothing and keep no place in the count
+        intervals_empty = [IntervalTool.span2interval([3, 3], IntervalTool.Policy.EXEX),
+                           IntervalTool.span2interval([0, 10], IntervalTool.Policy.ININ),
+                           ]
+        index_empty = IntervalIndex(intervals_empty)
+        self.assertEqual(index_empty.values2counts([2, 3, 4]).tolist(), [1, 1, 1])
+        self.assertEqual(index_empty.value2indexes(3), [1])
+
+    def test_06(self):
+        """
+        benchmark: point membership on 100k intervals
+        """
+        logger = FoxylibLogger.func_level2logger(self.test_06, logging.DEBUG)
+
+        rnd = random.Random(0)
+        n = 100000
+        intervals = [IntervalTool.span2interval(sorted([rnd.randint(0, 10 ** 7), rnd.randint(0, 10 ** 7)]),
+                                                IntervalTool.Policy.INEX)
+                     for _ in range(n)]
+        values = [rnd.randint(0, 10 ** 7) for _ in range(1000)]
+
+        time_start = time.perf_counter()
+        interval_set = IntervalSet.intervals2set(intervals)
+        hyp = interval_set.values2contained(values).tolist()
+        secs_set = time.perf_counter() - time_start
+
+        # IntervalTool.is_in() on every (value, interval) pair of a sample, extrapolated
+        time_start = time.perf_counter()
+        for v in values[:10]:
+            for interval in intervals[:1000]:
+                IntervalTool.is_in(v, interval)
+        secs_dict = (time.perf_counter() - time_start) * (n // 1000) * (len(values) // 10)
+
+        logger.info({"secs IntervalSet": secs_set, "secs IntervalTool (extrapolated)": secs_dict})
+        self.assertEqual(hyp[:10], [is_in_any(v, intervals) for v in values[:10]])
@@ -0,0 +1,29 @@
+import logging
+from unittest import TestCase
+
+from foxylib.tools.log.foxylib_logger import FoxylibLogger
+from foxylib.tools.string.trie.trie_tool import TrieTool
+
+
+class TestTrieTool(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        FoxylibLogger.attach_stderr2loggers(logging.DEBUG)
+
+    def test_01(self):
+        trie = TrieTool.texts2trie(["a", "ab", "abc", "b"])
+
+        self.assertEqual(TrieTool.trie_text_start2ends(trie, "abcd", 0), [1, 2, 3])
+        self.assertEqual(TrieTool.trie_text_start2ends(trie, "abcd", 1), [2])
+        self.assertEqual(TrieTool.trie_text_start2ends(trie, "abcd", 3), [])
+
+    def test_02(self):
+        trie = TrieTool.texts2trie(["ab", "abc"])
+
+        TrieTool.trie_text2removed(trie, "abc")
+        self.assertTrue(TrieTool.trie_text2contains(trie, "ab"))
+        self.assertFalse(TrieTool.trie_text2contains(trie, "abc"))
+        self.assertNotIn("c", trie["a"]["b"])
+
+        TrieTool.trie_text2removed(trie, "ab")
+        self.assertEqual(trie, {})
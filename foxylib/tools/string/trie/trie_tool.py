@@ -0,0 +1,84 @@
+class TrieTool:
+    """
+    character trie as nested dicts. {char: node}, where node[TrieTool.Constant.END] marks a complete key
+    """
+
+    class Constant:
+        END = ""  # never a single character, so it cannot collide with a child key
+
+    @classmethod
+    def texts2trie(cls, texts):
+        trie = {}
+        for text in texts:
+            cls.trie_text2added(trie, text)
+        return trie
+
+    @classmethod
+    def trie_text2added(cls, trie, text):
+        if not text:
+            return trie
+
+        node = trie
+        for c in text:
+            child = node.get(c)
+            if child is None:
+                child = node[c] = {}
+            node = child
+
+        node[cls.Constant.END] = True
+        return trie
+
+    @classmethod
+    def trie_text2removed(cls, trie, text):
+        """
+        prunes nodes left without any key below them
+        """
+        if not text:
+            return trie
+
+        path = [trie]
+        node = trie
+        for c in text:
+            node = node.get(c)
+            if node is None:
+                return trie
+            path.append(node)
+
+        if cls.Constant.END not in node:
+            return trie
+
+        del node[cls.Constant.END]
+        for i in range(len(text), 0, -1):
+            if path[i]:
+                break
+            del path[i - 1][text[i - 1]]
+
+        return trie
+
+    @classmethod
+    def trie_text2contains(cls, trie, text):
+        node = trie
+        for c in text:
+            node = node.get(c)
+            if node is None:
+                return False
+        return cls.Constant.END in node
+
+    @classmethod
+    def trie_text_start2ends(cls, trie, text, start):
+        """
+        end indexes (ascending) of every key that matches text from start
+        """
+        END = cls.Constant.END
+
+        ends = []
+        node = trie
+        for i in range(start, len(text)):
+            node = node.get(text[i])
+            if node is None:
+                break
+
+            if END in node:
+                ends.append(i + 1)
+
+        return ends
@@ -0,0 +1,104 @@
+import logging
+import queue
+from threading import Event
+from unittest import TestCase
+
+from foxylib.tools.log.foxylib_logger import FoxylibLogger
+from foxylib.tools.thread.thread_tool import ThreadTool, BoundedThreadPoolExecutor
+
+
+class TestThreadTool(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        FoxylibLogger.attach_stderr2loggers(logging.DEBUG)
+
+    def test_01(self):
+        pool = "TestThreadTool.test_01"
+
+        @ThreadTool.func2threaded(pool=pool, max_workers=2)
+        def f(x):
+            return x * 2
+
+        futures = [f(i) for i in range(10)]
+        hyp = [future.result() for future in futures]
+        self.assertEqual(hyp, [i * 2 for i in range(10)])
+
+        # same pool reused
+        self.assertIs(ThreadTool.name2executor(pool), ThreadTool.name2executor(pool))
+
+        metrics = ThreadTool.executors2metrics()[pool]
+        self.assertEqual(metrics["counts"]["submitted"], 10)
+        self.assertEqual(metrics["counts"]["completed"], 10)
+        self.assertEqual(metrics["latency_run"]["count"], 10)
+        self.assertEqual(metrics["queue_depth"], 0)
+
+        ThreadTool.shutdown_executor(pool)
+        self.assertNotIn(pool, ThreadTool.executors2metrics())
+
+    def test_02(self):
+        executor = BoundedThreadPoolExecutor(max_workers=1, max_queue=1, timeout_submit=0.1)
+        event, started = Event(), Event()
+
+        def f_block():
+            started.set()
+            return event.wait()
+
+        future1 = executor.submit(f_block)
+        started.wait()
+        future2 = executor.submit(lambda: "queued")
+
+        with self.assertRaises(queue.Full):
+            executor.submit(lambda: "rejected")
+
+        self.assertEqual(executor.metrics()["queue_depth"], 1)
+        self.assertEqual(executor.metrics()["counts"]["rejected"], 1)
+
+        event.set()
+        self.assertTrue(future1.result())
+        self.assertEqual(future2.result(), "queued")
+
+        # capacity released
+        self.assertEqual(executor.submit(lambda: "accepted").result(), "accepted")
+        executor.shutdown()
+
+    def test_03(self):
+        executor = BoundedThreadPoolExecutor(max_workers=1)
+
+        def f():
+            raise ValueError()
+
+        future = executor.submit(f)
+        with self.assertRaises(ValueError):
+            ThreadTool.future2result_or_raise(future)
+
+        executor.shutdown()
+        self.assertEqual(executor.metrics()["counts"]["failed"], 1)
+
+    def test_04(self):
+        """
+        futures cancelled before they start give their slot back
+        """
+        executor = BoundedThreadPoolExecutor(max_workers=1, max_queue=1, timeout_submit=0.1)
+        event, started = Event(), Event()
+
+        def f_block():
+            started.set()
+            return event.wait()
+
+        future1 = executor.submit(f_block)
+        started.wait()
+        for _ in range(3):
+            future = executor.submit(lambda: "cancelled")
+            self.assertTrue(future.cancel())
+
+        self.assertEqual(executor.metrics()["queue_depth"], 0)
+        future2 = executor.submit(lambda: "queued")
+
+        event.set()
+        self.assertTrue(future1.result())
+        self.assertEqual(future2.result(), "queued")
+        executor.shutdown()
+
+        executor_default = ThreadTool.name2executor("test_thread_tool.test_04")
+        self.assertEqual(executor_default.metrics()["max_queue"], ThreadTool.Constant.MAX_QUEUE_DEFAULT)
+        ThreadTool.shutdown_executor("test_thread_tool.test_04")
@@ -1,29 +1,217 @@
+import asyncio
+import atexit
 import logging
+import queue
+import time
 from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
+from threading import Lock, BoundedSemaphore
 
 from foxylib.tools.log.logger_tool import LoggerTool
 from foxylib.tools.log.foxylib_logger import FoxylibLogger
+from foxylib.tools.metric.metric_tool import LatencyMetric, CounterMetric
 
 logger = logging.getLogger(__name__)
 
+
+class BoundedThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    ThreadPoolExecutor with back-pressure and metrics.
+
+    At most max_workers + max_queue tasks are accepted at once (max_queue None: unbounded).
+    submit() blocks when full, and raises queue.Full if timeout_submit passes.
+    A task cancelled before it starts gives its slot back.
+    """
+
+    class Field:
+        MAX_WORKERS = "max_workers"
+        MAX_QUEUE = "max_queue"
+        QUEUE_DEPTH = "queue_depth"
+        RUNNING = "running"
+        COUNTS = "counts"
+        LATENCY_WAIT = "latency_wait"
+        LATENCY_RUN = "latency_run"
+
+    class Count:
+        SUBMITTED = "submitted"
+        COMPLETED = "completed"
+        FAILED = "failed"
+        REJECTED = "rejected"
+
+    def __init__(self, max_workers=None, max_queue=None, timeout_submit=None, thread_name_prefix=""):
+        super().__init__(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+
+        self.max_queue = max_queue
+        self.timeout_submit = timeout_submit
+        self.semaphore = BoundedSemaphore(self._max_workers + max_queue) if max_queue is not None else None
+
+        self.lock_metric = Lock()
+        self.queue_depth = 0
+        self.running = 0
+        self.counter = CounterMetric([self.Count.SUBMITTED, self.Count.COMPLETED,
+                                      self.Count.FAILED, self.Count.REJECTED, ])
+        self.latency_wait = LatencyMetric()
+        self.latency_run = LatencyMetric()
+
+    def _add_depth_running(self, d_depth, d_running):
+        with self.lock_metric:
+            self.queue_depth += d_depth
+            self.running += d_running
+
+    def submit(self, fn, *args, **kwargs):
+        if self.semaphore is not None:
+            if not self.semaphore.acquire(timeout=self.timeout_submit):
+                self.counter.incr(self.Count.REJECTED)
+                raise queue.Full()
+
+        return self._submit_acquired(fn, *args, **kwargs)
+
+    def submit_nowait(self, fn, *args, **kwargs):
+        """
+        raises queue.Full at once when full, whatever timeout_submit is. not counted as rejected, as callers retry
+        """
+        if self.semaphore is not None:
+            if not self.semaphore.acquire(blocking=False):
+                raise queue.Full()
+
+        return self._submit_acquired(fn, *args, **kwargs)
+
+    def _submit_acquired(self, fn, *args, **kwargs):
+
+        time_submit = time.perf_counter()
+
+        def run():
+            time_start = time.perf_counter()
+            self._add_depth_running(-1, 1)
+            self.latency_wait.add(time_start - time_submit)
+            try:
+                rv = fn(*args, **kwargs)
+            except BaseException:
+                self.counter.incr(self.Count.FAILED)
+                raise
+            else:
+                self.counter.incr(self.Count.COMPLETED)
+                return rv
+            finally:
+                self.latency_run.add(time.perf_counter() - time_start)
+                self._add_depth_running(0, -1)
+                if self.semaphore is not None:
+                    self.semaphore.release()
+
+        self._add_depth_running(1, 0)
+        try:
+            future = super().submit(run)
+        except BaseException:
+            self._released_queued()
+            raise
+
+        future.add_done_callback(self._future2released_if_cancelled)  # run() never starts then
+        self.counter.incr(self.Count.SUBMITTED)
+        return future
+
+    def _released_queued(self):
+        self._add_depth_running(-1, 0)
+        if self.semaphore is not None:
+            self.semaphore.release()
+
+    def _future2released_if_cancelled(self, future):
+        if future.cancelled():
+            self._released_queued()
+
+    def metrics(self):
+        with self.lock_metric:
+            queue_depth, running = self.queue_depth, self.running
+
+        return {self.Field.MAX_WORKERS: self._max_workers,
+                self.Field.MAX_QUEUE: self.max_queue,
+                self.Field.QUEUE_DEPTH: queue_depth,
+                self.Field.RUNNING: running,
+                self.Field.COUNTS: self.counter.to_dict(),
+                self.Field.LATENCY_WAIT: self.latency_wait.to_dict(),
+                self.Field.LATENCY_RUN: self.latency_run.to_dict(),
+                }
+
+
 class ThreadTool:
+    class Constant:
+        POOL_DEFAULT = "default"
+        MAX_QUEUE_DEFAULT = 1024
+
+    _h_name2executor = {}
+    _lock_executor = Lock()
+
+    @classmethod
+    def name2executor(cls, name=None, max_workers=None, max_queue=None, timeout_submit=None):
+        """
+        process-wide executor registry.
+        the pool is created on the first lookup of the name; later arguments for the same name are ignored.
+        max_queue: Constant.MAX_QUEUE_DEFAULT if None, so that shared pools always push back
+        """
+        name = name if name is not None else cls.Constant.POOL_DEFAULT
+        max_queue = max_queue if max_queue is not None else cls.Constant.MAX_QUEUE_DEFAULT
+
+        executor = cls._h_name2executor.get(name)
+        if executor is not None:
+            return executor
+
+        with cls._lock_executor:
+            if name not in cls._h_name2executor:
+                cls._h_name2executor[name] = BoundedThreadPoolExecutor(
+                    max_workers=max_workers,
+                    max_queue=max_queue,
+                    timeout_submit=timeout_submit,
+                    thread_name_prefix="{}.{}".format(FoxylibLogger.rootname, name),
+                )
+            return cls._h_name2executor[name]
+
+    @classmethod
+    def executors2metrics(cls):
+        with cls._lock_executor:
+            h_name2executor = dict(cls._h_name2executor)
+
+        return {name: executor.metrics() for name, executor in h_name2executor.items()}
+
+    @classmethod
+    def shutdown_executor(cls, name, wait=True):
+        with cls._lock_executor:
+            executor = cls._h_name2executor.pop(name, None)
+
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
     @classmethod
-    def func2threaded(cls, func=None, max_workers=None, ):
+    def shutdown_executors(cls, wait=True):
+        with cls._lock_executor:
+            executors = list(cls._h_name2executor.values())
+            cls._h_name2executor.clear()
+
+        for executor in executors:
+            executor.shutdown(wait=wait)
+
+    @classmethod
+    def func2threaded(cls, func=None, max_workers=None, pool=None, max_queue=None, timeout_submit=None):
+        """
+        submit each call into the shared executor named by 'pool' and return the future.
+        max_workers/max_queue/timeout_submit only apply if this call creates the pool. see name2executor()
+        """
         logger = FoxylibLogger.func_level2logger(cls.func2threaded, logging.DEBUG)
 
         def wrapper(f):
-            @wraps(f)
-            def wrapped(*args, **kwargs):
-                executor = ThreadPoolExecutor(max_workers=max_workers)  # non-blocking
+            def f_new(*args, **kwargs):
+                rv = f(*args, **kwargs)
 
-                def f_new(*args, **kwargs):
-                    rv = f(*args, **kwargs)
+                logger.info({"message": "func2thread", "value": rv})
+                LoggerTool.logger2flush_handlers(logger)
 
-                    logger.info({"message": "func2thread", "value": rv})
-                    LoggerTool.logger2flush_handlers(logger)
+                return rv
 
-                    return rv
+            @wraps(f)
+            def wrapped(*args, **kwargs):
+                executor = cls.name2executor(pool,
+                                             max_workers=max_workers,
+                                             max_queue=max_queue,
+                                             timeout_submit=timeout_submit,
+                                             )
 
                 future = executor.submit(f_new, *args, **kwargs)
                 # future.add_done_callback(lambda x: rs.setex(name, time, x.result()))
@@ -33,6 +221,26 @@ class ThreadTool:
 
         return wrapper(func) if func else wrapper
 
+    @classmethod
+    async def executor_func2aio_result(cls, executor, func, *args, secs_retry_max=0.05):
+        """
+        func(*args) on the executor, awaited on the running loop, which a full executor never blocks:
+        a BoundedThreadPoolExecutor is retried with backoff, up to secs_retry_max seconds apart
+        """
+        secs_retry = 0.001
+        while True:
+            try:
+                if isinstance(executor, BoundedThreadPoolExecutor):
+                    future = executor.submit_nowait(func, *args)
+                else:
+                    future = executor.submit(func, *args)
+                break
+            except queue.Full:
+                await asyncio.sleep(secs_retry)
+                secs_retry = min(secs_retry * 2, secs_retry_max)
+
+        return await asyncio.wrap_future(future)
+
     @classmethod
     def future2result_or_raise(cls, future):
         exc_future = future.exception()
@@ -41,3 +249,6 @@ class ThreadTool:
             raise exc_future
 
         return future.result()
+
+
+atexit.register(ThreadTool.shutdown_executors)